@@ -4,6 +4,9 @@ import requests   # See: http://docs.python-requests.org/en/master/
 from pprint import pprint
 import logging
 import sys
+import threading
+
+from tracing import Trace
 
 logging.getLogger('urllib3').setLevel(logging.INFO) # Don't want this debug level to cloud ours
 
@@ -59,9 +62,11 @@ class IMatchAPI:
     COLLECTION_PINS_BLUE = 53
     COLLECTION_PINS_NONE = 54
     REQUEST_TIMEOUT = 10                    # Request timeout in seconds
+    MAX_CONCURRENT_REQUESTS = 8             # Requests allowed in flight across all threads. IMWS is a desktop server.
 
     __auth_token = None # This stores the IMWS authentication token after authenticate() has been called
     __host_url = None
+    __request_slots = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
     collection_values = {
         COLLECTION_FLAGS : "Flags",
         COLLECTION_FLAGS_SET : "Flags|Set",
@@ -134,7 +139,8 @@ class IMatchAPI:
             endpoint = "/" + endpoint
 
         try:
-            req = requests.get(cls.__host_url + endpoint, params, timeout=cls.REQUEST_TIMEOUT)
+            with cls.__request_slots, Trace.span(f"GET {endpoint}", "imatch"):
+                req = requests.get(cls.__host_url + endpoint, params, timeout=cls.REQUEST_TIMEOUT)
             response = json.loads(req.text)
             if req.status_code == requests.codes.ok:
                 return response
@@ -157,7 +163,8 @@ class IMatchAPI:
         if endpoint[:1] != "/":
             endpoint = "/" + endpoint
 
-        req = requests.post(cls.__host_url + endpoint, params, timeout=cls.REQUEST_TIMEOUT)
+        with cls.__request_slots, Trace.span(f"POST {endpoint}", "imatch"):
+            req = requests.post(cls.__host_url + endpoint, params, timeout=cls.REQUEST_TIMEOUT)
         response = json.loads(req.text)
         if req.status_code == requests.codes.ok:
             return response
@@ -176,7 +183,7 @@ class IMatchAPI:
             response = cls.post_imatch( '/v1/categories/assign', params)
             if response is not None:
                 if response['result'] == "ok":
-                    logging.debug(f'Image assigned to {category}')
+                    logging.debug('Image assigned to %s', category)
                     return
             else:
                 print("There was an error removing images from the category. Please see message above.")
@@ -187,10 +194,12 @@ class IMatchAPI:
             sys.exit(1)
 
     @classmethod
-    def delete_attributes(cls, set, filelist, params={}, data={}):
+    def delete_attributes(cls, set, filelist, params=None, data=None):
         """ Delete attributes for image with id. Assumes attributes only exist once.
          (modification required if multiple instances of attribute sets are to be managed) """
 
+        params = {} if params is None else params
+
         params['set'] = set
         params['id'] = IMatchUtility().prepare_filelist(filelist)
 
@@ -201,7 +210,7 @@ class IMatchAPI:
 
         params['tasks'] = json.dumps(tasks)  # Necessary to stringify the tasks array before sending
 
-        logging.debug(f"Sending instructions : {params}")
+        logging.debug("Sending instructions : %s", params)
 
         response = cls.post_imatch( '/v1/attributes', params)
 
@@ -222,36 +231,42 @@ class IMatchAPI:
         return response['value']
 
     @classmethod
-    def get_attributes(cls, set, id, params={}):
+    def get_attributes(cls, set, id, params=None):
         """ Return all attributes for a list of file ids. filelist is an array. """
 
+        params = {} if params is None else params
+
         params['set'] = set
         params['id'] = IMatchUtility().prepare_filelist(id)
 
-        logging.debug(f"Requesting attributes for {params['id']}")
+        logging.debug("Requesting attributes for %s", params['id'])
         response = cls.get_imatch( '/v1/attributes', params)
 
         # Strip away the wrapping from the result
         results = []
         for attributes in response['result']:
             results.append(attributes['data'][0])
-        logging.debug(f"{len(results)} attribute instances retrieved.")
+        logging.debug("%s attribute instances retrieved.", len(results))
         return results
 
     @classmethod
-    def get_category_info(cls, category, params={}):
+    def get_category_info(cls, category, params=None):
         """ Return information about a category"""
 
+        params = {} if params is None else params
+
         params['path'] = category
         
-        logging.debug(f"Retrieving category information for {category}")
+        logging.debug("Retrieving category information for %s", category)
         response = cls.get_imatch( '/v1/categories', params)
         return response['categories']
 
     @classmethod
-    def get_file_categories(cls, filelist, params={}):
+    def get_file_categories(cls, filelist, params=None):
         """ Return the categories for the list of files """
 
+        params = {} if params is None else params
+
         params['id'] = IMatchUtility().prepare_filelist(filelist)
 
         response = cls.get_imatch( '/v1/files/categories', params)
@@ -259,7 +274,7 @@ class IMatchAPI:
         for file in response['files']:
             logging.debug(file)
             results[file['id']] = file['categories']
-        logging.debug(f"{len(results)} images with categories.")
+        logging.debug("%s images with categories.", len(results))
         return results
         
     @classmethod
@@ -270,7 +285,7 @@ class IMatchAPI:
         params['path'] = path
         params['fields'] = 'files,directfiles'
 
-        logging.debug(f'Retrieving list of files in the {path} category.')
+        logging.debug('Retrieving list of files in the %s category.', path)
         try:
             response = cls.get_imatch( '/v1/categories', params)
             if len(response['categories']) == 0:
@@ -279,7 +294,7 @@ class IMatchAPI:
                 return []
             else:
                 # Get straight to the data if present
-                logging.debug(f"{len(response['categories'][0]['files'])} files found.")
+                logging.debug("%s files found.", len(response['categories'][0]['files']))
                 return response['categories'][0]
         except requests.exceptions.RequestException as re:
             print(re)
@@ -296,21 +311,23 @@ class IMatchAPI:
         params['path'] = path
         params['fields'] = 'children,files,path'
 
-        logging.debug(f'Retrieving list of children categories in the {path} category.')
+        logging.debug('Retrieving list of children categories in the %s category.', path)
         response = cls.get_imatch( '/v1/categories', params)
         if len(response['categories']) == 0:
             logging.debug("0 categories found.")
             return []
         else:
             # Get straight to the data if present
-            logging.debug(f"{len(response['categories'][0]['children'])} children found.")
+            logging.debug("%s children found.", len(response['categories'][0]['children']))
             return response['categories'][0]['children']
 
 
     @classmethod
-    def get_file_metadata(cls, filelist, params={}):
+    def get_file_metadata(cls, filelist, params=None):
         """ Return details list of file ids """
 
+        params = {} if params is None else params
+
         params['id'] = IMatchUtility().prepare_filelist(filelist)
         response = cls.get_imatch( '/v1/files', params)
         return response['files']
@@ -361,10 +378,13 @@ class IMatchAPI:
             print(ex)
 
     @classmethod
-    def set_attributes(cls, set, filelist, params={}, data={}):
+    def set_attributes(cls, set, filelist, params=None, data=None):
         """ Set attributes for image with id. Assumes attributes only exist once. Will either add or update as needed.
          (modification required if multiple instances of attribute sets are to be managed) """
 
+        params = {} if params is None else params
+        data = {} if data is None else data
+
         params['set'] = set
         params['id'] = IMatchUtility().prepare_filelist(filelist)
 
@@ -391,7 +411,7 @@ class IMatchAPI:
 
         params['tasks'] = json.dumps(tasks)  # Necessary to stringify the tasks array before sending
 
-        logging.debug(f"Sending instructions : {params}")
+        logging.debug("Sending instructions : %s", params)
 
         response = cls.post_imatch( '/v1/attributes', params)
 
@@ -403,8 +423,11 @@ class IMatchAPI:
             sys.exit()
 
     @classmethod
-    def set_collections(cls, collection, filelist, op="add", params={}):
+    def set_collections(cls, collection, filelist, op="add", params=None):
         """ Set collections for files."""
+
+        params = {} if params is None else params
+
         if isinstance(collection, int):
             path = cls.collection_values[collection]
         else:
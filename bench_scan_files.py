@@ -0,0 +1,111 @@
+import argparse
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import tempfile
+import time
+from collections import defaultdict
+
+import scan_files
+
+## Benchmark of the vault scan against a synthetic vault. Builds a vault of notes of
+## varied length, some linking photos, then times the scanner in scan_files against
+## the line by line scanner it replaced, and a warm ReferenceIndex update.
+##
+##   python bench_scan_files.py [--notes 50000] [--keep FOLDER]
+
+WORDS = "the a photo of light over hills morning walk river garden quiet city street evening".split()
+
+
+def build_vault(folder, notes, seed=1):
+    """Write the synthetic vault. Roughly one note in five references photos, a few
+    notes are long, and the ignored photos folder holds files that must not be read."""
+    random.seed(seed)
+    os.makedirs(os.path.join(folder, "photos"), exist_ok=True)
+    for i in range(200):
+        with open(os.path.join(folder, "photos", f"{i:06d}.md"), 'w', encoding='utf-8') as file:
+            file.write(f"![[{i:06d}_c.webp]]\n")
+    for i in range(notes):
+        subfolder = os.path.join(folder, f"notes{i // 1000:03d}")
+        if i % 1000 == 0:
+            os.makedirs(subfolder, exist_ok=True)
+        lines = [" ".join(random.choices(WORDS, k=12)) for _ in range(random.choice([5, 20, 40, 400]))]
+        if random.random() < 0.2:
+            for _ in range(random.randint(1, 4)):
+                lines.insert(random.randrange(len(lines)), f"![[{random.randrange(100000):06d}_{random.choice('cmntz')}.webp]]")
+        with open(os.path.join(subfolder, f"note{i:06d}.md"), 'w', encoding='utf-8') as file:
+            file.write("\n".join(lines))
+        if i % 100 == 0:
+            with open(os.path.join(subfolder, f"image{i:06d}.png"), 'wb') as file:
+                file.write(os.urandom(4096))    # Attachments the scanner should skip
+
+
+def legacy_scan_file(file_path, pattern):
+    """The scanner scan_files used to have: compiled per file, decoded and read line by line"""
+    regex = re.compile(pattern)
+    match_dict = {}
+    try:
+        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+            for line_num, line in enumerate(f, 1):
+                for match in regex.finditer(line):
+                    match_dict.setdefault(match.group()[:6], []).append((file_path, line_num))
+    except Exception:
+        pass
+    return match_dict
+
+
+def legacy_scan(folder_path, pattern, folders_to_ignore):
+    file_paths = []
+    for root, dirs, files in os.walk(folder_path):
+        dirs[:] = [d for d in dirs if d.lower() not in folders_to_ignore]
+        for file_name in files:
+            file_paths.append(os.path.join(root, file_name))
+    with multiprocessing.Pool() as pool:
+        results = pool.starmap(legacy_scan_file, [(file_path, pattern) for file_path in file_paths])
+    combined_matches = defaultdict(list)
+    for result in results:
+        for match_text, occurrences in result.items():
+            combined_matches[match_text].extend(occurrences)
+    return combined_matches
+
+
+def timed(label, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    print(f"{label:<32} {time.perf_counter() - start:>8.2f}s")
+    return result
+
+
+def references(matches):
+    return sorted((media_id, file_path, line_num) for media_id, occurrences in matches.items() for file_path, line_num in occurrences)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the vault scanner on a synthetic vault.")
+    parser.add_argument("--notes", type=int, default=50000, help="notes in the synthetic vault (default: 50000)")
+    parser.add_argument("--keep", metavar="FOLDER", help="build the vault in FOLDER and keep it, reusing it if it exists")
+    args = parser.parse_args()
+
+    folder = args.keep or tempfile.mkdtemp(prefix="vault_")
+    try:
+        if not os.path.exists(os.path.join(folder, "notes000")):
+            timed(f"Building {args.notes} notes", build_vault, folder, args.notes)
+        pattern = scan_files.MEDIA_PATTERN
+        ignore = scan_files.VAULT_FOLDERS_TO_IGNORE
+
+        legacy = timed("Line by line scan", legacy_scan, folder, pattern, ignore)
+        current = timed("scan_files scan", scan_files.scan_folder_with_subfolders, folder, pattern, ignore, scan_files.MEDIA_LITERAL)
+        if references(legacy) != references(current):
+            print("** Scanners disagree **")
+
+        index_folder = tempfile.mkdtemp(prefix="index_")
+        index = scan_files.ReferenceIndex(folder, pattern, ignore, os.path.join(index_folder, "references.json"), scan_files.MEDIA_LITERAL)
+        timed("Reference index, first build", index.update)
+        timed("Reference index, no changes", index.update)
+        shutil.rmtree(index_folder)
+        print(f"{len(references(current))} references to {len(current)} photos")
+    finally:
+        if args.keep is None:
+            shutil.rmtree(folder)
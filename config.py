@@ -12,6 +12,9 @@ DELETE_CATEGORY = "_delete"
 # Error category root. All error categories sit below this
 ERROR_CATEGORY = "__errors"
 
+# Run history, journals and caches kept between runs
+STATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "state")
+
 # Standardise reference to Megabyte
 MB_SIZE = 1048576
 
@@ -20,10 +23,24 @@ desc_length = 20
 bar_format = "{desc:<50}{percentage:3.0f}%|{bar}| {n_fmt:<3}/{total_fmt:<3} [{elapsed}<{remaining}]"
 
 
-with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),"secrets.json")) as f:
+# secrets.json sits beside the code, unless SHARE_IMAGES_SECRETS names another, e.g. for the tests
+SECRETS_PATH = os.environ.get("SHARE_IMAGES_SECRETS", os.path.join(os.path.dirname(os.path.abspath(__file__)), "secrets.json"))
+
+with open(SECRETS_PATH) as f:
     secrets = json.load(f)
 
 albums = secrets["albums"]
 locations = secrets["locations"]
 flickr_secrets = secrets["flickr"]
-quantum_secrets = secrets["quantum"]
\ No newline at end of file
+quantum_secrets = secrets["quantum"]
+
+# ExifTool runs as a few stay-open sessions shared by the whole run. Defaults to the copy
+# installed with IMatch. Override with an optional "exiftool" section in secrets.json:
+# { "path" : "...", "sessions" : 4, "pipeline" : 8, "timeout" : 15 }
+# pipeline is how many commands each session has queued at once, and timeout the seconds
+# a command may take once exiftool starts on it.
+exiftool_secrets = secrets.get("exiftool", {})
+EXIFTOOL_PATH = exiftool_secrets.get("path", r"C:\Program Files\photools.com\imatch6\exiftool.exe")
+EXIFTOOL_SESSIONS = exiftool_secrets.get("sessions", 4)
+EXIFTOOL_PIPELINE = exiftool_secrets.get("pipeline", 8)
+EXIFTOOL_TIMEOUT = exiftool_secrets.get("timeout", 15)
@@ -0,0 +1,94 @@
+from contextlib import contextmanager
+from datetime import datetime
+import io
+import json
+import os
+import threading
+import time
+
+from tqdm import tqdm
+
+import config
+
+## Machine readable progress for the IMatch app and other tools. Each event is a
+## single JSON object on its own line (NDJSON), written as it happens, so a reader
+## can follow the file while the run continues. Terminal progress bars are
+## replaced by progress events while the stream is on.
+
+DEFAULT_PATH = os.path.join(config.STATE_PATH, "events.ndjson")
+
+
+class Events():
+    """The run's event file. start() opens it, emit() appends an event from any thread and
+    finish() closes it after run_end. Without --events nothing is written."""
+
+    enabled = False
+    __file = None
+    __lock = threading.Lock()
+
+    @classmethod
+    def start(cls, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        cls.__file = open(path, 'w', encoding='utf-8')
+        cls.enabled = True
+        cls.emit("run_start", pid=os.getpid())
+
+    @classmethod
+    def finish(cls, **fields):
+        if not cls.enabled:
+            return
+        cls.emit("run_end", **fields)
+        with cls.__lock:
+            cls.enabled = False
+            cls.__file.close()
+            cls.__file = None
+
+    @classmethod
+    def emit(cls, event, **fields):
+        """Write one event. Safe to call from worker threads."""
+        if not cls.enabled:
+            return
+        line = json.dumps({"event" : event, "time" : datetime.now().isoformat(timespec="milliseconds")} | fields, default=str)
+        with cls.__lock:
+            if cls.__file is None:
+                return
+            cls.__file.write(line + "\n")
+            cls.__file.flush()
+
+    @classmethod
+    @contextmanager
+    def stage(cls, platform, stage, items=None):
+        """Emit stage_start and stage_end around the block, with the stage's throughput at the end"""
+        if not cls.enabled:
+            yield
+            return
+        cls.emit("stage_start", platform=platform, stage=stage, items=items)
+        start = time.perf_counter()
+        status = "failed"
+        try:
+            yield
+            status = "ok"
+        finally:
+            seconds = time.perf_counter() - start
+            rate = items / seconds if items and seconds > 0 else None
+            cls.emit("stage_end", platform=platform, stage=stage, items=items, seconds=round(seconds, 3), rate=rate, status=status)
+
+
+class EventProgress(tqdm):
+    """A progress bar that reports progress events instead of drawing on the terminal"""
+
+    def __init__(self, *args, **kwargs) -> None:
+        kwargs['mininterval'] = max(kwargs.get('mininterval', 0.1), 1.0)
+        kwargs['file'] = io.StringIO()  # Nothing reaches the terminal
+        super().__init__(*args, **kwargs)
+
+    def display(self, msg=None, pos=None):
+        values = self.format_dict
+        rate = values['rate'] if values['rate'] else (values['n'] / values['elapsed'] if values['elapsed'] > 0 else None)
+        eta = (values['total'] - values['n']) / rate if rate and values['total'] else None
+        Events.emit("progress", description=self.desc.rstrip(": "), done=values['n'], total=values['total'],
+                    rate=rate, elapsed=round(values['elapsed'], 1), eta=round(eta, 1) if eta is not None else None)
+        return True
+
+    def clear(self, *args, **kwargs):
+        pass
@@ -5,16 +5,19 @@ import re
 import shutil
 import sys
 import logging
-from tqdm import tqdm
 
 import flickrapi
 
 from imatch_image import IMatchImage
 import IMatchAPI as im
+from journal import Journal
 from platform_controller import PlatformController
 from album import Album
 import config
-from utilities import print_clear, replace_extension, set_metadata
+import scan_files
+from metrics import MeteredProxy
+from tracing import Trace
+from utilities import LazyFormat, MetadataDigests, print_clear, progress_bar, replace_extension, set_metadata, vault_lock, write_if_changed
 
 logging.getLogger("flickrapi.core").setLevel(logging.CRITICAL)  # Hide basic info messages from flickr api
 
@@ -99,61 +102,65 @@ class FlickrImage(IMatchImage):
     
 class FlickrController(PlatformController):
 
+    commit_workers = 4  # Uploads are network bound. Flickr is comfortable with a handful in flight.
+
     def __init__(self, platform_name, album_cls, preferred_format, allowed_formats) -> None:
         super().__init__(platform_name, album_cls, preferred_format, allowed_formats)
         self.privacy = config.flickr_secrets['privacy']
         self.upload_format = im.IMatchAPI.FORMAT_JPEG
+        self.replaced_urls = {}  # photo_id -> new url, for photos replaced since the vault was last rewritten
 
-        logging.debug(f'{self.name}: Instance initialised.')
+        logging.debug('%s: Instance initialised.', self.name)
 
     
-    def add_images(self):
+    def prepare_add(self, images):
+        self._prepare_files(images, "add")
+
+    def _prepare_files(self, images, description):
         # Images loaded from raw jpegs will have private location information in them
         # We need to split them out and remove that code with exiftool before the
         # upload. The best way to do this is to avoid uploading originals.
         # 1. Copy to a temp location and point the filename at this file
         # 2. Run exiftool over the files
         # 3. Upload the temp files
+        # When resuming, copies and metadata already journalled are left alone. A fresh
+        # copy always needs its metadata redoing. A metadata-only update can keep the copy
+        # from last time if the tags it carries are unchanged.
 
+        copy_tasks = []
         exiftool_tasks = []
-        for image in self.images_to_add:
+        digests = {}
+        for image in images:
             output_file = replace_extension(os.path.join(config.flickr_secrets['tmp_path'], image.name),"jpg")
-            exiftool_tasks.append([image.filename, output_file, image.isPrivate])
+            task = [image.filename, output_file, image.isPrivate]
+            digests[output_file] = image.metadata_digest
             image.filename = output_file
-
+            if image.operation == IMatchImage.OP_METADATA and MetadataDigests.current(self.name, output_file, digests[output_file]):
+                logging.debug("%s: Metadata unchanged, keeping %s", self.name, output_file)
+            elif not (os.path.exists(output_file) and Journal.done(self.name, Journal.COPIED, output_file)):
+                copy_tasks.append((image, task))
+                exiftool_tasks.append(task)
+            elif not Journal.done(self.name, Journal.METADATA, output_file):
+                exiftool_tasks.append(task)
+
+        if len(copy_tasks) > 0:
+            for image, task in progress_bar(copy_tasks, f"{self.name}: Copying files to {description}", position=self.progress_position):
+                with self.metrics.measure("copy", os.path.getsize(task[0])), Trace.span("copy", "copy", image=image.id, platform=self.name, file=task[0]):
+                    shutil.copy(task[0], task[1])
+                Journal.record(self.name, Journal.COPIED, task[1])
         if len(exiftool_tasks) > 0:
-            for task in tqdm(exiftool_tasks, f"{self.name}: Copying files to add", bar_format=config.bar_format):
-                shutil.copy(task[0], task[1])
-            set_metadata(exiftool_tasks, self.name)
-
-        super().add_images()
-
-    def classify_images(self):
-        super().classify_images()
-        for image in self.images:
-            if image.operation != IMatchImage.OP_INVALID:
-                for category in image.categories:
-                    splits = category['path'].split("|")
-                    match splits[0]:
-                        case "Socials":
-                            if splits[1] == "albums":
-                                try:
-                                    name = splits[2]
-                                    try:
-                                        self.albums[name].add(image)
-                                        logging.debug(f'{self.name}: Adding image to album {name}')
-                                    except KeyError:
-                                        logging.error(f'{self.name}: Missing album configuration for "{name}". Check secrets.json')
-                                        sys.exit(1)
-                                except IndexError:
-                                    pass #no albums found
+            with self.metrics.measure("exiftool", len(exiftool_tasks)), Trace.context(platform=self.name):
+                written = set_metadata(exiftool_tasks, self.name, position=self.progress_position, pool=self.exiftool)
+            for output_file in written:
+                Journal.record(self.name, Journal.METADATA, output_file)
+            MetadataDigests.record(self.name, {output_file : digests[output_file] for output_file in written})
 
     def connect(self):
         if self.api is not None:
             return
         else: 
             try:
-                print(f"{self.name}: Work to do -- connecting to platform", end="\r")
+                print_clear(f"{self.name}: Work to do -- connecting to platform", end="\r")
                 flickr = flickrapi.FlickrAPI(
                     config.flickr_secrets["api_key"],
                     config.flickr_secrets["api_secret"],
@@ -167,33 +174,47 @@ class FlickrController(PlatformController):
                 logging.error(f"{self.name}: {ex}")
                 sys.exit()
             
-            self.api = flickr
+            self.api = MeteredProxy(flickr, self.metrics, self._stage_for_call)
+
+    def _stage_for_call(self, name, args, kwargs):
+        """Metrics stage and units of work for a flickr api call"""
+        if name in ['upload', 'replace']:
+            filename = kwargs['filename'] if 'filename' in kwargs else args[0]
+            return "upload", os.path.getsize(filename)
+        return "api", 1
 
 
     def commit_add(self, image):       
         """Make the api call to commit the image to the platform, and update IMatch with reference details"""
-        try:
-            logging.debug("[commit_add] Image variables\n%s:", pformat(image.__dict__))
-            response = self.api.upload(
-                image.filename,
-                title = image.title if image.title != '' else image.name,
-                description = image.description,
-                is_public = self.privacy['is_public'],
-                is_friend = self.privacy['is_friend'],
-                is_family = self.privacy['is_family'],
-                )
-            if response.attrib['stat'] != "ok":
-                raise RuntimeError("Unable to upload image to flickr")
-        except flickrapi.FlickrError as fe:
-            print_clear()
-            logging.error(f"Error adding file: {fe}")
-            sys.exit(1)
+        uploaded = Journal.get(self.name, Journal.UPLOADED, image.id)
+        if uploaded is not None:
+            # Uploaded by an interrupted run. Carry on with that photo rather than uploading a duplicate.
+            photo_id = uploaded['photo_id']
+            logging.debug("[commit_add] Resuming %s as %s", image.name, photo_id)
+        else:
+            try:
+                logging.debug("[commit_add] Image variables\n%s:", LazyFormat(pformat, image.__dict__))
+                response = self.api.upload(
+                    image.filename,
+                    title = image.title if image.title != '' else image.name,
+                    description = image.description,
+                    is_public = self.privacy['is_public'],
+                    is_friend = self.privacy['is_friend'],
+                    is_family = self.privacy['is_family'],
+                    )
+                if response.attrib['stat'] != "ok":
+                    raise RuntimeError("Unable to upload image to flickr")
+            except flickrapi.FlickrError as fe:
+                print_clear()
+                logging.error(f"Error adding file: {fe}")
+                sys.exit(1)
+
+            photo_id = response.findtext('photoid')
+            Journal.record(self.name, Journal.UPLOADED, image.id, photo_id=photo_id)
 
-        photo_id = response.findtext('photoid')
-            
         try:
             # Force date. Sometimes exif date does not pull through, especially for scans
-            logging.debug(f"[commit_add] Setting date for {image.filename}")
+            logging.debug("[commit_add] Setting date for %s", image.filename)
             response = self.api.photos.setDates(
                 photo_id=photo_id, 
                 date_taken=str(image.date_time), 
@@ -207,8 +228,16 @@ class FlickrController(PlatformController):
             logging.erorr(fe)
             sys.exit(1)
 
+        in_albums = set()
+        if uploaded is not None:
+            # The interrupted run may have added it to some albums already. Flickr refuses to add it twice.
+            contexts = self.api.photos.getAllContexts(photo_id = photo_id, format="parsed-json")
+            in_albums = {ps['id'] for ps in contexts.get('set', [])}
+
         for album in image.albums:
-            logging.debug(f"[commit_add] Adding {photo_id} to album: {album}")
+            if album.photoset_id in in_albums:
+                continue
+            logging.debug("[commit_add] Adding %s to album: %s", photo_id, album)
             try:
                 response = self.api.photosets_addPhoto(
                     photoset_id=album.photoset_id, 
@@ -260,11 +289,14 @@ class FlickrController(PlatformController):
 
         # Update the image in IMatch by adding the attributes below.
         posted = datetime.now().isoformat()[:10]
-        im.IMatchAPI.set_attributes(self.name, image.id, data = {
-            'posted' : posted,
-            'photo_id' : photo_id,
-            'url' : f"{config.flickr_secrets["url"]}{photo_id}"
-            })
+        if not Journal.done(self.name, Journal.WRITTEN_BACK, image.id):  # Unless an interrupted run already did
+            with self.metrics.measure("writeback", 1):
+                im.IMatchAPI.set_attributes(self.name, image.id, data = {
+                    'posted' : posted,
+                    'photo_id' : photo_id,
+                    'url' : f"{config.flickr_secrets["url"]}{photo_id}"
+                    })
+            Journal.record(self.name, Journal.WRITTEN_BACK, image.id)
 
                             
     def commit_delete(self, image):
@@ -277,7 +309,7 @@ class FlickrController(PlatformController):
         photo_id = attributes['photo_id']
 
         try:    
-            logging.debug(f"[commit_delete] Checking for comments {image.name}, {photo_id}")
+            logging.debug("[commit_delete] Checking for comments %s, %s", image.name, photo_id)
             response = self.api.photos.getInfo(
                 photo_id = photo_id,
                 format="parsed-json"
@@ -292,12 +324,11 @@ class FlickrController(PlatformController):
  
         if response['photo']['comments']['_content'] != '0':
             # Commented image, do not delete
-            image.errors.append("commented file")
-            self.invalid_images.add(image)
+            self.mark_invalid(image, "commented file")
             return False
 
         try:    
-            logging.debug(f"[commit_delete] Checking for faves {image.name}, {photo_id}")
+            logging.debug("[commit_delete] Checking for faves %s, %s", image.name, photo_id)
             response = self.api.photos.getFavorites(
                 photo_id = photo_id,
                 format="parsed-json"
@@ -312,12 +343,11 @@ class FlickrController(PlatformController):
 
         if bool(response.get("photo", {}).get("person")):
             # Favorited, do not delete
-            image.errors.append("faved file")
-            self.controller.invalid_images.add(image)
+            self.mark_invalid(image, "faved file")
             return False
 
         try:    
-            logging.debug(f"[commit_delete] Deleting {image.name}, {photo_id}")
+            logging.debug("[commit_delete] Deleting %s, %s", image.name, photo_id)
             response = self.api.photos.delete(photo_id = photo_id)
             if response.attrib['stat'] != "ok":
                 raise RuntimeError("Unable to delete image")
@@ -351,7 +381,7 @@ class FlickrController(PlatformController):
             #         'url' : f"{config.flickr_secrets["url"]}{photo_id}"
             #         })
                     
-            logging.debug(f"[commit_update] Set title and description for {photo_id}")
+            logging.debug("[commit_update] Set title and description for %s", photo_id)
             response = self.api.photos.setMeta(
                 title = image.title if image.title != '' else image.name,
                 description = image.description,  
@@ -361,57 +391,50 @@ class FlickrController(PlatformController):
                 raise RuntimeError("Unable to update title and description")
 
             if image.operation == IMatchImage.OP_UPDATE:
-                # Update image alongside metadata
-                logging.debug(f"[commit_update] Replacing image for {photo_id}")
-                try:
-                    response = self.api.replace(
-                        filename = image.filename, 
-                        photo_id = photo_id
-                        )
-                    if response.attrib['stat'] != "ok":
-                        raise RuntimeError("Unable to replace image file")
-                except flickrapi.FlickrError as fe:
-                    logging.error(fe)
-                    logging.error(response)
-                    sys.exit(1)
+                replaced = Journal.get(self.name, Journal.UPLOADED, image.id)
+                if replaced is not None:
+                    # Replaced by an interrupted run. Reuse the url it fetched, the old one no longer exists.
+                    new_url = replaced['url']
+                else:
+                    # Update image alongside metadata
+                    logging.debug("[commit_update] Replacing image for %s", photo_id)
+                    try:
+                        response = self.api.replace(
+                            filename = image.filename, 
+                            photo_id = photo_id
+                            )
+                        if response.attrib['stat'] != "ok":
+                            raise RuntimeError("Unable to replace image file")
+                    except flickrapi.FlickrError as fe:
+                        logging.error(fe)
+                        logging.error(response)
+                        sys.exit(1)
                 
-                # We updated so the secret component of any images linked externally will change.
-                try:
-                    response = self.api.photos_getSizes(
-                        photo_id = photo_id,
-                        format = "parsed-json"
-                    )
-                    if response['stat'] != "ok":
-                        raise RuntimeError("Unable to access sizes")
-                except flickrapi.FlickrError as fe:
-                    logging.error(fe)
-                    logging.error(response)
-                    sys.exit(1)
-
-                new_url = None
-                for size in response['sizes']['size']:
-                    if size['label'] == "Medium 800":
-                        new_url = size['source']
-                if not new_url:
-                    raise ValueError(f"Size 'c' not found for {photo_id}")
+                    # We updated so the secret component of any images linked externally will change.
+                    try:
+                        response = self.api.photos_getSizes(
+                            photo_id = photo_id,
+                            format = "parsed-json"
+                        )
+                        if response['stat'] != "ok":
+                            raise RuntimeError("Unable to access sizes")
+                    except flickrapi.FlickrError as fe:
+                        logging.error(fe)
+                        logging.error(response)
+                        sys.exit(1)
+
+                    new_url = None
+                    for size in response['sizes']['size']:
+                        if size['label'] == "Medium 800":
+                            new_url = size['source']
+                    if not new_url:
+                        raise ValueError(f"Size 'c' not found for {photo_id}")
+                    Journal.record(self.name, Journal.UPLOADED, image.id, photo_id=photo_id, url=new_url)
                     
-                flickr_pattern = flickr_pattern = re.compile(
-                    rf'https://live\.staticflickr\.com/\d+/{photo_id}_[a-zA-Z0-9]+(?:_[a-z])?\.jpg'
-                )
-                for root, _, files in os.walk(config.quantum_secrets['path']):
-                    for file in files:
-                        if file.endswith('.md'):
-                            file_path = os.path.join(root, file)
-                            with open(file_path, 'r', encoding="utf-8") as f:
-                                content = f.read()
-
-                            updated_content = flickr_pattern.sub(new_url, content)
-
-                            if content != updated_content:
-                                with open(file_path, 'w', encoding='utf-8') as f:
-                                    f.write(updated_content)
+                with self.lock:
+                    self.replaced_urls[photo_id] = new_url  # Rewritten in the vault once the updates are done
                 
-            logging.debug(f"[commit_update] Setting dates for {photo_id}")
+            logging.debug("[commit_update] Setting dates for %s", photo_id)
             response = self.api.photos.setDates(
                 photo_id=photo_id, 
                 date_taken=str(image.date_time), 
@@ -420,16 +443,16 @@ class FlickrController(PlatformController):
             if response.attrib['stat'] != "ok":
                 raise RuntimeError("Unable to update date")
             
-            logging.debug(f"[commit_update] Resetting tags for {photo_id}")
+            logging.debug("[commit_update] Resetting tags for %s", photo_id)
             ## Get list of assigned tags in flickr
             response = self.api.photos.getInfo(
                 photo_id = photo_id, 
                 format = "parsed-json")
-            logging.debug("[commit_update] Assigned tags\n%s:", pformat(response['photo']['tags']))
+            logging.debug("[commit_update] Assigned tags\n%s:", LazyFormat(pformat, response['photo']['tags']))
             for tag in response['photo']['tags']['tag']:
                 if tag['raw'] not in image.flat_keywords:
                     # Don't want this tag anymore, remove it
-                    logging.debug(f"[commit_update] Removing tag: {tag['raw']}")
+                    logging.debug("[commit_update] Removing tag: %s", tag['raw'])
                     response = self.api.photos.removeTag(
                         tag_id=tag['id']) 
                     if response.attrib['stat'] != "ok":
@@ -442,7 +465,7 @@ class FlickrController(PlatformController):
             if response.attrib['stat'] != "ok":
                 raise RuntimeError("Unable to add keywords")
 
-            logging.debug(f"[commit_update] Setting permissions for {photo_id}")
+            logging.debug("[commit_update] Setting permissions for %s", photo_id)
             response = self.api.photos.setPerms(
                 photo_id=photo_id,
                 is_public=self.privacy['is_public'],
@@ -452,7 +475,7 @@ class FlickrController(PlatformController):
             if response.attrib['stat'] != "ok":
                 raise RuntimeError("Unable to set permissions")
 
-            logging.debug(f"[commit_update] Requesting contexts for {photo_id}")
+            logging.debug("[commit_update] Requesting contexts for %s", photo_id)
             contexts = self.api.photos.getAllContexts(
                 photo_id = photo_id,
                 format="parsed-json"
@@ -465,12 +488,12 @@ class FlickrController(PlatformController):
 
             ## Remove the image from any flickr photosets that it should not belong to
             try:
-                logging.debug("[commit_update] Contexts (set)\n%s:", pformat(contexts['set']))
+                logging.debug("[commit_update] Contexts (set)\n%s:", LazyFormat(pformat, contexts['set']))
                 for flickr_album in contexts['set']:
                     # Check if any album in image.albums has a matching photoset_id
                     if flickr_album['id'] not in album_ids:
                         # Flickr says this image is in the album, but IMatch disagrees
-                        logging.debug(f"[commit_update] Removing image from `{flickr_album['title']}`")
+                        logging.debug("[commit_update] Removing image from `%s`", flickr_album['title'])
                         response = self.api.photosets_removePhoto(
                             photoset_id=flickr_album['id'],
                             photo_id=photo_id
@@ -487,7 +510,7 @@ class FlickrController(PlatformController):
                 if "set" in contexts:
                     flickr_albums = {ps['id'] for ps in contexts['set']}
                     if album.photoset_id not in flickr_albums:
-                        logging.debug(f"[commit_update] Adding to '{album.name}'")
+                        logging.debug("[commit_update] Adding to '%s'", album.name)
                         response = self.api.photosets_addPhoto(
                             photoset_id = album.photoset_id,
                             photo_id = photo_id
@@ -495,7 +518,7 @@ class FlickrController(PlatformController):
                         if response.attrib['stat'] != "ok":
                             raise RuntimeError(f"Unable to add to album '{album.name}")
                 else:
-                    logging.debug(f"[commit_update] Adding to '{album.name}'")
+                    logging.debug("[commit_update] Adding to '%s'", album.name)
                     response = self.api.photosets_addPhoto(
                         photoset_id = album.photoset_id,
                         photo_id = photo_id
@@ -533,11 +556,14 @@ class FlickrController(PlatformController):
 
             # Update the image in IMatch by adding the attributes below.
             posted = datetime.now().isoformat()[:10]
-            im.IMatchAPI.set_attributes(self.name, image.id, data = {
-                'posted' : posted,
-                'photo_id' : photo_id,
-                'url' : f"{config.flickr_secrets["url"]}{photo_id}"
-                })
+            if not Journal.done(self.name, Journal.WRITTEN_BACK, image.id):  # Unless an interrupted run already did
+                with self.metrics.measure("writeback", 1):
+                    im.IMatchAPI.set_attributes(self.name, image.id, data = {
+                        'posted' : posted,
+                        'photo_id' : photo_id,
+                        'url' : f"{config.flickr_secrets["url"]}{photo_id}"
+                        })
+                Journal.record(self.name, Journal.WRITTEN_BACK, image.id)
             
         except flickrapi.FlickrError as fe:
             logging.error(fe)
@@ -545,11 +571,12 @@ class FlickrController(PlatformController):
             sys.exit(1)
 
     def finalise(self):
+        self.rewrite_vault_urls()   # Replaced by an interrupted run, when nothing was updated in this one
         if len(self.images_to_add) + len(self.images_to_delete) + len(self.images_to_update) != 0:
             
             ## Set album order based on alphabetical album order
             print_clear(f'{self.name}: Finalising -- set album order', end='\r')
-            logging.debug(f"[commit_update] Finalising -- set album order")
+            logging.debug("[commit_update] Finalising -- set album order")
             sorted_ids = [album.photoset_id for album in sorted(self.albums.values(), key=lambda a: a.name)]
             
             self.connect() 
@@ -566,7 +593,7 @@ class FlickrController(PlatformController):
                 sys.exit(1)
 
             ## Now, set the thumbnail each album, based off the thumbnail set in the iMatch category and update the name and description
-            for album in tqdm(self.albums.values(), bar_format=config.bar_format, desc=f"{self.name}: Update album metadata"):
+            for album in progress_bar(self.albums.values(), desc=f"{self.name}: Update album metadata", position=self.progress_position):
                 category_info = im.IMatchAPI.get_category_info(
                     im.IMatchUtility.build_category([
                         config.ROOT_CATEGORY,
@@ -612,25 +639,78 @@ class FlickrController(PlatformController):
         super().finalise()  
         print_clear(f'{self.name}: Finalised')
 
-    def update_images(self):
-        # Images loaded from raw jpegs will have private location information in them
-        # We need to split them out and remove that code with exiftool before the
-        # upload. The best way to do this is to avoid uploading originals.
-        # 1. Copy to a temp location and point the filename at this file
-        # 2. Run exiftool over the files
-        # 3. Upload the temp files
+    def prepare_update(self, images):
+        self._prepare_files(images, "update")
 
-        exiftool_tasks = []
-        for image in self.images_to_update:
+    def begin_run(self):
+        # Photos replaced by an interrupted run may still be linked in the vault by their old urls
+        for data in Journal.entries(self.name, Journal.UPLOADED).values():
+            if 'url' in data:
+                self.replaced_urls[data['photo_id']] = data['url']
+
+    def complete_update(self, images):
+        try:
+            super().complete_update(images)
+        except BaseException:
+            # The run stops here, but the photos already replaced are only reachable at their new urls.
+            # Otherwise finalise() rewrites them once, for every batch.
+            self.rewrite_vault_urls()
+            raise
+
+    def rewrite_vault_urls(self):
+        """Point links in the vault to replaced photos at their new urls. The secret in a photo's url changes
+        when it is replaced. Only the files the url index lists for the replaced photos are read."""
+        if len(self.replaced_urls) == 0:
+            return
+        index = scan_files.flickr_url_index()
+        index.update()
+        file_paths = sorted({file_path for photo_id in self.replaced_urls for file_path, _ in index.lookup(photo_id)})
+
+        flickr_pattern = re.compile(scan_files.FLICKR_URL_PATTERN)
+        def new_url(match):
+            return self.replaced_urls.get(match.group(1), match.group())
+
+        with vault_lock:  # Quantum may be writing the same vault files
+            for file_path in progress_bar(file_paths, f"{self.name}: Updating links in the vault", position=self.progress_position):
+                with open(file_path, 'r', encoding="utf-8") as f:
+                    content = f.read()
+                self.count_write(write_if_changed(file_path, flickr_pattern.sub(new_url, content)))
+        self.replaced_urls = {}
+
+    def api_calls(self, image):
+        """Approximate number of flickr api calls, other than the upload, needed to commit the image"""
+        match image.operation:
+            case IMatchImage.OP_ADD:
+                return 2 + len(image.albums)   # dates, tags and each album
+            case IMatchImage.OP_UPDATE:
+                return 7    # as metadata, plus fetching the new sizes
+            case IMatchImage.OP_METADATA:
+                return 6    # meta, dates, info, tags, permissions and contexts. Tag and album changes vary.
+            case IMatchImage.OP_DELETE:
+                return 3    # comments, faves and the delete itself
+            case other:
+                return 0
+
+    def plan_work(self):
+        work = {stage : 0 for stage in ["copy", "exiftool", "upload", "api", "writeback"]}
+        for image in self.images_to_add | self.images_to_update:
             output_file = replace_extension(os.path.join(config.flickr_secrets['tmp_path'], image.name),"jpg")
-            exiftool_tasks.append([image.filename, output_file, image.isPrivate])
-            image.filename = output_file
+            if not (image.operation == IMatchImage.OP_METADATA and MetadataDigests.current(self.name, output_file, image.metadata_digest)):
+                work["copy"] += image.size
+                work["exiftool"] += 1
+            if image.operation in [IMatchImage.OP_ADD, IMatchImage.OP_UPDATE]:
+                work["upload"] += image.size
+            work["api"] += self.api_calls(image)
+            work["writeback"] += 1 if image.operation == IMatchImage.OP_ADD else 2
+
+        for image in self.images_to_delete:
+            work["api"] += self.api_calls(image)
+        if len(self.images_to_delete) > 0:
+            work["writeback"] += 2
 
-        if len(exiftool_tasks) > 0:
-            for task in tqdm(exiftool_tasks, f"{self.name}: Copying files to update", bar_format=config.bar_format):
-                shutil.copy(task[0], task[1])
-            set_metadata(exiftool_tasks, self.name)
-        super().update_images()
+        if len(self.images_to_add) + len(self.images_to_delete) + len(self.images_to_update) != 0:
+            work["api"] += 1 + 2 * len(self.albums)   # album order, then thumbnail and title for each album
+        return work
 
 class FlickrAlbum(Album):
     def __init__(self, name, description, photoset_id):
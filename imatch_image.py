@@ -1,14 +1,109 @@
+import copy
 from datetime import datetime
+import hashlib
+import json
 import logging
 from pprint import pprint
 import re
 import sys
+import threading
 
 import IMatchAPI as im
 import config
 
 logging.getLogger('urllib3').setLevel(logging.INFO) # Don't want this debug level to cloud ours
 
+class IMatchRecord():
+    """The raw information IMatch holds about a file: metadata, categories and relations. It is the
+    same whichever platform the file is shared to, so it is fetched once per run and shared by every
+    platform's image. Platform specifics, such as which version to upload, are applied by IMatchImage."""
+
+    FIELDS = {
+        "fields" : "datetime,filename,format,height,name,size,width", 
+        "tagtitle" : "title",
+        "tagdescription" : "description",
+        "taghierarchical_keywords" : "hierarchicalkeywords",
+        "varaperture" : "{File.MD.aperture}",
+        "varfocal_length" : "{File.MD.focallength|value:formatted}",
+        "varheadline" : "{File.MD.headline}",
+        "variso" : "{File.MD.iso|value:formatted}", 
+        "varlens" : "{File.MD.lens}",
+        "varmake" : "{File.MD.make}",
+        "varmodel" : "{File.MD.model}",
+        "varcameraname" : "{File.MD.photools.com::IMatch\\1510\\cameraname\\0}",
+        "varshutter_speed" : "{File.MD.shutterspeed|value:formatted}",
+        "varlatitude" : "{File.MD.gpslatitude|value:rawfrm}",
+        "varlongitude" : "{File.MD.gpslongitude|value:rawfrm}",
+        "varaltitude" : "{File.MD.gpsaltitude|value:rawfrm}",
+        "varcircadatecreated" : "{File.MD.XMP::iptcExt\\CircaDateCreated\\CircaDateCreated\\0}",
+        "varai_description" : "{File.MD.photools.com::IMatch\\200020\\AI.description\\0}",
+        "varcountry" : "{File.MD.Composite\\MWG-Country\\Country\\0}",
+        "varstate" : "{File.MD.Composite\\MWG-State\\State\\0}",
+        "varcity" : "{File.MD.Composite\\MWG-City\\City\\0}",
+        "varlocation" : "{File.MD.Composite\\MWG-Location\\Location\\0}",
+        "varcopyright" : "{File.MD.XMP::dc\\rights\\Rights\\0}",
+        "varcopyrightmarked" : "{File.MD.XMP::xmpRights\\Marked\\Marked\\0}",
+        "varcopyrighturl" : "{File.MD.XMP::xmpRights\\WebStatement\\WebStatement\\0}"
+    }
+
+    _records = {}   # Records fetched this run and still wanted by a platform, by file id
+    _wanted = {}    # file id -> platforms yet to take its record. Once all have, it is dropped.
+    _records_lock = threading.Lock()
+
+    def __init__(self, id) -> None:
+        self.id = id
+        self.info = None
+        self.categories = None
+        self.relations = None
+        self._lock = threading.Lock()  # Held while fetching so concurrent platforms wait rather than fetch twice
+
+    @classmethod
+    def expect(cls, ids):
+        """Note that a platform will gather the files, so their records are kept for it"""
+        with cls._records_lock:
+            for id in ids:
+                cls._wanted[id] = cls._wanted.get(id, 0) + 1
+
+    @classmethod
+    def get(cls, id):
+        """Return the record for the file id, fetching it from IMatch on first use. It is dropped from
+        the cache once every platform expecting it has taken it, so the cache doesn't grow with the run."""
+        with cls._records_lock:
+            record = cls._records.get(id)
+            if record is None:
+                record = cls(id)
+                cls._records[id] = record
+        with record._lock:
+            if record.info is None:
+                record._fetch()
+        with cls._records_lock:
+            remaining = cls._wanted.get(id, 0) - 1
+            if remaining > 0:
+                cls._wanted[id] = remaining
+            else:
+                cls._wanted.pop(id, None)
+                cls._records.pop(id, None)
+        return record
+
+    @classmethod
+    def cached(cls):
+        """Every record fetched so far"""
+        with cls._records_lock:
+            return list(cls._records.values())
+
+    def _fetch(self):
+        logging.debug("Querying image parameters")
+        self.info = im.IMatchAPI.get_file_metadata([self.id], dict(IMatchRecord.FIELDS))[0]
+
+        # Retrieve the list of categories the image belongs to.
+        logging.debug("Querying characteristics")
+        self.categories = im.IMatchAPI.get_file_categories([self.id], params={
+            'fields' : 'path,description'}
+            )[self.id]
+
+        self.relations = im.IMatchAPI.get_relations(self.id)
+
+
 class IMatchImage():
 
     ERROR_INDICATOR = im.IMatchAPI.COLLECTION_PINS_RED
@@ -31,51 +126,25 @@ class IMatchImage():
         self._set_operations()
         if self.operation != IMatchImage.OP_INVALID:
             self._prepare_for_operations()
-            logging.debug(f'{self.name}: Prepared for operations (opcode: {self.operation}).')
+            logging.debug('%s: Prepared for operations (opcode: %s).', self.name, self.operation)
         else:
-            logging.debug(f'NO_OP: {self.name}')
+            logging.debug('NO_OP: %s', self.name)
 
     def _fetch_information_from_imatch(self):
         # Get this image's information from IMatch. Process and save each
-        # as an attribute for easier reference.
-        image_params = {
-            "fields" : "datetime,filename,format,height,name,size,width", 
-            "tagtitle" : "title",
-            "tagdescription" : "description",
-            "taghierarchical_keywords" : "hierarchicalkeywords",
-            "varaperture" : "{File.MD.aperture}",
-            "varfocal_length" : "{File.MD.focallength|value:formatted}",
-            "varheadline" : "{File.MD.headline}",
-            "variso" : "{File.MD.iso|value:formatted}", 
-            "varlens" : "{File.MD.lens}",
-            "varmake" : "{File.MD.make}",
-            "varmodel" : "{File.MD.model}",
-            "varcameraname" : "{File.MD.photools.com::IMatch\\1510\\cameraname\\0}",
-            "varshutter_speed" : "{File.MD.shutterspeed|value:formatted}",
-            "varlatitude" : "{File.MD.gpslatitude|value:rawfrm}",
-            "varlongitude" : "{File.MD.gpslongitude|value:rawfrm}",
-            "varcircadatecreated" : "{File.MD.XMP::iptcExt\\CircaDateCreated\\CircaDateCreated\\0}",
-            "varai_description" : "{File.MD.photools.com::IMatch\\200020\\AI.description\\0}",
-            "varcountry" : "{File.MD.Composite\\MWG-Country\\Country\\0}",
-            "varstate" : "{File.MD.Composite\\MWG-State\\State\\0}",
-            "varcity" : "{File.MD.Composite\\MWG-City\\City\\0}",
-            "varlocation" : "{File.MD.Composite\\MWG-Location\\Location\\0}",
-            "varcopyright" : "{File.MD.XMP::dc\\rights\\Rights\\0}",
-            "varcopyrightmarked" : "{File.MD.XMP::xmpRights\\Marked\\Marked\\0}",
-            "varcopyrighturl" : "{File.MD.XMP::xmpRights\\WebStatement\\WebStatement\\0}"
-        }
-        
-        logging.debug("Querying image parameters")
-        image_info = im.IMatchAPI.get_file_metadata([self.id],image_params)[0]
+        # as an attribute for easier reference. The record is shared with other
+        # platforms so take copies of anything this image may change.
+        record = IMatchRecord.get(self.id)
+        image_info = record.info
 
         for attribute in image_info.keys():
             match attribute:
                 case "dateTime":
                     setattr(self, "date_time", datetime.strptime(image_info[attribute],'%Y-%m-%dT%H:%M:%S'))
-                    logging.debug(f'Setting date_time to {image_info[attribute]}')
+                    logging.debug('Setting date_time to %s', image_info[attribute])
                 case "fileName":    # fileName is a special case. Ask for filename, get fileName in results
                     setattr(self, "filename", image_info[attribute])
-                    logging.debug(f'Setting filename to {image_info[attribute]}')
+                    logging.debug('Setting filename to %s', image_info[attribute])
                 case "name":
                     match = re.search(r'\[(\d+)\]', image_info[attribute])
                     if match:
@@ -87,36 +156,33 @@ class IMatchImage():
                 case "model":
                     if image_info[attribute] == "Canon EOS 400D DIGITAL":
                         setattr(self, attribute, "Canon EOS 400D")
-                        logging.debug(f'Setting model to Canon EOS 400D')
+                        logging.debug('Setting model to Canon EOS 400D')
                     else:
                         setattr(self, attribute, image_info[attribute])
-                        logging.debug(f'Setting {attribute} to {image_info[attribute]}')
+                        logging.debug('Setting %s to %s', attribute, image_info[attribute])
                 case other:      
-                    setattr(self, attribute, image_info[attribute])
-                    logging.debug(f'Setting {attribute} to {image_info[attribute]}')
+                    value = image_info[attribute]
+                    setattr(self, attribute, list(value) if isinstance(value, list) else value)
+                    logging.debug('Setting %s to %s', attribute, image_info[attribute])
 
-        # Retrieve the list of categories the image belongs to.
-        logging.debug("Querying characteristics")
-        self.categories = im.IMatchAPI.get_file_categories([self.id], params={
-            'fields' : 'path,description'}
-            )[self.id]
+        self.categories = copy.deepcopy(record.categories)
         
-        # Retrieve relations for this image. If there is an image in the preferred upload format for the
+        # Use the relations for this image. If there is an image in the preferred upload format for the
         # image controller, use it
-        self.relations = im.IMatchAPI.get_relations(self.id)
+        self.relations = copy.deepcopy(record.relations)
         if self.relations is not None:
             for relation in self.relations:
                 if relation['format'] in self.controller.allowed_formats:
                     if self.format != self.controller.preferred_format:
                         # We are ok to replace the existing format. If it is already the preferred, we don't replace again
-                            logging.debug(f'Replacing {self.name} with {relation['name']}')
-                            logging.debug(f'Setting name to {relation['format']}')
+                            logging.debug('Replacing %s with %s', self.name, relation['name'])
+                            logging.debug('Setting name to %s', relation['format'])
                             self.name = relation['name']
-                            logging.debug(f'Setting filename to {relation['fileName']}')
+                            logging.debug('Setting filename to %s', relation['fileName'])
                             self.filename = relation['fileName']
-                            logging.debug(f'Setting format to {relation['format']}')
+                            logging.debug('Setting format to %s', relation['format'])
                             self.format = relation['format']
-                            logging.debug(f'Setting size to {relation['size']}')
+                            logging.debug('Setting size to %s', relation['size'])
                             self.size = relation['size']
 
     def _prepare_for_operations(self):
@@ -220,6 +286,20 @@ class IMatchImage():
     def isPublic(self) -> bool:
         return not self.isPrivate
     
+    # Fields holding the values of the tags copied into shared files (see exiftool_public_tag_args
+    # in utilities.py). Private images don't carry their location.
+    METADATA_FIELDS = ['date_time', 'title', 'description', 'copyright', 'copyrightmarked', 'copyrighturl',
+                       'country', 'state', 'city', 'make', 'model', 'lens', 'aperture', 'shutter_speed', 'focal_length', 'iso']
+    LOCATION_FIELDS = ['location', 'latitude', 'longitude', 'altitude']
+
+    @property
+    def metadata_digest(self) -> str:
+        """Digest of the values copied into shared files. If it matches the digest recorded for a
+        file, the file already carries this metadata."""
+        fields = IMatchImage.METADATA_FIELDS if self.isPrivate else IMatchImage.METADATA_FIELDS + IMatchImage.LOCATION_FIELDS
+        values = {field : getattr(self, field) for field in fields} | {'source' : self.filename, 'private' : self.isPrivate}
+        return hashlib.blake2b(json.dumps(values, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+
     @property
     def camera_info(self) -> str:
         """Standardise a basic way of presenting camera information on a single line"""
@@ -0,0 +1,124 @@
+import json
+import logging
+import os
+import sys
+import threading
+
+import config
+
+class Journal():
+    """Append-only record of the steps completed for each image during a run. If the run
+    is interrupted, --resume reads it back so finished copies, renders and uploads are
+    skipped rather than repeated. A run that completes removes it.
+
+    Entries are keyed by platform, step and key. The key is the image id for steps that
+    act on the image (uploaded, written back) and the output file for steps that create
+    files (copied, metadata, rendered)."""
+
+    FILENAME = "journal.jsonl"
+
+    COPIED = "copied"               # working copy of the original taken
+    METADATA = "metadata"           # metadata stripped and copied into an output file
+    UPLOADED = "uploaded"           # file sent to the platform. Holds the photo_id.
+    RENDERED = "rendered"           # image version created
+    WRITTEN_BACK = "written_back"   # attributes written back to IMatch
+
+    __done = {}         # (platform, step, key) -> data for completed steps
+    __file = None       # Open for appending while a run is in progress
+    __lock = threading.Lock()
+
+    @classmethod
+    def path(cls):
+        return os.path.join(config.STATE_PATH, cls.FILENAME)
+
+    @classmethod
+    def load(cls):
+        """Read the steps completed by the previous run"""
+        cls.__done = {}
+        try:
+            with open(cls.path(), 'r', encoding='utf-8') as file:
+                for line in file:
+                    if line.strip() == "":
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last line may be partial if the run died while writing it
+                        logging.warning(f"Journal: skipping unreadable entry in {cls.path()}")
+                        continue
+                    cls.__done[(entry['platform'], entry['step'], entry['key'])] = entry.get('data', {})
+        except FileNotFoundError:
+            pass
+        logging.debug("Journal: %s completed steps loaded", len(cls.__done))
+
+    @classmethod
+    def unfinished(cls):
+        """Did an earlier run stop before finishing, leaving its journal behind?"""
+        try:
+            return os.path.getsize(cls.path()) > 0
+        except FileNotFoundError:
+            return False
+
+    @classmethod
+    def start(cls, resume=False):
+        """Begin journalling a run. A run can't start afresh over the journal of an unfinished one, as
+        that would forget its uploads and so upload them again. Resume it instead."""
+        os.makedirs(config.STATE_PATH, exist_ok=True)
+        if not resume and cls.unfinished():
+            logging.error(f"Journal: an earlier run did not finish. Run again with --resume to complete it, or delete {cls.path()} to start afresh (anything it uploaded will be uploaded again).")
+            sys.exit(1)
+        if resume:
+            cls.load()
+            print(f"Journal: resuming, {len(cls.__done)} completed steps will be skipped")
+        else:
+            cls.__done = {}
+        cls.__file = open(cls.path(), 'a' if resume else 'w', encoding='utf-8')
+        if cls.__file.tell() > 0:
+            cls.__file.write("\n")   # Start clear of any partial line left by the interrupted run
+
+    @classmethod
+    def finish(cls):
+        """The run completed, so there is nothing to resume. Remove the journal."""
+        with cls.__lock:
+            if cls.__file is not None:
+                cls.__file.close()
+                cls.__file = None
+                os.remove(cls.path())
+
+    @classmethod
+    def record(cls, platform, step, key, **data):
+        """Note that a step is complete. Safe to call from worker threads. The entry is flushed, so it
+        survives the run being killed. sync() at the end of each stage makes it survive a power cut."""
+        key = str(key)
+        with cls.__lock:
+            cls.__done[(platform, step, key)] = data
+            if cls.__file is None:
+                return  # Not journalling, e.g. a plan
+            cls.__file.write(json.dumps({'platform' : platform, 'step' : step, 'key' : key, 'data' : data}) + "\n")
+            cls.__file.flush()
+
+    @classmethod
+    def sync(cls):
+        """Durably store everything recorded so far. Called at stage boundaries, as doing so for every
+        record costs more than the steps it protects."""
+        with cls.__lock:
+            if cls.__file is not None:
+                cls.__file.flush()
+                os.fsync(cls.__file.fileno())
+
+    @classmethod
+    def done(cls, platform, step, key):
+        """Has the step been completed?"""
+        return (platform, step, str(key)) in cls.__done
+
+    @classmethod
+    def get(cls, platform, step, key):
+        """Return the data recorded for a completed step, or None if it has not been completed"""
+        return cls.__done.get((platform, step, str(key)))
+
+    @classmethod
+    def entries(cls, platform, step):
+        """Return key -> data for every completed step of the kind"""
+        with cls.__lock:
+            return {key : data for (entry_platform, entry_step, key), data in cls.__done.items()
+                    if entry_platform == platform and entry_step == step}
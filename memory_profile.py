@@ -0,0 +1,101 @@
+import sys
+import tracemalloc
+
+from imatch_image import IMatchRecord
+
+## Opt-in memory profiling for large catalogues. Allocation snapshots are taken at the
+## stage boundaries in share_images.py. The report shows how memory grew between stages
+## and which lines of code hold it. It also estimates the bytes each image object
+## holds, by class and by attribute.
+
+CONTAINERS = (dict, list, set, frozenset, tuple)
+
+
+def deep_sizeof(obj, seen):
+    """Bytes held by obj and any containers and values within it. Other objects, such as
+    controllers and albums, are shared references and not counted."""
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(deep_sizeof(key, seen) + deep_sizeof(value, seen) for key, value in obj.items())
+    if isinstance(obj, CONTAINERS):
+        return sys.getsizeof(obj) + sum(deep_sizeof(item, seen) for item in obj)
+    if hasattr(obj, '__dict__'):
+        return 0
+    return sys.getsizeof(obj)
+
+
+def image_sizes(image):
+    """Bytes held by each attribute of the image"""
+    seen = {id(image)}
+    sizes = {'(object)' : sys.getsizeof(image) + sys.getsizeof(image.__dict__)}
+    for attribute, value in image.__dict__.items():
+        sizes[attribute] = deep_sizeof(value, seen)
+    return sizes
+
+
+class MemoryProfile():
+    """tracemalloc snapshots labelled by stage. report() compares each with the one before
+    to show what grew, then sizes the images the controllers hold."""
+
+    enabled = False
+    TOP = 10        # Allocators to list for each stage
+    FRAMES = 10     # Stack depth kept for each allocation
+    __snapshots = []
+
+    @classmethod
+    def start(cls):
+        tracemalloc.start(cls.FRAMES)
+        cls.__snapshots = []
+        cls.enabled = True
+
+    @classmethod
+    def snapshot(cls, label):
+        """Mark a stage boundary"""
+        if not cls.enabled:
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            ])
+        cls.__snapshots.append((label, snapshot, current, peak))
+
+    @classmethod
+    def report(cls, controllers):
+        """Print the growth at each stage boundary, and the memory held per image"""
+        if not cls.enabled:
+            return
+        print( "--------------------------------------------------------------------------------------")
+        print("Memory profile")
+        previous = None
+        for label, snapshot, current, peak in cls.__snapshots:
+            print(f"-- {label}: {current/1024/1024:.1f} MB traced, peak {peak/1024/1024:.1f} MB")
+            stats = snapshot.compare_to(previous, 'lineno') if previous is not None else snapshot.statistics('lineno')
+            for stat in stats[:cls.TOP]:
+                frame = stat.traceback[0]
+                growth = getattr(stat, 'size_diff', stat.size)
+                print(f"---- {growth/1024:>+10.1f} KB {stat.size/1024:>10.1f} KB  {frame.filename}:{frame.lineno}")
+            previous = snapshot
+
+        print("-- Memory held per image")
+        for controller in sorted(controllers, key=lambda x: x.name):
+            by_class = {}
+            for image in controller.images:
+                totals = by_class.setdefault(type(image).__name__, {'count' : 0, 'attributes' : {}})
+                totals['count'] += 1
+                for attribute, size in image_sizes(image).items():
+                    totals['attributes'][attribute] = totals['attributes'].get(attribute, 0) + size
+            for class_name, totals in sorted(by_class.items()):
+                total = sum(totals['attributes'].values())
+                print(f"---- {controller.name} {class_name}: {totals['count']} images, {total/1024/1024:.1f} MB, {total/totals['count']:.0f} bytes per image")
+                for attribute, size in sorted(totals['attributes'].items(), key=lambda x: -x[1])[:cls.TOP]:
+                    print(f"------ {attribute:<24} {size/totals['count']:>10.0f} bytes per image")
+
+        records = IMatchRecord.cached()
+        if len(records) > 0:
+            seen = set()
+            total = sum(deep_sizeof(record.__dict__, seen) for record in records)
+            print(f"---- IMatch records (waiting for other platforms): {len(records)} records, {total/1024/1024:.1f} MB, {total/len(records):.0f} bytes per record")
@@ -0,0 +1,146 @@
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+import config
+from tracing import Trace
+
+## Stage names and the unit of work each one counts
+STAGE_UNITS = {
+    "total" : "images",         # the whole run for the platform, wall clock
+    "gather" : "images",        # images read from IMatch
+    "classify" : "images",      # images sorted into add, update, delete and invalid
+    "copy" : "bytes",           # working copies of originals
+    "exiftool" : "files",       # metadata copied into an output file
+    "resize" : "renditions",    # image versions encoded
+    "upload" : "bytes",         # image data sent to the platform
+    "api" : "calls",            # platform api calls, other than uploads
+    "markdown" : "pages",       # pages written to the vault
+    "writeback" : "writes",     # attribute and category updates sent to IMatch
+    "finalise" : "albums",      # album maintenance and error reporting at the end of the run
+}
+
+
+def format_units(stage, units):
+    if STAGE_UNITS.get(stage) == "bytes":
+        return f"{units/config.MB_SIZE:.1f} MB"
+    return f"{units} {STAGE_UNITS.get(stage, 'units')}"
+
+
+def format_rate(stage, rate):
+    if STAGE_UNITS.get(stage) == "bytes":
+        return f"{rate/config.MB_SIZE:.2f} MB/s"
+    return f"{rate:.2f} {STAGE_UNITS.get(stage, 'units')}/s"
+
+
+class StageMetrics():
+    """Accumulates time spent, and work done, in each stage of a run. Safe to use from worker threads."""
+
+    def __init__(self) -> None:
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds, units=0):
+        with self._lock:
+            totals = self.stages.setdefault(stage, {"seconds" : 0.0, "units" : 0})
+            totals["seconds"] += seconds
+            totals["units"] += units
+
+    @contextmanager
+    def measure(self, stage, units=0):
+        """Time the enclosed block and record it, with units of work, against stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, units)
+
+
+class MeteredProxy():
+    """Wraps a platform api object so every call is timed into a StageMetrics. stage_for(name, args, kwargs)
+    returns the (stage, units) for a call, where name is the dotted path used, e.g. photos.setMeta."""
+
+    def __init__(self, target, metrics, stage_for, name="") -> None:
+        self._target = target
+        self._metrics = metrics
+        self._stage_for = stage_for
+        self._name = name
+
+    def __getattr__(self, attribute):
+        name = f"{self._name}.{attribute}" if self._name else attribute
+        return MeteredProxy(getattr(self._target, attribute), self._metrics, self._stage_for, name)
+
+    def __call__(self, *args, **kwargs):
+        stage, units = self._stage_for(self._name, args, kwargs)
+        with self._metrics.measure(stage, units), Trace.span(self._name, stage):
+            return self._target(*args, **kwargs)
+
+
+class RunHistory():
+    """Stage metrics from previous runs, one JSON record per platform per run. Streamed and staged runs
+    overlap their stages differently, so each run's mode is kept and only runs in the same mode compared."""
+
+    FILENAME = "run_history.jsonl"
+    RECENT_RUNS = 10    # Runs used when working out throughput
+    REGRESSION = 0.25   # Flag a stage running this much slower than its baseline
+    MIN_SECONDS = 1.0   # Stages quicker than this are too noisy to flag
+
+    @classmethod
+    def path(cls):
+        return os.path.join(config.STATE_PATH, cls.FILENAME)
+
+    @classmethod
+    def record(cls, platform, metrics, mode):
+        if len(metrics.stages) == 0:
+            return  # Nothing happened worth remembering
+        os.makedirs(config.STATE_PATH, exist_ok=True)
+        entry = {
+            "finished" : datetime.now().isoformat(timespec="seconds"),
+            "platform" : platform,
+            "mode" : mode,
+            "stages" : metrics.stages,
+        }
+        with open(cls.path(), 'a', encoding='utf-8') as file:
+            file.write(json.dumps(entry) + "\n")
+
+    @classmethod
+    def load(cls, platform, mode):
+        """Return the recorded runs for the platform in the mode, oldest first. Runs recorded before
+        the mode was kept count as staged."""
+        runs = []
+        try:
+            with open(cls.path(), 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        logging.warning(f"Skipping unreadable line in {cls.path()}")
+                        continue
+                    if entry.get("platform") == platform and entry.get("mode", "staged") == mode:
+                        runs.append(entry)
+        except FileNotFoundError:
+            pass
+        return runs
+
+    @classmethod
+    def rates(cls, platform, mode):
+        """Return units per second for each stage, pooled over the most recent runs in the mode that used it"""
+        totals = {}
+        for run in reversed(cls.load(platform, mode)):
+            for stage, values in run["stages"].items():
+                seconds, units, count = totals.get(stage, (0.0, 0, 0))
+                if count < cls.RECENT_RUNS:
+                    totals[stage] = (seconds + values["seconds"], units + values["units"], count + 1)
+
+        return {stage : units / seconds for stage, (seconds, units, count) in totals.items() if seconds > 0 and units > 0}
+
+    @classmethod
+    def regressed(cls, stage, values, baseline):
+        """Has the stage's throughput fallen well below the baseline rate?"""
+        if stage not in baseline or values["seconds"] < cls.MIN_SECONDS or values["units"] == 0:
+            return False
+        return values["units"] / values["seconds"] < baseline[stage] * (1 - cls.REGRESSION)
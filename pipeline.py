@@ -0,0 +1,191 @@
+import logging
+import queue
+import threading
+import time
+
+from imatch_image import IMatchImage
+from journal import Journal
+from tracing import Trace
+from utilities import print_clear, progress_bar
+
+## Streaming alternative to the staged run in share_images.py. Rather than
+## building every image before anything is classified or committed, images
+## flow through hydrate -> classify -> prepare -> commit stages joined by
+## bounded queues, so adds and updates start as soon as the first images
+## arrive from IMatch. Deletes still wait for the stream to drain as they
+## rely on a scan of the full vault.
+
+_DONE = object()    # Marks the end of the stream on a queue
+
+
+class PipelineAborted(Exception):
+    """Raised inside a stage when another stage has failed"""
+    pass
+
+
+class Pipeline():
+
+    def __init__(self, controller, build_image, hydrate_workers=4, queue_size=32, batch_size=16, batch_wait=2.0) -> None:
+        """
+        controller      -- platform controller the images belong to
+        build_image     -- callable(id, controller) returning a hydrated image
+        hydrate_workers -- threads reading images from IMatch
+        queue_size      -- maximum images waiting between any two stages
+        batch_size      -- maximum images handed to a prepare/commit step at once
+        batch_wait      -- seconds to wait for a batch to fill before sending it on
+        """
+        self.controller = controller
+        self.build_image = build_image
+        self.hydrate_workers = hydrate_workers
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+
+        self._abort = threading.Event()
+        self._errors = []
+
+    def run(self, image_ids):
+        """Stream image_ids through to the platform. Returns once every add and update is committed."""
+        ids = queue.Queue()
+        for image_id in image_ids:
+            ids.put(image_id)
+
+        hydrated = queue.Queue(maxsize=self.queue_size)
+        classified = queue.Queue(maxsize=self.queue_size)
+        prepared = queue.Queue(maxsize=self.queue_size)
+
+        pbar = progress_bar(total=len(image_ids), desc=f"{self.controller.name}: Streaming images from IMatch", position=self.controller.progress_position)
+
+        start = time.perf_counter()
+        hydrators = [self._start(self._hydrate, ids, hydrated, pbar) for _ in range(self.hydrate_workers)]
+        stages = [
+            self._start(self._classify, hydrated, classified),
+            self._start(self._prepare, classified, prepared),
+            self._start(self._commit, prepared),
+        ]
+
+        for thread in hydrators:
+            thread.join()
+        # Wall clock, as in a staged run. Summing each image's time would count every hydrator.
+        self.controller.metrics.add("gather", time.perf_counter() - start, len(image_ids))
+        try:
+            self._put(hydrated, _DONE)
+        except PipelineAborted:
+            pass  # A stage failed. The error is raised below once everything has stopped.
+        for thread in stages:
+            thread.join()
+        pbar.close()
+
+        if len(self._errors) > 0:
+            raise self._errors[0]
+
+        self.controller.print_classification()
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target=self._guard, args=(target, *args), daemon=True)
+        thread.start()
+        return thread
+
+    def _guard(self, target, *args):
+        """Run a stage, recording the first failure and telling every other stage to stop"""
+        try:
+            target(*args)
+        except PipelineAborted:
+            pass
+        except BaseException as ex:  # includes sys.exit() from deep within the controllers
+            logging.debug("%s: pipeline stage %s failed: %r", self.controller.name, target.__name__, ex)
+            self._errors.append(ex)
+            self._abort.set()
+
+    def _put(self, q, item):
+        while True:
+            if self._abort.is_set():
+                raise PipelineAborted()
+            try:
+                q.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    def _get(self, q, timeout=None):
+        """Take the next item, blocking until one arrives (or timeout passes, raising queue.Empty)"""
+        waited = 0.0
+        while True:
+            if self._abort.is_set():
+                raise PipelineAborted()
+            try:
+                return q.get(timeout=0.5)
+            except queue.Empty:
+                waited += 0.5
+                if timeout is not None and waited >= timeout:
+                    raise
+
+    def _next_batch(self, q):
+        """Collect up to batch_size items. Returns (batch, finished) where finished means the stream has ended."""
+        batch = []
+        item = self._get(q)
+        if item is _DONE:
+            return batch, True
+        batch.append(item)
+        while len(batch) < self.batch_size:
+            try:
+                item = self._get(q, timeout=self.batch_wait)
+            except queue.Empty:
+                break
+            if item is _DONE:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _hydrate(self, ids, hydrated, pbar):
+        while not self._abort.is_set():
+            try:
+                image_id = ids.get_nowait()
+            except queue.Empty:
+                return
+            with Trace.context(image=image_id, platform=self.controller.name):
+                image = self.build_image(image_id, self.controller)
+            pbar.update()
+            self._put(hydrated, image)
+
+    def _classify(self, hydrated, classified):
+        while True:
+            image = self._get(hydrated)
+            if image is _DONE:
+                self._put(classified, _DONE)
+                return
+            with self.controller.metrics.measure("classify", 1):
+                self.controller.classify_image(image)
+            if image.operation in [IMatchImage.OP_ADD, IMatchImage.OP_UPDATE, IMatchImage.OP_METADATA]:
+                self._put(classified, image)
+
+    def _prepare(self, classified, prepared):
+        finished = False
+        while not finished:
+            batch, finished = self._next_batch(classified)
+            adds, updates = self._split(batch)
+            if len(adds) > 0:
+                self.controller.prepare_add(adds)
+            if len(updates) > 0:
+                self.controller.prepare_update(updates)
+            for image in batch:
+                self._put(prepared, image)
+        self._put(prepared, _DONE)
+
+    def _commit(self, prepared):
+        finished = False
+        while not finished:
+            batch, finished = self._next_batch(prepared)
+            adds, updates = self._split(batch)
+            if len(adds) > 0:
+                self.controller.complete_add(adds)
+            if len(updates) > 0:
+                self.controller.complete_update(updates)
+            Journal.sync()
+            if len(batch) > 0:
+                print_clear(f"{self.controller.name}: Committed {len(adds)} adds and {len(updates)} updates")
+
+    def _split(self, batch):
+        adds = {image for image in batch if image.operation == IMatchImage.OP_ADD}
+        updates = {image for image in batch if image.operation in [IMatchImage.OP_UPDATE, IMatchImage.OP_METADATA]}
+        return adds, updates
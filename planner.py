@@ -0,0 +1,51 @@
+from datetime import timedelta
+
+from metrics import RunHistory, format_units
+
+## Stages carried out inside the controller's commit workers. Their recorded
+## time is per worker, so the estimate is shared across commit_workers.
+WORKER_STAGES = ["upload", "api", "markdown", "writeback"]
+
+
+def estimate(controller, work, rates):
+    """Return the estimated seconds for each stage of work, or None where no previous run measured the stage"""
+    estimates = {}
+    for stage, units in work.items():
+        if units == 0:
+            estimates[stage] = 0.0
+        elif stage not in rates:
+            estimates[stage] = None
+        else:
+            seconds = units / rates[stage]
+            if stage in WORKER_STAGES:
+                seconds /= controller.commit_workers
+            estimates[stage] = seconds
+    return estimates
+
+
+def report(controller):
+    """Print what a run would do for the classified images, and roughly how long it would take.
+    Nothing is changed on the platform, in IMatch or on disk."""
+    work = controller.plan_work()
+    estimates = estimate(controller, work, RunHistory.rates(controller.name, controller.run_mode))
+
+    stats = controller.stats
+    print( "--------------------------------------------------------------------------------------")
+    print(f"{controller.name}: Plan")
+    print(f"-- {stats['added']} add, {stats['updated']} update, {stats['deleted']} delete, {stats['invalid']} invalid, {stats['untouched']} untouched")
+    for image in sorted(controller.invalid_images, key=lambda x: x.name):
+        print(f"---- invalid {image.name}: {', '.join(image.errors)}")
+
+    total = 0.0
+    unmeasured = []
+    for stage, units in work.items():
+        if units == 0:
+            continue
+        if estimates[stage] is None:
+            unmeasured.append(stage)
+            print(f"-- {stage:<10} {format_units(stage, units):>16}   (no previous runs to estimate from)")
+        else:
+            total += estimates[stage]
+            print(f"-- {stage:<10} {format_units(stage, units):>16}   ~{timedelta(seconds=round(estimates[stage]))}")
+
+    print(f"-- Estimated time ~{timedelta(seconds=round(total))}" + (f" plus {', '.join(unmeasured)}" if len(unmeasured) > 0 else ""))
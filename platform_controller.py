@@ -1,14 +1,23 @@
+from concurrent.futures import ThreadPoolExecutor
 import logging
-from tqdm import tqdm
+import sys
+import threading
 
 import IMatchAPI as im
 from imatch_image import IMatchImage
 import config
 from album import Album
-from utilities import print_clear
+from events import Events
+from metrics import RunHistory, StageMetrics, format_rate, format_units
+from tracing import Trace
+from utilities import ExifToolPool, print_clear, progress_bar
 
 class PlatformController():
 
+    # Number of commits the platform can safely have in flight at once. Subclasses
+    # raise this to suit their platform.
+    commit_workers = 1
+
     def __init__(self, platform_name, album_cls, preferred_format, allowed_formats) -> None:
         self.name = platform_name
         self.preferred_format = preferred_format
@@ -23,6 +32,12 @@ class PlatformController():
         self.api = None  # Holds the platform api connection once active
         self.locations = config.locations
         self.albums = album_cls.load()
+        self.lock = threading.Lock()  # Guards shared state while commits run concurrently
+        self.progress_position = None  # Line for this controller's progress bars when controllers run side by side
+        self.metrics = StageMetrics()  # Time and work per stage, kept in the run history to estimate future runs
+        self.run_mode = "staged"    # or "stream". Runs are only compared with others in the same mode.
+        self.vault_writes = {'written' : 0, 'unchanged' : 0}  # Vault files this run, see count_write()
+        self.exiftool = ExifToolPool()  # Sessions kept for the whole run and closed in finalise()
 
     def __repr__(self):
         return f'{self.name} with {len(self.images)} and {len(self.albums)}.'
@@ -31,27 +46,37 @@ class PlatformController():
         """Upload and add image to platform"""
         raise NotImplementedError("Subclasses must implement this for their specific platform.")
 
+    def begin_run(self):
+        """Called once the journal is open, before any images are gathered. Nothing is needed by default."""
+        pass
+
     def register_image(self, image):
         """Register image to the list of controller's images, and connect to image"""
         image.controller = self
-        self.images.add(image)
+        with self.lock:
+            self.images.add(image)
      
-    def add_images(self):
-        """Upload and add image to platform"""
-        if len(self.images_to_add) == 0:
+    def add_images(self, images=None):
+        """Upload and add images to platform. Defaults to every image classified for adding."""
+        images = self.images_to_add if images is None else images
+        if len(images) == 0:
             return  # Nothing to see here
-        
+
+        self.prepare_add(images)
+        self.complete_add(images)
+
+    def prepare_add(self, images):
+        """Get images ready to be added, e.g. take working copies. Nothing is needed by default."""
+        pass
+
+    def complete_add(self, images):
+        """Commit prepared images to the platform"""
         self.connect()
+        self.run_commits(images, self.commit_add, "Adding")
 
-        for image in (pbar := tqdm(self.images_to_add, bar_format=config.bar_format)):
-            pbar.set_description(f'{self.name}: Adding {image.name}')
-        
-            self.commit_add(image)
-        
-    def classify_images(self):
-        count = 0
-        for image in self.images:
-            print( f'{self.name}: Classifying images [{count:3.0f} of {len(self.images)}]', end='\r')
+    def classify_image(self, image):
+        """Place a single image in the set matching its operation and add it to its albums"""
+        with self.lock:
             match image.operation:
                 case IMatchImage.OP_ADD:
                     self.images_to_add.add(image)
@@ -65,9 +90,36 @@ class PlatformController():
                     self.invalid_images.add(image)
                 case other:
                     pass
-            count += 1
+
+        if image.operation != IMatchImage.OP_INVALID:
+            for category in image.categories:
+                splits = category['path'].split("|")
+                match splits[0]:
+                    case "Socials":
+                        if splits[1] == "albums":
+                            try:
+                                name = splits[2]
+                                try:
+                                    self.albums[name].add(image)
+                                    logging.debug('%s: Adding image to album %s', self.name, name)
+                                except KeyError:
+                                    logging.error(f'{self.name}: Missing album configuration for "{name}". Check secrets.json')
+                                    sys.exit(1)
+                            except IndexError:
+                                pass #no albums found
+
+    def classify_images(self):
+        count = 0
+        with self.metrics.measure("classify", len(self.images)):
+            for image in self.images:
+                print_clear( f'{self.name}: Classifying images [{count:3.0f} of {len(self.images)}]', end='\r')
+                self.classify_image(image)
+                count += 1
         
-        print_clear( f'{self.name}: {count} images classified (add: {len(self.images_to_add)}, update: {len(self.images_to_update)}, delete: {len(self.images_to_delete)}, invalid: {len(self.invalid_images)})')
+        self.print_classification()
+
+    def print_classification(self):
+        print_clear( f'{self.name}: {len(self.images)} images classified (add: {len(self.images_to_add)}, update: {len(self.images_to_update)}, delete: {len(self.images_to_delete)}, invalid: {len(self.invalid_images)})')
 
 
     def commit_add(self, image):
@@ -91,28 +143,58 @@ class PlatformController():
         self.connect()
 
         deleted_images = set()
-        for image in (pbar := tqdm(self.images_to_delete, bar_format=config.bar_format)):
-            pbar.set_description(f'{self.name}: Delete {image.name}')
-            
-            if self.commit_delete(image):
+        for image, deleted in self.run_commits(self.images_to_delete, self.commit_delete, "Delete"):
+            if deleted:
                 deleted_images.add(image.id)
 
         if len(deleted_images) > 0:
             # Unassign all deleted images from the deleted category. Those that were not deleted remain.
-            im.IMatchAPI.unassign_category(
-                im.IMatchUtility.build_category([
-                    config.ROOT_CATEGORY,
-                    self.name,
-                    config.DELETE_CATEGORY
-                    ]), 
-                list(deleted_images)
-                )
-            im.IMatchAPI.delete_attributes(self.name,list(deleted_images))
+            with self.metrics.measure("writeback", 2):
+                im.IMatchAPI.unassign_category(
+                    im.IMatchUtility.build_category([
+                        config.ROOT_CATEGORY,
+                        self.name,
+                        config.DELETE_CATEGORY
+                        ]), 
+                    list(deleted_images)
+                    )
+                im.IMatchAPI.delete_attributes(self.name,list(deleted_images))
 
         if len(deleted_images) != len(self.images_to_delete):
             print_clear(f"{self.name}: Some images not deleted due to presence of faves or comments. Please check '{config.ERROR_CATEGORY}' category")
 
 
+    def mark_invalid(self, image, error):
+        """Record an error against the image and move it to the invalid list. Safe to call from commit workers."""
+        with self.lock:
+            image.errors.append(error)
+            self.invalid_images.add(image)
+
+    def run_commits(self, images, commit, description):
+        """Call commit for every image using up to commit_workers threads. Progress is reported, and
+        results returned, in a stable name order as (image, result) pairs. An error in any commit
+        (including sys.exit) cancels the outstanding work and is raised in the calling thread."""
+        ordered = sorted(images, key=lambda x: x.name)
+        results = []
+        with ThreadPoolExecutor(max_workers=self.commit_workers, thread_name_prefix=self.name) as executor:
+            futures = [executor.submit(Trace.traced(commit, image.id, self.name), image) for image in ordered]
+            try:
+                for image, future in (pbar := progress_bar(zip(ordered, futures), total=len(futures), position=self.progress_position)):
+                    pbar.set_description(f'{self.name}: {description} {image.name}')
+                    results.append((image, future.result()))
+                    Events.emit("image", platform=self.name, id=image.id, name=image.name, action=description,
+                                result="invalid" if image in self.invalid_images else "ok", errors=image.errors)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        return results
+
+    def count_write(self, written):
+        """Count a vault file as written or left unchanged, for the summary. Safe to call from commit workers."""
+        with self.lock:
+            self.vault_writes['written' if written else 'unchanged'] += 1
+
     def get_album(self, name):
         try:
             return self.albums[name]
@@ -143,6 +225,7 @@ class PlatformController():
                         , image.id)
 
     def finalise(self):
+        self.exiftool.shutdown()
         self.process_errors()
 
     def summarise(self):
@@ -152,19 +235,49 @@ class PlatformController():
         print(f"{self.name}: Summary of images processed")
         for val in stats.keys():
             print(f"-- {stats[val]} {val} images")
+        if sum(self.vault_writes.values()) > 0:
+            print(f"-- {self.vault_writes['written']} vault files written, {self.vault_writes['unchanged']} unchanged")
+        self.print_stage_timings()
 
-    def update_images(self):
-        """Update images already on the platform"""
-        if len(self.images_to_update) == 0:
+    def print_stage_timings(self):
+        """Output time and throughput for each stage, flagging any that are well down on recent runs"""
+        if len(self.metrics.stages) == 0:
+            return
+        baseline = RunHistory.rates(self.name, self.run_mode)
+        print(f"{self.name}: Stage timings")
+        for stage, values in self.metrics.stages.items():
+            line = f"-- {stage:<10} {format_units(stage, values['units']):>16} {values['seconds']:>9.1f}s"
+            if values['seconds'] > 0 and values['units'] > 0:
+                line += f" {format_rate(stage, values['units'] / values['seconds']):>18}"
+                if stage in baseline:
+                    line += f"   (baseline {format_rate(stage, baseline[stage])})"
+            if RunHistory.regressed(stage, values, baseline):
+                line += "   ** SLOWER THAN USUAL **"
+            print(line)
+
+    def update_images(self, images=None):
+        """Update images already on the platform. Defaults to every image classified for updating."""
+        images = self.images_to_update if images is None else images
+        if len(images) == 0:
             return  # Nothing to see here
-        
+
+        self.prepare_update(images)
+        self.complete_update(images)
+
+    def prepare_update(self, images):
+        """Get images ready to be updated, e.g. take working copies. Nothing is needed by default."""
+        pass
+
+    def complete_update(self, images):
+        """Commit prepared updates to the platform"""
         self.connect()
-        
-        for image in (pbar := tqdm(self.images_to_update, bar_format=config.bar_format)):
-            pbar.set_description(f'{self.name}: Update {image.name}')
+        self.run_commits(images, self._update_image, "Update")
 
-            self.commit_update(image)
+    def _update_image(self, image):
+        """Commit a single update and clear the IMatch category that requested it"""
+        self.commit_update(image)
 
+        with self.metrics.measure("writeback", 1):
             if image.operation == IMatchImage.OP_UPDATE:
                 im.IMatchAPI.unassign_category(
                     im.IMatchUtility.build_category([
@@ -183,8 +296,13 @@ class PlatformController():
                         config.UPDATE_METADATA_CATEGORY
                         ]), 
                     image.id
-                    )     
-        
+                    )
+
+    def plan_work(self):
+        """Return the work, by metrics stage, that committing the classified images would take.
+        Must not change anything on the platform, in IMatch or on disk."""
+        raise NotImplementedError("Subclasses must implement this for their specific platform.")
+
     @property
     def stats(self):
         return {
@@ -1,21 +1,25 @@
-from concurrent.futures import ProcessPoolExecutor
 import datetime
+import hashlib
 import html
+import json
 import logging
 import os
+import re
 from pprint import pprint
-import random
 import sys
 
-from PIL import Image
+from PIL import features
 
 from imatch_image import IMatchImage
 from platform_controller import PlatformController
 from album import Album
 import IMatchAPI as im
 import config
+from journal import Journal
 import scan_files
-from utilities import set_metadata
+from renditions import FORMATS, RenditionManifest, RenditionPool
+from tracing import Trace
+from utilities import MetadataDigests, set_metadata, vault_lock, write_if_changed
 
 SCALING_FACTORS = [
     { "size" : 100, "suffix" : "_t", "format" : "WEBP" },
@@ -28,21 +32,26 @@ SCALING_FACTORS = [
     { "size" : 1600, "suffix" : "_h", "format" : "WEBP" },
 ]
 
-def create_image_version(input_file, output_file, long_edge, format, quality=85):
-    """Create image from original as specified"""
-    logging.debug(f"Creating image: {output_file}")
-    with Image.open(input_file) as img:
-        width, height = img.size
-        if max(width,height) > long_edge:
-            scaling_factor = int(long_edge) / max(width, height)
-            new_size = (int(width * scaling_factor), int(height * scaling_factor))
-            img = img.resize(new_size, Image.LANCZOS)
-        img.save(output_file, format=format, quality=quality)
-
-
-def prepare_image_versions(args):
-    return create_image_version(*args)
+def rendition_profiles():
+    """SCALING_FACTORS with the encoder profile for each size (see renditions.py). An optional
+    "rendition_profiles" setting in the quantum section of secrets.json overrides them, by long
+    edge or "default" for every size, e.g.
+    { "default" : { "options" : { "method" : 6 } }, "1600" : { "format" : "AVIF", "quality" : 60, "budget" : 150000 } }"""
+    configured = config.quantum_secrets.get('rendition_profiles', {})
+    profiles = []
+    for scale in SCALING_FACTORS:
+        profile = ({'format' : scale['format']} | configured.get('default', {}) | configured.get(str(scale['size']), {})
+                   | {'size' : scale['size'], 'suffix' : scale['suffix']})
+        profile['format'] = profile['format'].upper()
+        if profile['format'] not in FORMATS or not features.check(FORMATS[profile['format']]):
+            logging.error(f'Rendition format "{profile['format']}" for size {scale['size']} is not supported. Use one of {", ".join(FORMATS)} that PIL was built with.')
+            sys.exit(1)
+        profiles.append(profile)
+    return profiles
 
+def media_extensions(profiles):
+    """Extensions of the versions notes in the vault may embed: the default formats and those of the profiles"""
+    return sorted({FORMATS[scale['format']] for scale in SCALING_FACTORS + profiles})
 
 class QuantumImage(IMatchImage):
         
@@ -97,8 +106,8 @@ class QuantumImage(IMatchImage):
             self.description = ""
         
         self.target_md = f'{self.media_id}.md'
-        logging.debug(f'media_id: {self.media_id}')
-        logging.debug(f'target_md: {self.target_md}')
+        logging.debug('media_id: %s', self.media_id)
+        logging.debug('target_md: %s', self.target_md)
         
     @property
     def is_valid(self) -> bool:
@@ -125,7 +134,7 @@ class QuantumImage(IMatchImage):
         return self.filename_for_size("m")
     
     def filename_for_size(self, size: str) -> str:
-        return f'{self.media_id}_{size.lower()}.webp'
+        return os.path.basename(self.controller.version_file(self.media_id, self.controller.profile(f'_{size.lower()}')))
     
     
     def create_photo_markdown(self):
@@ -229,12 +238,14 @@ class QuantumImage(IMatchImage):
             sys.exit(1)
  
         output_file = self.controller.build_photo_path(self.target_md)
-        with open(output_file, 'w', encoding='utf-8') as file:
-            file.write(filtered_markdown)
+        with vault_lock:
+            written = write_if_changed(output_file, filtered_markdown)
+        self.controller.count_write(written)
 
 
 class QuantumController(PlatformController):
 
+    commit_workers = 8  # Commits write markdown to local disk and attributes to IMatch
     _MAX_SIZE = 25 * config.MB_SIZE
     _PHOTOS_PATH = "photos"
     _ALBUMS_PATH = "albums"
@@ -248,56 +259,27 @@ class QuantumController(PlatformController):
             QuantumController._ALBUM_TEMPLATE : None,
             QuantumController._CARD_TEMPLATE : None,
         }
-        logging.debug(f'{self.name}: Instance initialised.')
-
-
-    def add_images(self):
-        ## This might be backward. The super call creates the markdown, then the
-        ## image files are processed and added
-        super().add_images()
-
-        scaling_tasks = []
-        exiftool_tasks = []
-        # Bulk process creation of image version files
-        for image in self.images_to_add:
-            for scale in SCALING_FACTORS:
-                output_file = self.build_photo_path(f'{image.media_id}{scale['suffix']}.{scale['format'].lower()}')
-                scaling_tasks.append((image.filename, output_file, scale['size'], scale['format']))
-                exiftool_tasks.append((image.filename, output_file, image.isPrivate))
-
-        if (len(scaling_tasks) > 0):
-            print(f'{self.name}: Generating image versions (adds)')
-            with ProcessPoolExecutor() as executor:
-                executor.map(prepare_image_versions, scaling_tasks)
-
-            set_metadata(exiftool_tasks)
+        # Kept for the whole run. Optional "rendition_backend" ("process" or "thread") and
+        # "rendition_workers" settings in the quantum section of secrets.json tune it.
+        self.renditions = RenditionPool(
+            backend=config.quantum_secrets.get('rendition_backend', 'process'),
+            workers=config.quantum_secrets.get('rendition_workers')
+            )
+        # With "embed_metadata" the encoder writes the metadata into each new version, saving an
+        # exiftool pass and a second write of the file. Versions kept as they are still use exiftool.
+        self.embed_metadata = config.quantum_secrets.get('embed_metadata', False)
+        self.profiles = rendition_profiles()
+        self.reference_index = None     # Photo references in the vault, once embedded_in_vault() needs them
+        logging.debug('%s: Instance initialised.', self.name)
+
+
+    def complete_add(self, images):
+        # Versions first, so the pages written by the commits link to the files as they now are
+        self.generate_versions(images, "adds")
+
+        super().complete_add(images)
             
     
-    def classify_images(self):
-        super().classify_images()
-        for image in self.images:
-            if image.operation != IMatchImage.OP_INVALID:
-                for category in image.categories:
-                    splits = category['path'].split("|")
-                    match splits[0]:
-                        case "Socials":
-                            if splits[1] == "albums":
-                                try:
-                                    name = splits[2]
-                                    try:
-                                        self.albums[name].add(image)
-                                        logging.debug(f'{self.name}: Adding image to album {name}')
-                                    except KeyError:
-                                        logging.error(f'{self.name}: Missing album configuration for "{name}". Check secrets.json')
-                                        sys.exit(1)
-                                except IndexError:
-                                    pass #no albums found
-
-        if len(self.images_to_delete) > 0:
-            pattern = r"\d{6}_[cmntz]\.webp"
-            self.image_references = scan_files.scan_folder_with_subfolders(config.quantum_secrets['path'], pattern, {"photos", "albums", ".obsidian"})
-
-
     def connect(self):
         try:
             if self.api is not None:
@@ -309,7 +291,7 @@ class QuantumController(PlatformController):
                     QuantumController._ALBUMS_PATH : os.path.join(quantum_path, QuantumController._ALBUMS_PATH)
                 }
 
-                logging.debug(f"checking for {self.api[QuantumController._PHOTOS_PATH]}.")
+                logging.debug("checking for %s.", self.api[QuantumController._PHOTOS_PATH])
                 if not(os.path.exists(self.api[QuantumController._PHOTOS_PATH]) and os.path.isdir(self.api[QuantumController._PHOTOS_PATH])):
                     logging.error(f'Connection error: {self.api[QuantumController._PHOTOS_PATH]} not found.')
                     sys.exit(1)
@@ -343,6 +325,7 @@ class QuantumController(PlatformController):
 
 
     def finalise(self):
+        self.renditions.shutdown()
         self.generate_albums()
         super().finalise()       
 
@@ -355,18 +338,51 @@ class QuantumController(PlatformController):
         return os.path.join(self.api[QuantumController._PHOTOS_PATH], path)
 
 
+    def profile(self, suffix):
+        """The rendition profile of the version with the suffix"""
+        for profile in self.profiles:
+            if profile['suffix'] == suffix:
+                return profile
+        raise KeyError(f"No rendition with suffix '{suffix}'")
+
+
+    def output_file(self, media_id, profile):
+        return self.build_photo_path(f'{media_id}{profile['suffix']}.{FORMATS[profile['format']]}')
+
+
+    def version_file(self, media_id, profile):
+        """The version as it is on disk. Until it is rendered in the profile's format, for instance
+        just after the format was changed, that is the file written under the format before."""
+        output_file = self.output_file(media_id, profile)
+        if not os.path.exists(output_file):
+            for other_file in self.other_formats(media_id, profile):
+                if os.path.exists(other_file):
+                    return other_file
+        return output_file
+
+
+    def other_formats(self, media_id, profile):
+        """Files the version may have been written as under another format"""
+        return [self.build_photo_path(f'{media_id}{profile['suffix']}.{extension}')
+                for format, extension in FORMATS.items() if format != profile['format']]
+
+
     def commit_add(self, image):
         """Make the api call to commit the image to the platform, and update IMatch with reference details"""
         try:
            
-            image.create_photo_markdown()
+            with self.metrics.measure("markdown", 1):
+                image.create_photo_markdown()
             
             # Update the image in IMatch by adding the attributes below.
-            im.IMatchAPI().set_attributes(self.name, image.id, data = {
-                'posted' : datetime.datetime.now().isoformat()[:10],
-                'media_id' : image.media_id,
-                'url' : f'https://quantumgardener.info/photos/{image.media_id}'
-                })
+            if not Journal.done(self.name, Journal.WRITTEN_BACK, image.id):  # Unless an interrupted run already did
+                with self.metrics.measure("writeback", 1):
+                    im.IMatchAPI().set_attributes(self.name, image.id, data = {
+                        'posted' : datetime.datetime.now().isoformat()[:10],
+                        'media_id' : image.media_id,
+                        'url' : f'https://quantumgardener.info/photos/{image.media_id}'
+                        })
+                Journal.record(self.name, Journal.WRITTEN_BACK, image.id)
         except KeyError:
             logging.error(f"{self.name}: Missed validating an image field somewhere.")
             sys.exit()
@@ -382,10 +398,11 @@ class QuantumController(PlatformController):
         try:
 
             # Delete all existing files
-            for scale in SCALING_FACTORS:
-                output_file = self.build_photo_path(f'{image.media_id}{scale['suffix']}.{scale['format'].lower()}')
-                if os.path.exists(output_file):
-                    os.remove(output_file)
+            for profile in self.profiles:
+                for output_file in [self.output_file(image.media_id, profile)] + self.other_formats(image.media_id, profile):
+                    if os.path.exists(output_file):
+                        os.remove(output_file)
+            RenditionManifest.delete(image.media_id)
 
             md_path = self.build_photo_path(image.target_md)
             if os.path.exists(md_path):
@@ -399,14 +416,18 @@ class QuantumController(PlatformController):
     def commit_update(self, image):
         """Make the api call to update the image on the platform"""
         try:
-            image.create_photo_markdown()           
+            with self.metrics.measure("markdown", 1):
+                image.create_photo_markdown()           
 
             # Update the image in IMatch by adding the attributes below.
-            im.IMatchAPI().set_attributes(self.name, image.id, data = {
-                'posted' : datetime.datetime.now().isoformat()[:10],
-                'media_id' : image.media_id,
-                'url' : f'https://quantumgardener.info/photos/{image.media_id}'
-                })
+            if not Journal.done(self.name, Journal.WRITTEN_BACK, image.id):  # Unless an interrupted run already did
+                with self.metrics.measure("writeback", 1):
+                    im.IMatchAPI().set_attributes(self.name, image.id, data = {
+                        'posted' : datetime.datetime.now().isoformat()[:10],
+                        'media_id' : image.media_id,
+                        'url' : f'https://quantumgardener.info/photos/{image.media_id}'
+                        })
+                Journal.record(self.name, Journal.WRITTEN_BACK, image.id)
         except KeyError:
             logging.error(f"{self.name}: validating an image field somewhere.")
             sys.exit()
@@ -418,98 +439,284 @@ class QuantumController(PlatformController):
 
 
     def delete_images(self):
+        self.check_references()
+        super().delete_images()
+
+
+    def check_references(self):
+        """Images still referenced from notes in the vault must not be deleted. Mark them invalid instead."""
         if len(self.images_to_delete) == 0:
             return  # Nothing to see here
 
+        index = scan_files.vault_reference_index(media_extensions(self.profiles))
+        index.update()
+        self.image_references = index.references()
+
         for image in self.images_to_delete.copy():
             if image.media_id in self.image_references.keys():
                 self.images_to_delete.remove(image)
                 print(f'{self.name}: Image in use "{image.title}" ({image.media_id})')
-                image.errors.append("referenced file")
-                self.invalid_images.add(image)
+                self.mark_invalid(image, "referenced file")
                 for referenced_image in self.image_references[image.media_id]:
                     print(f"--{referenced_image[0]}")
 
-        super().delete_images()
 
+    def embedded_in_vault(self, file_path):
+        """Notes in the vault that embed the version by its file name, or None if names like it are not
+        indexed and so it cannot be told. The index finds the notes that reference the media_id at all."""
+        name = os.path.basename(file_path)
+        pattern, _ = scan_files.media_pattern(media_extensions(self.profiles))
+        if re.fullmatch(pattern, name) is None:
+            return None
+        if self.reference_index is None:
+            self.reference_index = scan_files.vault_reference_index(media_extensions(self.profiles))
+            self.reference_index.update()
+        notes = set()
+        for note, _ in self.reference_index.lookup(name[:6]):
+            try:
+                with open(note, 'r', encoding='utf-8', errors='ignore') as file:
+                    if name in file.read():
+                        notes.add(note)
+            except OSError:
+                notes.add(note)     # Can't tell, so assume it does
+        return sorted(notes)
+
+
+    def complete_update(self, images):
+        # Versions first. A size whose format changed then has its new file for the page to link to.
+        self.generate_versions(images, "updates")
+
+        super().complete_update(images)
 
-    def update_images(self):
-        super().update_images()
 
+    def rendition_tasks(self, image):
+        """Return the (scaling, exiftool) tasks that bring the image's versions up to date. Scaling tasks
+        are (original, output_file, profile, current) where current means the output exists and was
+        made with the same profile, so it can be kept if the pixels turn out to be unchanged."""
         scaling_tasks = []
         exiftool_tasks = []
-        # Bulk process creation of image version files
-        for image in self.images_to_update:
-            # To reduce sync load into Obsidian, only create image files
-            # if they are missing or older than original.
-            for scale in SCALING_FACTORS:
-                output_file = self.build_photo_path(f'{image.media_id}{scale['suffix']}.{scale['format'].lower()}')
-                if os.path.exists(output_file) and image.operation == IMatchImage.OP_METADATA:
-                    # Check file modified dates. Metadata writes will update and that's desired.
-                    original_date = os.path.getmtime(image.filename)
-                    output_date = os.path.getmtime(output_file)
-                    if original_date > output_date:
-                        logging.debug(f"{self.name}: Image file metadata changed. Regenerating {output_file}")
-                        scaling_tasks.append((image.filename, output_file, scale['size'], scale['format']))
-                        exiftool_tasks.append((image.filename, output_file, image.isPrivate))
-                else:
-                    # File for this scale does not exist or forced update
-                    scaling_tasks.append((image.filename, output_file, scale['size'], scale['format']))
+        metadata_digest = image.metadata_digest
+        manifest = RenditionManifest.load(image.media_id)
+        unchanged_source = manifest is not None and manifest['source'] == RenditionManifest.source(image.filename)
+        for profile in self.profiles:
+            output_file = self.output_file(image.media_id, profile)
+            current = (os.path.exists(output_file) and manifest is not None
+                       and manifest['versions'].get(os.path.basename(output_file)) == RenditionManifest.settings(profile))
+            if os.path.exists(output_file) and Journal.done(self.name, Journal.RENDERED, output_file):
+                # Rendered by an interrupted run. It may still be waiting for its metadata.
+                if not Journal.done(self.name, Journal.METADATA, output_file):
+                    exiftool_tasks.append((image.filename, output_file, image.isPrivate))
+            elif image.operation == IMatchImage.OP_METADATA and current and unchanged_source:
+                # Original untouched since the version was made. Only the metadata needs writing,
+                # and not even that if the tags it carries are unchanged.
+                if not MetadataDigests.current(self.name, output_file, metadata_digest):
+                    exiftool_tasks.append((image.filename, output_file, image.isPrivate))
+            elif image.operation == IMatchImage.OP_METADATA and manifest is None and os.path.exists(output_file):
+                # Made before manifests were kept. To reduce sync load into Obsidian, only recreate
+                # image files if they are older than original. Metadata writes will update and that's desired.
+                original_date = os.path.getmtime(image.filename)
+                output_date = os.path.getmtime(output_file)
+                if original_date > output_date:
+                    logging.debug("%s: Image file metadata changed. Regenerating %s", self.name, output_file)
+                    scaling_tasks.append((image.filename, output_file, profile, False))
+                    exiftool_tasks.append((image.filename, output_file, image.isPrivate))
+                elif not MetadataDigests.current(self.name, output_file, metadata_digest):
                     exiftool_tasks.append((image.filename, output_file, image.isPrivate))
+            else:
+                # File for this scale does not exist, settings changed or forced add/update. For metadata
+                # changes an existing version is only re-encoded if the pixels differ from last time.
+                scaling_tasks.append((image.filename, output_file, profile, current and image.operation == IMatchImage.OP_METADATA))
+                exiftool_tasks.append((image.filename, output_file, image.isPrivate))
+        return scaling_tasks, exiftool_tasks
+
+
+    def generate_versions(self, images, description):
+        """Bulk process creation of image version files"""
+        scaling_tasks = []
+        exiftool_tasks = []
+        image_for_original = {}
+        rendered = set()
+        for image in images:
+            image_scaling_tasks, image_exiftool_tasks = self.rendition_tasks(image)
+            scaling_tasks.extend(image_scaling_tasks)
+            exiftool_tasks.extend(image_exiftool_tasks)
+            image_for_original[image.filename] = image
 
         if (len(scaling_tasks) > 0):
-            print(f'{self.name}: Generating image versions (updates)')
-            with ProcessPoolExecutor() as executor:
-                executor.map(prepare_image_versions, scaling_tasks)
+            # One task per original, so it is decoded once for all of its versions
+            versions = {}
+            for input_file, output_file, profile, current in scaling_tasks:
+                versions.setdefault(input_file, []).append((output_file, profile, current))
+            sources = {}
+            tasks = []
+            for input_file, outputs in versions.items():
+                image = image_for_original[input_file]
+                manifest = RenditionManifest.load(image.media_id)
+                sources[input_file] = RenditionManifest.source(input_file)
+                tasks.append((input_file, outputs, image.width * image.height, manifest['pixel_hash'] if manifest else None,
+                              image.isPrivate if self.embed_metadata else None))
+
+            failed = set()
+            embedded = set()
+            with self.metrics.measure("resize", len(scaling_tasks)):
+                for result in self.renditions.run(tasks, f"{self.name}: Generating image versions ({description})", self.progress_position):
+                    input_file = result['input_file']
+                    image = image_for_original[input_file]
+                    Trace.add("create_image_versions", "pil", result['start'], result['end'], pid=result['pid'], tid=result['pid'], thread_name=f"render {result['pid']}",
+                              image=image.id, platform=self.name, file=input_file, versions=len(versions[input_file]), rendered=len(result['rendered']))
+                    rendered.update(result['rendered'])
+                    for output_file, profile, current in versions[input_file]:
+                        if output_file in result['errors']:
+                            logging.error("%s: Unable to create %s: %s", self.name, output_file, result['errors'][output_file])
+                            failed.add(output_file)
+                        else:
+                            Journal.record(self.name, Journal.RENDERED, output_file)
+                    if self.embed_metadata:
+                        for output_file in result['rendered']:
+                            Journal.record(self.name, Journal.METADATA, output_file)
+                            embedded.add(output_file)
+                        MetadataDigests.record(self.name, {output_file : image.metadata_digest for output_file in result['rendered']})
+                    if result['pixel_hash'] is not None:
+                        self.update_manifest(image, sources[input_file], result['pixel_hash'], versions[input_file], result['errors'])
+            exiftool_tasks = [task for task in exiftool_tasks if task[1] not in failed and task[1] not in embedded]
+
+        # Versions kept because their pixels are unchanged may already carry this metadata
+        digests = {task[1] : image_for_original[task[0]].metadata_digest for task in exiftool_tasks}
+        exiftool_tasks = [task for task in exiftool_tasks
+                          if task[1] in rendered or not MetadataDigests.current(self.name, task[1], digests[task[1]])]
+
+        if (len(exiftool_tasks) > 0):
+            with self.metrics.measure("exiftool", len(exiftool_tasks)), Trace.context(platform=self.name):
+                written = set_metadata(exiftool_tasks, self.name, position=self.progress_position, pool=self.exiftool)
+            for output_file in written:
+                Journal.record(self.name, Journal.METADATA, output_file)
+            MetadataDigests.record(self.name, {output_file : digests[output_file] for output_file in written})
+
+
+    def update_manifest(self, image, source, pixel_hash, versions, errors):
+        """Record what the image's versions are now made from"""
+        manifest = RenditionManifest.load(image.media_id)
+        if manifest is None or manifest['pixel_hash'] != pixel_hash:
+            # Anything not just rendered was made from other pixels
+            manifest = {'versions' : {}}
+        manifest['source'] = source
+        manifest['pixel_hash'] = pixel_hash
+        for output_file, profile, current in versions:
+            if output_file not in errors:
+                manifest['versions'][os.path.basename(output_file)] = RenditionManifest.settings(profile)
+                # The profile's format changed, so the version written before is no longer used. It
+                # stays while notes embed it by name, as removing it would break them.
+                for other_file in self.other_formats(image.media_id, profile):
+                    manifest['versions'].pop(os.path.basename(other_file), None)
+                    if os.path.exists(other_file):
+                        notes = self.embedded_in_vault(other_file)
+                        if notes is None:
+                            logging.warning(f"{self.name}: Keeping {os.path.basename(other_file)}. Notes embedding it are not indexed, so it may still be in use.")
+                        elif len(notes) > 0:
+                            logging.warning(f"{self.name}: Keeping {os.path.basename(other_file)} as notes still embed it. Change them to {os.path.basename(output_file)}: {', '.join(notes)}")
+                        else:
+                            os.remove(other_file)
+        RenditionManifest.save(image.media_id, manifest)
+
+
+    def plan_work(self):
+        self.connect()  # Only checks the vault folders exist and loads templates
+        self.check_references()
+
+        work = {stage : 0 for stage in ["resize", "exiftool", "markdown", "writeback"]}
+        for image in self.images_to_add | self.images_to_update:
+            scaling_tasks, exiftool_tasks = self.rendition_tasks(image)
+            work["resize"] += len(scaling_tasks)
+            if self.embed_metadata:
+                # Assume every version scheduled for scaling is re-encoded, with its metadata
+                scaled = {task[1] for task in scaling_tasks}
+                exiftool_tasks = [task for task in exiftool_tasks if task[1] not in scaled]
+            work["exiftool"] += len(exiftool_tasks)
+            work["markdown"] += 1
+            work["writeback"] += 1 if image.operation == IMatchImage.OP_ADD else 2
+
+        if len(self.images_to_delete) > 0:
+            work["writeback"] += 2
+        work["markdown"] += len([album for album in self.albums.values() if len(album) > 0])
+        return work
+
+
+    def album_card(self, image, cards):
+        """The image's card for album pages. The card cached from last run is reused if nothing on it has changed."""
+        card_template_values = {
+            'fullsize' : image.filename_for_size('c'),
+            'page' : image.media_id,
+            'orientation' : 'landscape' if image.width >= image.height else 'portrait',
+            'title' : image.title,
+            'thumbnail' : image.filename_for_size('m'),
+        }
+        template = self.templates[QuantumController._CARD_TEMPLATE]
+        digest = AlbumPages.digest(template, card_template_values)
+        card = cards.get(image.media_id)
+        if card is None or card['digest'] != digest:
+            card = {'digest' : digest, 'content' : template.format(**card_template_values)}
+        return card
+
+    @staticmethod
+    def album_thumbnail(album, images):
+        """The album's configured thumbnail if it is in the album, otherwise its first image. images are in date order."""
+        for image in images:
+            if image.media_id == album.thumbnail:
+                return image
+        return images[0]
 
-            set_metadata(exiftool_tasks)
-        
-            
     def generate_albums(self):
+        """Write the page for each album. Pages are only rendered again when the album's
+        membership, its images' cards or its own details have changed since last run."""
         self.connect()
 
+        state = AlbumPages.load()
+        cards = {}
+        pages = {}
         for album in sorted(self.albums.values()):
             if(len(album) > 0):
-                print(f"{self.name}: Creating album for {album.name} [{len(album)} images]")
-                cards = []
-                dates = []
-                for image in album.images:
-                    dates.append(image.date_time)
-                    card_template_values = {
-                        'fullsize' : image.filename_for_size('c'),
-                        'page' : image.media_id,
-                        'orientation' : 'landscape' if image.width >= image.height else 'portrait',
-                        'title' : image.title,
-                        'thumbnail' : image.filename_for_size('m'),
-                    }
-                    card_content = self.templates[QuantumController._CARD_TEMPLATE].format(**card_template_values)
-                    cards.append(card_content)
+                images = sorted(album.images, key=lambda image: (image.date_time, image.media_id))
+                album_cards = []
+                for image in images:
+                    cards[image.media_id] = cards.get(image.media_id) or self.album_card(image, state['cards'])
+                    album_cards.append(cards[image.media_id])
 
                 album_template_values = {
-                    'datetime' : max(dates).strftime('%Y-%m-%dT%H:%M:%S'),
+                    'datetime' : images[-1].date_time.strftime('%Y-%m-%dT%H:%M:%S'),
                     'title' : album.name,
-                    'cards' : "\n".join(cards),
-                    'count' : len(cards),
+                    'count' : len(album_cards),
                     'description' : album.description,
-                    'thumbnail' : random.choice(list(album.images)).filename_for_size('m')
+                    'thumbnail' : self.album_thumbnail(album, images).filename_for_size('m')
                 }
+                template = self.templates[QuantumController._ALBUM_TEMPLATE]
+                pages[album.slug] = AlbumPages.digest(template, album_template_values, [card['digest'] for card in album_cards])
 
-                md_content = self.templates[QuantumController._ALBUM_TEMPLATE].format(**album_template_values)
+                album_filename = self.build_album_path(f"{album.slug}.md")
+                if state['albums'].get(album.slug) == pages[album.slug] and os.path.exists(album_filename):
+                    logging.debug("%s: Album %s unchanged", self.name, album.name)
+                    self.count_write(False)
+                    continue
+
+                print(f"{self.name}: Creating album for {album.name} [{len(album)} images]")
+                md_content = template.format(cards="\n".join(card['content'] for card in album_cards), **album_template_values)
                 md_content = html.unescape(md_content)
 
-                album_filename = self.build_album_path(f"{album.slug}.md")
-                logging.debug(f"{self.name}: Writing album to {album_filename}")
-                with open(album_filename, 'w') as file:
-                    file.write(md_content)
+                logging.debug("%s: Writing album to %s", self.name, album_filename)
+                with self.metrics.measure("markdown", 1), vault_lock:
+                    written = write_if_changed(album_filename, md_content)
+                self.count_write(written)
             else:
                 print(f"{self.name}: Skipping empty album {album.name}.")
 
+        AlbumPages.save({'cards' : cards, 'albums' : pages})
+
 
 class QuantumAlbum(Album):
-    def __init__(self, name, description, slug):
+    def __init__(self, name, description, slug, thumbnail=None):
             
         super().__init__(name, description)
         self.slug = slug
+        self.thumbnail = thumbnail  # media_id of the image shown for the album, otherwise its first image
 
     def __repr__(self):
         return f'{self.__class__.__name__}: {self.name} (slug: {self.slug} images:{len(self.images)}), {self.description} '
@@ -522,9 +729,41 @@ class QuantumAlbum(Album):
         albums = {}
         for album in config.albums:
             try:
-                albums[album['name']] = cls(album['name'], album['description'], album['slug'])
+                albums[album['name']] = cls(album['name'], album['description'], album['slug'], album.get('thumbnail'))
             except KeyError:
                 # If any required fields are missing for the album class, then not a valid album
                 pass
             
-        return albums
\ No newline at end of file
+        return albums
+
+
+class AlbumPages():
+    """What each album page and image card was last rendered from, kept in the state folder
+    so unchanged albums aren't rendered again. Cards are cached by media_id with the content
+    rendered for them."""
+
+    FILENAME = "albums.json"
+
+    @classmethod
+    def path(cls):
+        return os.path.join(config.STATE_PATH, cls.FILENAME)
+
+    @classmethod
+    def load(cls):
+        try:
+            with open(cls.path(), 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {'cards' : {}, 'albums' : {}}
+
+    @classmethod
+    def save(cls, state):
+        os.makedirs(config.STATE_PATH, exist_ok=True)
+        tmp_path = cls.path() + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(state, file)
+        os.replace(tmp_path, cls.path())
+
+    @staticmethod
+    def digest(*values):
+        return hashlib.blake2b(json.dumps(values, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
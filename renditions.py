@@ -0,0 +1,389 @@
+import atexit
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
+import io
+import json
+import logging
+import os
+import xml.etree.ElementTree as ET
+
+from PIL import Image
+
+try:
+    import numpy as np     # Optional. Only needed for byte budgets.
+except ImportError:
+    np = None
+
+import config
+from tracing import now
+from utilities import progress_bar
+
+## Creating the sized versions of originals. The work is CPU bound, so it runs in a
+## pool of worker processes that is kept for the whole run rather than started for
+## each batch of adds or updates.
+
+QUALITY = 85    # Encoder quality for every version, unless its profile says otherwise
+
+## Each version is encoded as its profile says. A profile is the version's long edge
+## ("size") and "format" (WEBP, AVIF or JPEG), with optional:
+##   quality      encoder quality, default QUALITY
+##   options      other arguments for PIL's save, e.g. {"method" : 6} for WebP or {"speed" : 4} for AVIF
+##   budget       bytes. A version larger than this at its quality is searched for the lowest
+##                quality, down to min_quality, that still looks the same: its SSIM against
+##                the unencoded pixels is at least threshold. Needs numpy.
+##   min_quality  default 40
+##   threshold    default 0.97
+FORMATS = {"WEBP" : "webp", "AVIF" : "avif", "JPEG" : "jpg"}   # File extension for each format
+ENCODER_SETTINGS = ['options', 'budget', 'min_quality', 'threshold']
+MIN_QUALITY = 40
+SSIM_THRESHOLD = 0.97
+SSIM_BLOCK = 8      # SSIM is computed over blocks of this many pixels square
+
+## Metadata embedded by the encoder when exiftool is skipped. The same whitelist as
+## exiftool_public_tag_args and exiftool_private_tag_args in utilities.py, with private
+## images losing their GPS and IPTC location.
+EXIF_IFD = 0x8769
+GPS_IFD = 0x8825
+EXIF_IMAGE_TAGS = [0x010F, 0x0110]   # Make, Model
+EXIF_PHOTO_TAGS = [0x829A, 0x829D, 0x8827, 0x920A, 0xA432, 0xA433, 0xA434, 0xA001]   # ExposureTime, FNumber, ISO, FocalLength, LensInfo, LensMake, LensModel, ColorSpace
+EXIF_GPS_TAGS = [1, 2, 3, 4, 5, 6]   # Latitude, longitude and altitude with their refs
+
+RDF = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+XMP_NAMESPACES = {
+    "x" : "adobe:ns:meta/",
+    "rdf" : RDF,
+    "xmp" : "http://ns.adobe.com/xap/1.0/",
+    "xmpRights" : "http://ns.adobe.com/xap/1.0/rights/",
+    "dc" : "http://purl.org/dc/elements/1.1/",
+    "photoshop" : "http://ns.adobe.com/photoshop/1.0/",
+    "Iptc4xmpCore" : "http://iptc.org/std/Iptc4xmpCore/1.0/xmlns/",
+}
+XMP_PUBLIC_PROPERTIES = {    # namespace -> property names, None for all of them
+    XMP_NAMESPACES["xmp"] : {"CreateDate", "Rights"},
+    XMP_NAMESPACES["xmpRights"] : None,
+    XMP_NAMESPACES["dc"] : {"title", "description", "rights"},
+    XMP_NAMESPACES["photoshop"] : {"DateCreated", "Country", "State", "City"},
+    XMP_NAMESPACES["Iptc4xmpCore"] : {"Location"},
+}
+XMP_PRIVATE_PROPERTIES = {namespace : names for namespace, names in XMP_PUBLIC_PROPERTIES.items() if namespace != XMP_NAMESPACES["Iptc4xmpCore"]}
+
+for prefix, namespace in XMP_NAMESPACES.items():
+    ET.register_namespace(prefix, namespace)
+
+
+def scaled_size(width, height, long_edge):
+    """Size of the version of a width x height original with the given long edge. Originals are never enlarged."""
+    if max(width, height) <= long_edge:
+        return (width, height)
+    scaling_factor = int(long_edge) / max(width, height)
+    return (int(width * scaling_factor), int(height * scaling_factor))
+
+
+def pixel_hash(img):
+    """Digest of an image's pixels. Metadata edits to the original don't change it."""
+    digest = hashlib.blake2b(f"{img.mode} {img.size}".encode(), digest_size=16)
+    digest.update(img.tobytes())
+    return digest.hexdigest()
+
+
+def embedded_exif(original, private):
+    """The original's whitelisted EXIF tags, ready for the encoder"""
+    source = original.getexif()
+    exif = Image.Exif()
+    for tag in EXIF_IMAGE_TAGS:
+        if tag in source:
+            exif[tag] = source[tag]
+    ifds = [(EXIF_IFD, EXIF_PHOTO_TAGS)] if private else [(EXIF_IFD, EXIF_PHOTO_TAGS), (GPS_IFD, EXIF_GPS_TAGS)]
+    for ifd, tags in ifds:
+        values = {tag : value for tag, value in source.get_ifd(ifd).items() if tag in tags}
+        if len(values) > 0:
+            exif.get_ifd(ifd).update(values)
+    return exif.tobytes()
+
+
+def xmp_property(name, private):
+    """True if the {namespace}name property is whitelisted"""
+    namespace, _, local = name[1:].partition("}")
+    properties = XMP_PRIVATE_PROPERTIES if private else XMP_PUBLIC_PROPERTIES
+    return namespace in properties and (properties[namespace] is None or local in properties[namespace])
+
+
+def embedded_xmp(original, private):
+    """A new XMP packet holding only the original's whitelisted properties, or None if it has none"""
+    packet = original.info.get('xmp')
+    if not packet:
+        return None
+    try:
+        root = ET.fromstring(packet)
+    except ET.ParseError:
+        return None
+    description = ET.Element(f"{{{RDF}}}Description", {f"{{{RDF}}}about" : ""})
+    for source in root.iter(f"{{{RDF}}}Description"):
+        for name, value in source.attrib.items():
+            if xmp_property(name, private):
+                description.set(name, value)
+        for child in source:
+            if xmp_property(child.tag, private):
+                description.append(child)
+    if len(description) == 0 and len(description.attrib) == 1:
+        return None
+    xmpmeta = ET.Element(f"{{{XMP_NAMESPACES['x']}}}xmpmeta")
+    ET.SubElement(xmpmeta, f"{{{RDF}}}RDF").append(description)
+    return (b'<?xpacket begin="\xef\xbb\xbf" id="W5M0MpCehiHzreSzNTczkc9d"?>'
+            + ET.tostring(xmpmeta, encoding="utf-8", xml_declaration=False)
+            + b'<?xpacket end="w"?>')
+
+
+def ssim(a, b):
+    """Structural similarity of two images of the same size, from 1 for identical down. Computed
+    on luminance as the mean over SSIM_BLOCK square blocks, vectorised with numpy."""
+    def blocks(img):
+        pixels = np.asarray(img.convert("L"), dtype=np.float64)
+        height, width = (pixels.shape[0] // SSIM_BLOCK) * SSIM_BLOCK, (pixels.shape[1] // SSIM_BLOCK) * SSIM_BLOCK
+        if height == 0 or width == 0:
+            return pixels.reshape(1, -1)   # Smaller than a block, so compare it whole
+        return (pixels[:height, :width]
+                .reshape(height // SSIM_BLOCK, SSIM_BLOCK, width // SSIM_BLOCK, SSIM_BLOCK)
+                .swapaxes(1, 2)
+                .reshape(-1, SSIM_BLOCK * SSIM_BLOCK))
+    x, y = blocks(a), blocks(b)
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    mean_x, mean_y = x.mean(axis=1), y.mean(axis=1)
+    var_x, var_y = x.var(axis=1), y.var(axis=1)
+    covariance = ((x - mean_x[:, None]) * (y - mean_y[:, None])).mean(axis=1)
+    values = ((2 * mean_x * mean_y + c1) * (2 * covariance + c2)) / ((mean_x ** 2 + mean_y ** 2 + c1) * (var_x + var_y + c2))
+    return float(values.mean())
+
+
+def encode(img, profile, quality, metadata):
+    """The image encoded as the profile says, at the given quality"""
+    buffer = io.BytesIO()
+    img.save(buffer, format=profile['format'], quality=quality, **profile.get('options', {}), **metadata)
+    return buffer.getvalue()
+
+
+def encode_version(img, profile, metadata):
+    """Encode a version. Without a budget, or within it at the profile's quality, that is the
+    result. Otherwise search for the lowest quality whose SSIM meets the threshold."""
+    quality = profile.get('quality', QUALITY)
+    data = encode(img, profile, quality, metadata)
+    if 'budget' not in profile or len(data) <= profile['budget']:
+        return data
+    if np is None:
+        logging.warning("numpy is needed for rendition byte budgets. Encoding at quality %s.", quality)
+        return data
+
+    # Quality only ever falls, so the search is over [min_quality, quality). Bisect for the
+    # lowest that still meets the threshold, keeping the best result found so far.
+    threshold = profile.get('threshold', SSIM_THRESHOLD)
+    low, high = profile.get('min_quality', MIN_QUALITY), quality - 1
+    while low <= high:
+        middle = (low + high) // 2
+        candidate = encode(img, profile, middle, metadata)
+        with Image.open(io.BytesIO(candidate)) as decoded:
+            similar = ssim(img, decoded) >= threshold
+        if similar:
+            data = candidate if len(candidate) < len(data) else data
+            high = middle - 1
+        else:
+            low = middle + 1
+    return data
+
+
+def create_image_versions(input_file, versions, known_hash=None, embed=None):
+    """Create every version of an original from a single decode. versions is a list of
+    (output_file, profile, current), where current means the file exists and was made with
+    the same profile. The original is decoded once, at reduced scale where the
+    format allows, to make the largest version. Smaller versions are then resized from
+    that, not from the full original.
+
+    Every version is derived from the largest, so its pixels identify them all. If they hash
+    to known_hash, current versions are left alone.
+
+    embed is None to leave metadata to exiftool, or the image's isPrivate to have the encoder
+    write the whitelisted EXIF and XMP, built once from the original, into every version.
+
+    Returns (pixel_hash, rendered, errors). rendered lists the output files written and
+    errors maps any that could not be saved to the error."""
+    versions = sorted(versions, key=lambda version: -version[1]['size'])
+    with Image.open(input_file) as original:
+        width, height = original.size
+        largest_size = scaled_size(width, height, versions[0][1]['size'])
+
+        # JPEG can decode straight to 1/2, 1/4 or 1/8 scale. Draft never goes below the size asked for.
+        original.draft(original.mode, largest_size)
+        # Other formats are shrunk by a whole factor with reduce() before resampling (reducing_gap)
+        largest = original.resize(largest_size, Image.LANCZOS, reducing_gap=3.0) if original.size != largest_size else original.copy()
+
+        metadata = {}
+        if embed is not None:
+            metadata['exif'] = embedded_exif(original, embed)
+            xmp = embedded_xmp(original, embed)
+            if xmp is not None:
+                metadata['xmp'] = xmp
+
+    digest = pixel_hash(largest)
+    rendered = []
+    errors = {}
+    for output_file, profile, current in versions:
+        if current and digest == known_hash:
+            logging.debug("Pixels unchanged, keeping image: %s", output_file)
+            continue
+        logging.debug("Creating image: %s", output_file)
+        try:
+            size = scaled_size(width, height, profile['size'])
+            version = largest if size == largest.size else largest.resize(size, Image.LANCZOS, reducing_gap=3.0)
+            data = encode_version(version, profile, metadata)
+            with open(output_file, 'wb') as file:
+                file.write(data)
+            rendered.append(output_file)
+        except Exception as ex:
+            errors[output_file] = f"{type(ex).__name__}: {ex}"
+    return digest, rendered, errors
+
+
+def failed_result(input_file, versions, ex):
+    return {
+        'input_file' : input_file, 'versions' : len(versions), 'start' : 0, 'end' : 0, 'pid' : 0, 'pixel_hash' : None, 'rendered' : [],
+        'errors' : {version[0] : f"{type(ex).__name__}: {ex}" for version in versions},
+    }
+
+
+def render_batch(batch):
+    """Worker entry point. batch is a list of (input_file, versions, known_hash, embed) tasks. Returns a result dict
+    for each with the input_file, start, end and pid for tracing, and the pixel_hash, rendered and errors
+    from create_image_versions."""
+    results = []
+    for input_file, versions, known_hash, embed in batch:
+        start = now()
+        try:
+            digest, rendered, errors = create_image_versions(input_file, versions, known_hash, embed=embed)
+            results.append({
+                'input_file' : input_file, 'versions' : len(versions), 'start' : start, 'end' : now(), 'pid' : os.getpid(),
+                'pixel_hash' : digest, 'rendered' : rendered, 'errors' : errors,
+            })
+        except Exception as ex:
+            # Could not read the original, so every version fails
+            results.append(failed_result(input_file, versions, ex))
+    return results
+
+
+class RenditionPool():
+    """Long lived pool of rendition workers, shared by every batch in the run.
+
+    backend     -- "process" (default) for CPU parallelism, or "thread" where processes are
+                   costly to start or the platform can't fork cheaply. PIL releases the GIL
+                   while resizing and encoding, so threads still overlap well.
+    workers     -- defaults to the number of CPUs
+    batch_size  -- most originals sent to a worker at once, to cut IPC overhead
+    """
+
+    def __init__(self, backend="process", workers=None, batch_size=4) -> None:
+        if backend not in ["process", "thread"]:
+            raise ValueError(f"Unknown rendition backend '{backend}'. Use 'process' or 'thread'.")
+        self.backend = backend
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.backend == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="render")
+            atexit.register(self.shutdown)
+        return self._executor
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    def batches(self, tasks):
+        """Largest originals first, so the longest tasks don't start last and hold up the end of the run.
+        Batches stay small enough that every worker has several to take."""
+        ordered = sorted(tasks, key=lambda task: -task[2])
+        batch_size = max(1, min(self.batch_size, len(ordered) // (self.workers * 4)))
+        return [[(input_file, versions, known_hash, embed) for input_file, versions, pixels, known_hash, embed in ordered[i:i + batch_size]]
+                for i in range(0, len(ordered), batch_size)]
+
+    def run(self, tasks, description, position=None):
+        """Render every task, a list of (input_file, versions, pixel_count, known_hash, embed), yielding
+        the render_batch result for each as it completes"""
+        executor = self._get_executor()
+        pending = {executor.submit(render_batch, batch) : batch for batch in self.batches(tasks)}
+        total = sum(len(task[1]) for task in tasks)
+        pbar = progress_bar(total=total, desc=description, position=position)
+        try:
+            while len(pending) > 0:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch = pending.pop(future)
+                    try:
+                        results = future.result()
+                    except Exception as ex:
+                        # The worker itself failed, e.g. it was killed
+                        results = [failed_result(input_file, versions, ex) for input_file, versions, known_hash, embed in batch]
+                        if isinstance(ex, BrokenProcessPool) and self._executor is executor:
+                            # The pool is unusable once a worker dies. The next batch starts a fresh one.
+                            logging.warning("Rendition pool lost a worker and will be restarted: %s", ex)
+                            executor.shutdown(wait=False)
+                            self._executor = None
+                    for result in results:
+                        pbar.update(result['versions'])
+                        yield result
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            raise
+        finally:
+            pbar.close()
+
+
+class RenditionManifest():
+    """What each media_id's versions were made from: the original's size and mtime, the hash of
+    its pixels and the settings used for each version. One small JSON file per media_id in the
+    state folder. Lets metadata-only runs skip re-encoding when the pixels haven't changed."""
+
+    FOLDER = "renditions"
+
+    @classmethod
+    def path(cls, media_id):
+        return os.path.join(config.STATE_PATH, cls.FOLDER, f"{media_id}.json")
+
+    @classmethod
+    def load(cls, media_id):
+        try:
+            with open(cls.path(media_id), 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    @classmethod
+    def save(cls, media_id, manifest):
+        os.makedirs(os.path.dirname(cls.path(media_id)), exist_ok=True)
+        tmp_path = cls.path(media_id) + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(manifest, file)
+        os.replace(tmp_path, cls.path(media_id))
+
+    @classmethod
+    def delete(cls, media_id):
+        try:
+            os.remove(cls.path(media_id))
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def source(filename):
+        """The original's identity as far as a cheap stat can tell"""
+        stat = os.stat(filename)
+        return {'file' : filename, 'size' : stat.st_size, 'mtime' : stat.st_mtime}
+
+    @staticmethod
+    def settings(profile):
+        """What a version made with the profile depends on. Versions made before profiles match the default."""
+        settings = {'long_edge' : profile['size'], 'format' : profile['format'], 'quality' : profile.get('quality', QUALITY)}
+        return settings | {key : profile[key] for key in ENCODER_SETTINGS if key in profile}
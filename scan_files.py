@@ -1,38 +1,116 @@
+import argparse
+import json
 import logging
+import mmap
 import multiprocessing
 import os
 import re
 import pprint
 from collections import defaultdict
 
-def scan_file(file_path, pattern):
-    regex = re.compile(pattern)
+import config
+
+def media_pattern(extensions):
+    """Pattern for a reference to a version in one of the extensions, and the literals one of which is
+    in every match. Most notes have none, so the regex never runs on them. Only the extensions
+    versions are written in are matched, as others pick up the likes of Flickr's ..._c.jpg urls."""
+    extensions = sorted(extensions)
+    return (rf"(?<![0-9A-Za-z])\d{{6}}_[cmntz]\.(?:{'|'.join(re.escape(extension) for extension in extensions)})",
+            tuple(f".{extension}".encode() for extension in extensions))
+
+## Photos are referenced from notes in the vault by the filename of one of their versions
+MEDIA_EXTENSIONS = ["webp"]     # Unless the rendition profiles add others
+MEDIA_PATTERN, MEDIA_LITERAL = media_pattern(MEDIA_EXTENSIONS)
+VAULT_FOLDERS_TO_IGNORE = {"photos", "albums", ".obsidian"}
+
+## Flickr photos are embedded by their static URL, which has the photo_id in it
+FLICKR_URL_PATTERN = r"https://live\.staticflickr\.com/\d+/(\d+)_[a-zA-Z0-9]+(?:_[a-z])?\.jpg"
+FLICKR_URL_LITERAL = b"staticflickr"
+
+# Attachments that can't link to a photo. Every other file is read, as a photo may be used from any
+# text file in the vault (notes, canvases, bases, html, json ...) and must not be deleted while it is.
+BINARY_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".webp", ".avif", ".heic", ".heif", ".dng", ".psd", ".tif", ".tiff", ".bmp", ".ico",
+                     ".mp4", ".mov", ".webm", ".mkv", ".avi", ".mp3", ".m4a", ".wav", ".ogg", ".flac",
+                     ".pdf", ".zip", ".7z", ".gz", ".docx", ".xlsx", ".pptx", ".ttf", ".otf", ".woff", ".woff2")
+MMAP_MIN_SIZE = 256 * 1024  # Smaller files are cheaper to read in one go than to map
+BATCH_SIZE = 256    # Files handed to a worker process at once
+POOL_MIN_FILES = 1024   # Fewer files than this are scanned in this process
+
+def _search(data, regex, literal, file_path, match_dict):
+    """Record the matches in data, by the pattern's first group if it has one and otherwise
+    the first six characters (a media_id). Line numbers are only counted when there is a
+    match, and only over the text since the previous one."""
+    literals = (literal,) if isinstance(literal, bytes) else literal
+    if literals is not None and all(data.find(literal) == -1 for literal in literals):
+        return
+    line_num = 1
+    position = 0
+    for match in regex.finditer(data):
+        line_num += data[position:match.start()].count(b"\n")  # mmap has no count() before 3.13
+        position = match.start()
+        matched_text = match.group().decode('ascii', errors='ignore')
+        key = match.group(1).decode('ascii', errors='ignore') if regex.groups > 0 else matched_text[:6]
+        match_dict.setdefault(key, []).append((file_path, line_num))
+        logging.debug("Matched '%s' in %s on line %s", matched_text, file_path, line_num)
+
+
+def scan_file(file_path, pattern, literal=None):
+    """Find the pattern in the file, returning media_id (or the first group) -> [(file_path, line number)]. The file is
+    searched as bytes, without decoding it or splitting it into lines. If given, literal is bytes
+    found in every match, or a tuple of them one of which is, checked for first as that is much
+    faster than the regex."""
+    regex = re.compile(pattern.encode() if isinstance(pattern, str) else pattern)
     match_dict = {}
     try:
-        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-            for line_num, line in enumerate(f, 1):
-                match = regex.search(line)
-                if match:
-                    matched_text = match.group()
-                    if matched_text not in match_dict:
-                        match_dict[matched_text[:6]] = []
-                    match_dict[matched_text[:6]].append((file_path, line_num))
-                    logging.debug(f"Matched '{matched_text}' in {file_path} on line {line_num}")
+        with open(file_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size >= MMAP_MIN_SIZE:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    _search(data, regex, literal, file_path, match_dict)
+            elif size > 0:
+                _search(f.read(), regex, literal, file_path, match_dict)
     except Exception as e:
         logging.error(f"Error reading {file_path}: {e}")
     return match_dict
 
 
-def scan_folder_with_subfolders(folder_path, pattern, folders_to_ignore):
+def scan_batch(file_paths, pattern, literal=None):
+    """Worker entry point. scan_file each path."""
+    return [scan_file(file_path, pattern, literal) for file_path in file_paths]
+
+
+def list_files(folder_path, folders_to_ignore, skip_extensions=BINARY_EXTENSIONS):
+    """Every file under folder_path, other than those with one of the extensions to skip or in the folders to ignore"""
     file_paths = []
-    for root, dirs, files in os.walk(folder_path):
-        dirs[:] = [d for d in dirs if d.lower() not in folders_to_ignore]
-        for file_name in files:
-            file_paths.append(os.path.join(root, file_name))
+    folders = [folder_path]
+    while len(folders) > 0:
+        try:
+            entries = os.scandir(folders.pop())
+        except OSError as e:
+            logging.error(f"Error listing {e.filename}: {e}")
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name.lower() not in folders_to_ignore:
+                        folders.append(entry.path)
+                elif not entry.name.lower().endswith(skip_extensions):
+                    file_paths.append(entry.path)
+    return file_paths
+
 
-    # Use multiprocessing
+def scan_paths(file_paths, pattern, literal=None):
+    """scan_file every path, returning the results in the same order"""
+    if len(file_paths) < POOL_MIN_FILES:
+        return scan_batch(file_paths, pattern, literal)  # Not worth starting processes
+    # Use multiprocessing, handing out the files in batches to keep the overhead per file down
+    batches = [file_paths[i:i + BATCH_SIZE] for i in range(0, len(file_paths), BATCH_SIZE)]
     with multiprocessing.Pool() as pool:
-        results = pool.starmap(scan_file, [(file_path, pattern) for file_path in file_paths])
+        return [result for batch in pool.starmap(scan_batch, [(batch, pattern, literal) for batch in batches]) for result in batch]
+
+
+def scan_folder_with_subfolders(folder_path, pattern, folders_to_ignore, literal=None):
+    results = scan_paths(list_files(folder_path, folders_to_ignore), pattern, literal)
 
     # Merge the dictionaries
     combined_matches = defaultdict(list)
@@ -42,3 +120,105 @@ def scan_folder_with_subfolders(folder_path, pattern, folders_to_ignore):
 
     return combined_matches
 
+
+class ReferenceIndex():
+    """Which files under a folder reference each media_id, kept on disk between runs. Only files
+    whose size or mtime have changed since they were last indexed are read again, so after
+    the first run an update costs little more than listing the folder."""
+
+    def __init__(self, folder_path, pattern, folders_to_ignore, index_path, literal=None) -> None:
+        self.folder_path = folder_path
+        self.pattern = pattern
+        self.literal = literal
+        self.folders_to_ignore = folders_to_ignore
+        self.index_path = index_path
+        self.files = {}     # file -> {size, mtime, matches : {media_id : [line numbers]}}
+        self._references = None
+
+    def load(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as file:
+                index = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            index = None
+        if index is None or index['pattern'] != self.pattern or index['ignore'] != sorted(self.folders_to_ignore) or index.get('skip') != list(BINARY_EXTENSIONS):
+            self.files = {}  # Built some other way, so start again
+        else:
+            self.files = index['files']
+        self._references = None
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump({'pattern' : self.pattern, 'ignore' : sorted(self.folders_to_ignore), 'skip' : list(BINARY_EXTENSIONS), 'files' : self.files}, file)
+        os.replace(tmp_path, self.index_path)
+
+    def update(self):
+        """Bring the index up to date with the folder. Returns the number of files read and dropped."""
+        self.load()
+        current = {}
+        for file_path in list_files(self.folder_path, self.folders_to_ignore):
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue  # Gone since it was listed
+            current[file_path] = {'size' : stat.st_size, 'mtime' : stat.st_mtime}
+
+        changed = [file_path for file_path, stat in current.items()
+                   if file_path not in self.files or {'size' : self.files[file_path]['size'], 'mtime' : self.files[file_path]['mtime']} != stat]
+        removed = [file_path for file_path in self.files if file_path not in current]
+
+        for file_path, result in zip(changed, scan_paths(changed, self.pattern, self.literal)):
+            matches = {media_id : [line_num for _, line_num in occurrences] for media_id, occurrences in result.items()}
+            self.files[file_path] = current[file_path] | {'matches' : matches}
+        for file_path in removed:
+            del self.files[file_path]
+
+        if len(changed) > 0 or len(removed) > 0:
+            self.save()
+        self._references = None
+        logging.debug("Reference index: %s files read, %s dropped, %s unchanged", len(changed), len(removed), len(current) - len(changed))
+        return len(changed), len(removed)
+
+    def references(self):
+        """Every reference, as media_id -> [(file, line number)] like scan_folder_with_subfolders"""
+        if self._references is None:
+            self._references = defaultdict(list)
+            for file_path, entry in self.files.items():
+                for media_id, line_nums in entry['matches'].items():
+                    self._references[media_id].extend((file_path, line_num) for line_num in line_nums)
+        return self._references
+
+    def lookup(self, media_id):
+        """Where the media_id is referenced, as [(file, line number)]"""
+        return self.references().get(media_id, [])
+
+
+def vault_reference_index(extensions=MEDIA_EXTENSIONS):
+    """The index of photo references in the Quantum vault, to versions in any of the extensions"""
+    pattern, literal = media_pattern(extensions)
+    return ReferenceIndex(config.quantum_secrets['path'], pattern, VAULT_FOLDERS_TO_IGNORE,
+                          os.path.join(config.STATE_PATH, "references.json"), literal)
+
+
+def flickr_url_index():
+    """The index of Flickr photo URLs in the vault, by photo_id"""
+    return ReferenceIndex(config.quantum_secrets['path'], FLICKR_URL_PATTERN, {".obsidian"},
+                          os.path.join(config.STATE_PATH, "flickr_references.json"), FLICKR_URL_LITERAL)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List the notes in the vault that use each photo.")
+    parser.add_argument("media_ids", nargs="+", help="six digit media ids of the photos")
+    args = parser.parse_args()
+
+    import quantum  # For the formats the rendition profiles write, so the index matches the one quantum keeps
+    index = vault_reference_index(quantum.media_extensions(quantum.rendition_profiles()))
+    read, dropped = index.update()
+    print(f"Index updated ({read} files read, {dropped} dropped)")
+    for media_id in args.media_ids:
+        references = index.lookup(media_id)
+        print(f"{media_id}: {len(references)} references")
+        for file_path, line_num in references:
+            print(f"-- {file_path}:{line_num}")
@@ -1,14 +1,23 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 import sys
 import logging
 import pprint
 import time
-from tqdm import tqdm
 
 import config
+from events import DEFAULT_PATH as DEFAULT_EVENTS_PATH, Events
 import IMatchAPI as im
 import flickr
+from imatch_image import IMatchRecord
+from journal import Journal
+from memory_profile import MemoryProfile
+from metrics import RunHistory
 import quantum
-from utilities import print_clear
+from pipeline import Pipeline
+import planner
+from tracing import Trace
+from utilities import add_json_log, print_clear, progress_bar
 
 
 logging.basicConfig(
@@ -60,51 +69,152 @@ class Factory():
             logging.error(f"{cls.__name__}.build(platform): '{platform.name}' is an unrecognised platform. Valid options are {cls.platforms.keys()}.")
             sys.exit()
           
+def gather_image_ids(controller):
+    """Retrieve the ids of every file in the Socials|{platform} category"""
+    try:
+        return im.IMatchAPI.get_categories(im.IMatchUtility.build_category([config.ROOT_CATEGORY,controller.name]))['directFiles']
+    except TypeError:
+        logging.error(f"{controller.name}: Root socials category missing: {im.IMatchUtility.build_category([config.ROOT_CATEGORY,controller.name])}")
+        sys.exit(1)
+
+
+def run_controller(controller, image_ids, stream):
+    """Take a controller through every stage of the run, short of the summary"""
+    try:
+        controller.begin_run()
+        with controller.metrics.measure("total", len(image_ids)):
+            if stream:
+                run_streamed(controller, image_ids)
+            else:
+                run_staged(controller, image_ids)
+
+            with Events.stage(controller.name, "delete", len(controller.images_to_delete)):
+                controller.delete_images()
+            Journal.sync()
+            MemoryProfile.snapshot(f"{controller.name}: deleted")
+            with controller.metrics.measure("finalise", len(controller.albums)), Events.stage(controller.name, "finalise"):
+                controller.finalise()
+            MemoryProfile.snapshot(f"{controller.name}: finalised")
+    except TypeError as ex:
+        print(ex) 
+        sys.exit(1)
+
+
+def gather_images(controller, image_ids):
+    with controller.metrics.measure("gather", len(image_ids)), Events.stage(controller.name, "gather", len(image_ids)):
+        for image_id in progress_bar(image_ids, desc=f"{controller.name}: Gathering images from IMatch", position=controller.progress_position):
+            with Trace.context(image=image_id, platform=controller.name):
+                Factory.build_image(image_id, controller)
+    MemoryProfile.snapshot(f"{controller.name}: gathered")
+
+
+def run_staged(controller, image_ids):
+    """Build every image, then classify, then commit each operation in turn"""
+    gather_images(controller, image_ids)
+
+    with Events.stage(controller.name, "classify", len(controller.images)):
+        controller.classify_images()
+    MemoryProfile.snapshot(f"{controller.name}: classified")
+    with Events.stage(controller.name, "add", len(controller.images_to_add)):
+        controller.add_images()
+    Journal.sync()
+    MemoryProfile.snapshot(f"{controller.name}: added")
+    with Events.stage(controller.name, "update", len(controller.images_to_update)):
+        controller.update_images()
+    Journal.sync()
+    MemoryProfile.snapshot(f"{controller.name}: updated")
+
+
+def run_streamed(controller, image_ids):
+    """Commit adds and updates while the rest of the images are still being read from IMatch"""
+    with Events.stage(controller.name, "stream", len(image_ids)):
+        Pipeline(controller, Factory.build_image).run(image_ids)
+    MemoryProfile.snapshot(f"{controller.name}: streamed")
+
+
 if __name__ == "__main__":
 
     start_time = time.time()
 
+    parser = argparse.ArgumentParser(description="Share IMatch images to the configured platforms.")
+    parser.add_argument("platforms", nargs="*", help=f"platforms to process (default: all of {', '.join(Factory.platforms.keys())})")
+    parser.add_argument("--stream", action="store_true", help="stream images from IMatch straight through to the platform instead of gathering them all first")
+    parser.add_argument("--parallel", action="store_true", help="run the platforms at the same time rather than one after the other")
+    parser.add_argument("--plan", action="store_true", help="report what would be done, and an estimate of how long it would take, without changing anything")
+    parser.add_argument("--resume", action="store_true", help="carry on from an interrupted run, skipping copies, renders and uploads it completed")
+    parser.add_argument("--trace", metavar="FILE", help="save a trace of IMatch, rendering, exiftool and platform calls to FILE, for chrome://tracing or Perfetto")
+    parser.add_argument("--profile-memory", action="store_true", help="report memory growth at each stage and the memory held per image. Slows the run considerably.")
+    parser.add_argument("--log-json", metavar="FILE", help="also write the log to FILE as JSON lines")
+    parser.add_argument("--events", metavar="FILE", nargs="?", const=DEFAULT_EVENTS_PATH, help=f"write progress as JSON lines to FILE (default: {DEFAULT_EVENTS_PATH}) in place of progress bars")
+    args = parser.parse_args()
+
+    if args.log_json:
+        add_json_log(args.log_json)
+    if args.events:
+        Events.start(args.events)
+    if args.trace:
+        Trace.start(args.trace)
+    if args.profile_memory:
+        MemoryProfile.start()
+
     # Retreive the complete list of Socials files from IMatch for all known
     # platforms. Within IMatch, files are in the Socials|{platform} category
     # or subcategories.
 
-    images = []             # main image store
     platform_controllers = set()
 
     im.IMatchAPI()             # Perform initial connection
 
     # Gather all image information for the specified platforms
-    if len(sys.argv[1:]) > 0:
-        for platform in sys.argv[1:]:
+    if len(args.platforms) > 0:
+        for platform in args.platforms:
             platform_controllers.add(Factory.build_controller(platform))
     else:
         # Do the lot
         for platform in Factory.platforms.keys():
             platform_controllers.add(Factory.build_controller(platform))
 
-    for controller in platform_controllers:
-        print( "--------------------------------------------------------------------------------------")
-        try:
-            images = im.IMatchAPI.get_categories(im.IMatchUtility.build_category([config.ROOT_CATEGORY,controller.name]))['directFiles']
-        except TypeError:
-            logging.error(f"{controller.name}: Root socials category missing: {im.IMatchUtility.build_category([config.ROOT_CATEGORY,controller.name])}")
-            sys.exit(1)
-        count = 0
-        max_images = len(images)
-        try:
-            for image_id in tqdm(images, desc=f"{controller.name}: Gathering images from IMatch", bar_format=config.bar_format):
-                image = Factory.build_image(image_id, controller)
-                count += 1
-
+    jobs = {}
+    for controller in sorted(platform_controllers, key=lambda x: x.name):
+        controller.run_mode = "stream" if args.stream else "staged"
+        jobs[controller] = gather_image_ids(controller)
+        IMatchRecord.expect(jobs[controller])
+    MemoryProfile.snapshot("started")
+
+    if args.plan:
+        if args.resume:
+            Journal.load()  # Plan for what is left, without disturbing the journal
+        for controller, image_ids in jobs.items():
+            print( "--------------------------------------------------------------------------------------")
+            gather_images(controller, image_ids)
             controller.classify_images()
-            controller.add_images()
-            controller.update_images()
-            controller.delete_images()
-            controller.finalise()
+            MemoryProfile.snapshot(f"{controller.name}: classified")
+            planner.report(controller)
+    elif args.parallel and len(jobs) > 1:
+        Journal.start(args.resume)
+        # Quantum is bound by CPU and disk, Flickr by the network, so they overlap well.
+        # Each keeps its own progress line, and summaries wait until both are done.
+        print( "--------------------------------------------------------------------------------------")
+        for position, controller in enumerate(jobs.keys()):
+            controller.progress_position = position
+        with ThreadPoolExecutor(max_workers=len(jobs), thread_name_prefix="platform") as executor:
+            futures = [executor.submit(run_controller, controller, image_ids, args.stream) for controller, image_ids in jobs.items()]
+            for future in futures:
+                future.result()
+        for controller in jobs.keys():
             controller.summarise()
-        except TypeError as ex:
-            print(ex) 
-            sys.exit(1)
+            RunHistory.record(controller.name, controller.metrics, controller.run_mode)
+        Journal.finish()
+    else:
+        Journal.start(args.resume)
+        for controller, image_ids in jobs.items():
+            print( "--------------------------------------------------------------------------------------")
+            run_controller(controller, image_ids, args.stream)
+            controller.summarise()
+            RunHistory.record(controller.name, controller.metrics, controller.run_mode)
+        Journal.finish()
+
+    MemoryProfile.report(jobs.keys())
 
     # stats = {}
     # for controller in platform_controllers:
@@ -122,6 +232,7 @@ if __name__ == "__main__":
     
     print("--------------------------------------------------------------------------------------")
     print(f"Done in {time.time()-start_time:.2f}s")
+    Events.finish(seconds=round(time.time()-start_time, 1), summary={controller.name : controller.stats for controller in jobs.keys()})
     sys.exit(0)
 
 
@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+## The modules live at the top of the repository and read secrets.json when config is
+## imported, so point them at the placeholder secrets kept with the tests.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["SHARE_IMAGES_SECRETS"] = os.path.join(os.path.dirname(os.path.abspath(__file__)), "secrets.json")
+
+import config
+
+
+@pytest.fixture
+def state(tmp_path, monkeypatch):
+    """A state folder of the test's own"""
+    monkeypatch.setattr(config, "STATE_PATH", str(tmp_path / "state"))
+    return tmp_path / "state"
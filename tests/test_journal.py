@@ -0,0 +1,85 @@
+import json
+import os
+
+import pytest
+
+from journal import Journal
+
+
+@pytest.fixture(autouse=True)
+def journal(state):
+    yield
+    Journal.finish()
+
+
+def write_journal(entries, partial=""):
+    """Leave a journal behind as an interrupted run would"""
+    os.makedirs(os.path.dirname(Journal.path()), exist_ok=True)
+    with open(Journal.path(), 'w', encoding='utf-8') as file:
+        for platform, step, key, data in entries:
+            file.write(json.dumps({'platform' : platform, 'step' : step, 'key' : key, 'data' : data}) + "\n")
+        file.write(partial)
+
+
+def test_resume_skips_the_steps_an_interrupted_run_completed():
+    write_journal([("Flickr", Journal.UPLOADED, "12", {'photo_id' : "555"}),
+                   ("Quantum", Journal.RENDERED, "/vault/000012_c.webp", {})],
+                  partial='{"platform" : "Flickr", "st')
+
+    Journal.start(resume=True)
+
+    assert Journal.get("Flickr", Journal.UPLOADED, 12) == {'photo_id' : "555"}
+    assert Journal.done("Quantum", Journal.RENDERED, "/vault/000012_c.webp")
+    assert not Journal.done("Flickr", Journal.WRITTEN_BACK, 12)
+    assert not Journal.done("Quantum", Journal.UPLOADED, 12)
+
+
+def test_entries_lists_the_steps_of_one_kind():
+    write_journal([("Flickr", Journal.UPLOADED, "1", {'photo_id' : "10", 'url' : "u"}),
+                   ("Flickr", Journal.UPLOADED, "2", {'photo_id' : "20"}),
+                   ("Flickr", Journal.COPIED, "3", {}),
+                   ("Quantum", Journal.UPLOADED, "4", {})])
+
+    Journal.start(resume=True)
+
+    assert Journal.entries("Flickr", Journal.UPLOADED) == {"1" : {'photo_id' : "10", 'url' : "u"}, "2" : {'photo_id' : "20"}}
+
+
+def test_records_after_resuming_are_appended_clear_of_a_partial_line():
+    write_journal([("Flickr", Journal.UPLOADED, "1", {'photo_id' : "10"})], partial='{"platf')
+
+    Journal.start(resume=True)
+    Journal.record("Flickr", Journal.UPLOADED, 2, photo_id="20")
+    Journal.sync()
+
+    Journal.load()
+    assert Journal.get("Flickr", Journal.UPLOADED, 1) == {'photo_id' : "10"}
+    assert Journal.get("Flickr", Journal.UPLOADED, 2) == {'photo_id' : "20"}
+
+
+def test_fresh_start_is_refused_over_an_unfinished_journal():
+    write_journal([("Flickr", Journal.UPLOADED, "1", {'photo_id' : "10"})])
+
+    with pytest.raises(SystemExit):
+        Journal.start()
+
+    Journal.load()
+    assert Journal.get("Flickr", Journal.UPLOADED, 1) == {'photo_id' : "10"}
+
+
+def test_finished_run_leaves_nothing_to_resume():
+    Journal.start()
+    Journal.record("Quantum", Journal.COPIED, "a")
+    Journal.finish()
+
+    assert not os.path.exists(Journal.path())
+    Journal.start()
+    assert not Journal.done("Quantum", Journal.COPIED, "a")
+
+
+def test_fresh_start_forgets_steps_recorded_in_memory():
+    Journal.record("Quantum", Journal.COPIED, "a")  # e.g. by a plan, which doesn't journal
+
+    Journal.start()
+
+    assert not Journal.done("Quantum", Journal.COPIED, "a")
@@ -0,0 +1,107 @@
+import sys
+import threading
+
+import pytest
+
+from imatch_image import IMatchImage
+from metrics import StageMetrics
+from pipeline import Pipeline
+
+OPERATIONS = [IMatchImage.OP_ADD, IMatchImage.OP_UPDATE, IMatchImage.OP_METADATA, IMatchImage.OP_DELETE, IMatchImage.OP_INVALID]
+
+
+class FakeImage():
+    def __init__(self, id) -> None:
+        self.id = id
+        self.operation = OPERATIONS[id % len(OPERATIONS)]
+
+
+class FakeController():
+    """Records each call the pipeline makes, in order"""
+
+    name = "Fake"
+    progress_position = None
+
+    def __init__(self, fail_on=None) -> None:
+        self.metrics = StageMetrics()
+        self.calls = []
+        self.batches = []
+        self.fail_on = fail_on
+        self._lock = threading.Lock()
+
+    def _note(self, step, images):
+        with self._lock:
+            self.calls.extend((step, image.id) for image in images)
+
+    def classify_image(self, image):
+        self._note("classify", [image])
+
+    def prepare_add(self, images):
+        self._note("prepare", images)
+
+    def prepare_update(self, images):
+        self._note("prepare", images)
+
+    def complete_add(self, images):
+        self.batches.append(len(images))
+        self._note("commit", images)
+        if self.fail_on in {image.id for image in images}:
+            sys.exit(1)
+
+    def complete_update(self, images):
+        self.batches.append(len(images))
+        self._note("commit", images)
+
+    def print_classification(self):
+        pass
+
+
+def build_image(id, controller):
+    return FakeImage(id)
+
+
+def run(controller, count, **kwargs):
+    Pipeline(controller, build_image, batch_wait=0.05, **kwargs).run(list(range(count)))
+
+
+def test_every_add_and_update_is_prepared_then_committed_once():
+    controller = FakeController()
+    run(controller, 40)
+
+    committed = [id for step, id in controller.calls if step == "commit"]
+    expected = {id for id in range(40) if FakeImage(id).operation in [IMatchImage.OP_ADD, IMatchImage.OP_UPDATE, IMatchImage.OP_METADATA]}
+    assert sorted(committed) == sorted(expected)
+    assert {id for step, id in controller.calls if step == "classify"} == set(range(40))
+    for id in expected:
+        assert controller.calls.index(("classify", id)) < controller.calls.index(("prepare", id)) < controller.calls.index(("commit", id))
+
+
+def test_deletes_and_invalid_images_are_not_prepared():
+    controller = FakeController()
+    run(controller, 20)
+
+    skipped = {id for id in range(20) if FakeImage(id).operation in [IMatchImage.OP_DELETE, IMatchImage.OP_INVALID]}
+    assert skipped.isdisjoint(id for step, id in controller.calls if step != "classify")
+
+
+def test_commits_are_batched():
+    controller = FakeController()
+    run(controller, 50, batch_size=4)
+
+    assert max(controller.batches) <= 4
+
+
+def test_gather_is_timed_once_for_the_whole_stream():
+    controller = FakeController()
+    run(controller, 30, hydrate_workers=4)
+
+    assert controller.metrics.stages["gather"]["units"] == 30
+
+
+def test_failure_in_a_stage_stops_the_run_and_is_raised():
+    controller = FakeController(fail_on=5)
+    with pytest.raises(SystemExit):
+        run(controller, 200, batch_size=2)
+
+    committed = [id for step, id in controller.calls if step == "commit"]
+    assert len(committed) < len([id for id in range(200) if FakeImage(id).operation in [IMatchImage.OP_ADD, IMatchImage.OP_UPDATE, IMatchImage.OP_METADATA]])
@@ -0,0 +1,127 @@
+import os
+
+import pytest
+from PIL import Image
+
+import config
+from imatch_image import IMatchImage
+from journal import Journal
+from platform_controller import PlatformController
+import IMatchAPI as im
+import quantum
+from quantum import QuantumAlbum, QuantumController, QuantumImage
+
+
+class FakeImage():
+    """Just what rendering and naming the versions reads from an image"""
+
+    filename_for_size = QuantumImage.filename_for_size
+
+    def __init__(self, controller, filename, operation=IMatchImage.OP_ADD) -> None:
+        self.controller = controller
+        self.id = 1
+        self.media_id = "000001"
+        self.filename = filename
+        self.width, self.height = Image.open(filename).size
+        self.isPrivate = False
+        self.metadata_digest = "digest"
+        self.operation = operation
+
+
+@pytest.fixture
+def vault(tmp_path, state, monkeypatch):
+    folder = tmp_path / "vault"
+    (folder / "photos").mkdir(parents=True)
+    (folder / "notes").mkdir()
+    monkeypatch.setitem(config.quantum_secrets, 'path', str(folder))
+    monkeypatch.setitem(config.quantum_secrets, 'rendition_backend', "thread")
+    monkeypatch.setitem(config.quantum_secrets, 'embed_metadata', True)  # No exiftool needed
+    yield folder
+    Journal.load()  # Forget what the test rendered
+
+
+def controller(vault, monkeypatch, profiles=None):
+    if profiles is not None:
+        monkeypatch.setitem(config.quantum_secrets, 'rendition_profiles', profiles)
+    controller = QuantumController("Quantum", QuantumAlbum, im.IMatchAPI.FORMAT_WEBP, [im.IMatchAPI.FORMAT_WEBP])
+    controller.api = {QuantumController._PHOTOS_PATH : str(vault / "photos")}
+    return controller
+
+
+def original(tmp_path):
+    path = tmp_path / "original.png"
+    Image.new("RGB", (400, 300), "green").save(path)
+    return str(path)
+
+
+def pages_written(monkeypatch, step):
+    """Stand in for the commits, noting the file each page would link to"""
+    links = []
+    monkeypatch.setattr(PlatformController, step, lambda self, images: links.extend(image.filename_for_size("c") for image in images))
+    return links
+
+
+def test_profiles_take_the_default_then_the_size_settings(vault, monkeypatch):
+    monkeypatch.setitem(config.quantum_secrets, 'rendition_profiles', {'default' : {'quality' : 70}, '800' : {'format' : "avif", 'budget' : 1000}})
+
+    profiles = {profile['size'] : profile for profile in quantum.rendition_profiles()}
+
+    assert profiles[800] == {'format' : "AVIF", 'quality' : 70, 'budget' : 1000, 'size' : 800, 'suffix' : "_c"}
+    assert profiles[100] == {'format' : "WEBP", 'quality' : 70, 'size' : 100, 'suffix' : "_t"}
+    assert quantum.media_extensions(list(profiles.values())) == ["avif", "webp"]
+
+
+def test_unknown_format_is_refused(vault, monkeypatch):
+    monkeypatch.setitem(config.quantum_secrets, 'rendition_profiles', {'800' : {'format' : "GIF"}})
+
+    with pytest.raises(SystemExit):
+        quantum.rendition_profiles()
+
+
+def test_version_falls_back_to_the_file_of_the_previous_format(vault, monkeypatch):
+    quantum_controller = controller(vault, monkeypatch, {'800' : {'format' : "AVIF"}})
+    profile = quantum_controller.profile("_c")
+
+    assert quantum_controller.version_file("000001", profile) == str(vault / "photos" / "000001_c.avif")
+
+    (vault / "photos" / "000001_c.webp").write_bytes(b"webp")
+    assert quantum_controller.version_file("000001", profile) == str(vault / "photos" / "000001_c.webp")
+
+    (vault / "photos" / "000001_c.avif").write_bytes(b"avif")
+    assert quantum_controller.version_file("000001", profile) == str(vault / "photos" / "000001_c.avif")
+
+
+def test_page_links_to_the_version_in_the_new_format(vault, tmp_path, monkeypatch):
+    source = original(tmp_path)
+    before = controller(vault, monkeypatch)
+    added = pages_written(monkeypatch, "complete_add")
+    before.complete_add([FakeImage(before, source)])
+    before.renditions.shutdown()
+    assert added == ["000001_c.webp"]
+    Journal.load()
+
+    after = controller(vault, monkeypatch, {'800' : {'format' : "AVIF"}})
+    updated = pages_written(monkeypatch, "complete_update")
+    after.complete_update([FakeImage(after, source, IMatchImage.OP_UPDATE)])
+    after.renditions.shutdown()
+
+    assert updated == ["000001_c.avif"]
+    assert os.path.exists(vault / "photos" / "000001_c.avif")
+    assert not os.path.exists(vault / "photos" / "000001_c.webp")
+
+
+def test_version_in_the_old_format_stays_while_a_note_embeds_it(vault, tmp_path, monkeypatch):
+    source = original(tmp_path)
+    before = controller(vault, monkeypatch)
+    before.generate_versions([FakeImage(before, source)], "adds")
+    before.renditions.shutdown()
+    Journal.load()
+    (vault / "notes" / "walk.md").write_text("![[000001_c.webp]]\n", encoding='utf-8')
+
+    after = controller(vault, monkeypatch, {'800' : {'format' : "AVIF"}, '640' : {'format' : "AVIF"}})
+    after.generate_versions([FakeImage(after, source, IMatchImage.OP_UPDATE)], "updates")
+    after.renditions.shutdown()
+
+    assert os.path.exists(vault / "photos" / "000001_c.webp")
+    assert not os.path.exists(vault / "photos" / "000001_z.webp")
+    assert os.path.exists(vault / "photos" / "000001_z.avif")
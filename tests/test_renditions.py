@@ -0,0 +1,137 @@
+import io
+import random
+
+from PIL import Image
+
+from renditions import QUALITY, RenditionManifest, create_image_versions, encode, encode_version, ssim
+
+PROFILES = [{'size' : 100, 'suffix' : "_c", 'format' : "WEBP"}, {'size' : 50, 'suffix' : "_m", 'format' : "WEBP"}]
+
+
+def make_original(path, colour):
+    Image.new("RGB", (400, 200), colour).save(path)
+    return str(path)
+
+
+def make_noise(seed=1):
+    """An image whose encoded size falls steadily with the quality"""
+    noise = random.Random(seed)
+    return Image.frombytes("RGB", (64, 64), bytes(noise.randrange(256) for _ in range(64 * 64 * 3))).resize((256, 256))
+
+
+def versions(tmp_path, current):
+    return [(str(tmp_path / f"000001{profile['suffix']}.webp"), profile, current) for profile in PROFILES]
+
+
+def test_default_profile_matches_manifests_written_before_profiles():
+    assert RenditionManifest.settings({'size' : 800, 'suffix' : "_c", 'format' : "WEBP"}) == {'long_edge' : 800, 'format' : "WEBP", 'quality' : QUALITY}
+
+
+def test_settings_change_with_the_encoder_profile():
+    default = RenditionManifest.settings({'size' : 800, 'suffix' : "_c", 'format' : "WEBP"})
+
+    assert RenditionManifest.settings({'size' : 800, 'suffix' : "_c", 'format' : "AVIF"}) != default
+    assert RenditionManifest.settings({'size' : 800, 'suffix' : "_c", 'format' : "WEBP", 'quality' : 70}) != default
+    assert RenditionManifest.settings({'size' : 800, 'suffix' : "_c", 'format' : "WEBP", 'options' : {'method' : 6}}) != default
+    assert RenditionManifest.settings({'size' : 800, 'suffix' : "_c", 'format' : "WEBP", 'budget' : 50000}) != default
+
+
+def test_manifest_round_trip(state):
+    manifest = {'source' : {'file' : "a.jpg", 'size' : 1, 'mtime' : 2.0}, 'pixel_hash' : "abc", 'versions' : {"000001_c.webp" : {'long_edge' : 800}}}
+
+    RenditionManifest.save("000001", manifest)
+    assert RenditionManifest.load("000001") == manifest
+
+    RenditionManifest.delete("000001")
+    assert RenditionManifest.load("000001") is None
+    RenditionManifest.delete("000001")  # Already gone
+
+
+def test_unreadable_manifest_counts_as_missing(state):
+    RenditionManifest.save("000001", {})
+    with open(RenditionManifest.path("000001"), 'w', encoding='utf-8') as file:
+        file.write('{"pixel_')
+
+    assert RenditionManifest.load("000001") is None
+
+
+def test_source_changes_when_the_original_is_rewritten(tmp_path):
+    original = make_original(tmp_path / "original.png", "red")
+    before = RenditionManifest.source(original)
+
+    Image.new("RGB", (300, 200), "red").save(original)
+
+    assert RenditionManifest.source(original) != before
+
+
+def test_current_versions_are_kept_when_the_pixels_are_unchanged(tmp_path):
+    original = make_original(tmp_path / "original.png", "red")
+    digest, rendered, errors = create_image_versions(original, versions(tmp_path, False))
+    assert sorted(rendered) == sorted(output_file for output_file, _, _ in versions(tmp_path, False))
+    assert errors == {}
+
+    again, rendered, errors = create_image_versions(original, versions(tmp_path, True), known_hash=digest)
+
+    assert again == digest
+    assert rendered == []
+
+
+def test_versions_are_rendered_again_when_the_pixels_change(tmp_path):
+    original = make_original(tmp_path / "original.png", "red")
+    digest, _, _ = create_image_versions(original, versions(tmp_path, False))
+
+    make_original(original, "blue")
+    changed, rendered, _ = create_image_versions(original, versions(tmp_path, True), known_hash=digest)
+
+    assert changed != digest
+    assert len(rendered) == len(PROFILES)
+
+
+def test_versions_not_current_are_rendered_even_with_unchanged_pixels(tmp_path):
+    original = make_original(tmp_path / "original.png", "red")
+    digest, _, _ = create_image_versions(original, versions(tmp_path, False))
+
+    _, rendered, _ = create_image_versions(original, versions(tmp_path, False), known_hash=digest)
+
+    assert len(rendered) == len(PROFILES)
+
+
+def test_ssim_is_one_for_identical_images_and_less_otherwise():
+    img = make_noise()
+
+    assert ssim(img, img.copy()) == 1.0
+    assert ssim(img, make_noise(seed=2)) < 0.5
+
+
+def test_version_without_a_budget_is_encoded_at_the_profile_quality():
+    img = make_noise()
+    profile = {'size' : 256, 'suffix' : "_c", 'format' : "WEBP", 'quality' : 70}
+
+    assert encode_version(img, profile, {}) == encode(img, profile, 70, {})
+
+
+def test_version_within_its_budget_is_encoded_at_the_profile_quality():
+    img = make_noise()
+    profile = {'size' : 256, 'suffix' : "_c", 'format' : "WEBP"}
+    data = encode(img, profile, QUALITY, {})
+
+    assert encode_version(img, profile | {'budget' : len(data)}, {}) == data
+
+
+def test_version_over_budget_is_made_smaller_while_it_still_looks_the_same():
+    img = make_noise()
+    profile = {'size' : 256, 'suffix' : "_c", 'format' : "WEBP", 'threshold' : 0.8}
+    full = encode(img, profile, QUALITY, {})
+
+    data = encode_version(img, profile | {'budget' : len(full) // 2}, {})
+
+    assert len(data) < len(full)
+    with Image.open(io.BytesIO(data)) as decoded:
+        assert ssim(img, decoded) >= 0.8
+
+
+def test_version_that_cannot_get_smaller_and_look_the_same_keeps_the_profile_quality():
+    img = make_noise()
+    profile = {'size' : 256, 'suffix' : "_c", 'format' : "WEBP", 'threshold' : 1.0}
+
+    assert encode_version(img, profile | {'budget' : 1}, {}) == encode(img, profile, QUALITY, {})
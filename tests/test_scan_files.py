@@ -0,0 +1,95 @@
+import os
+import re
+
+import pytest
+
+import scan_files
+from scan_files import ReferenceIndex, list_files, media_pattern
+
+
+@pytest.fixture
+def vault(tmp_path):
+    folder = tmp_path / "vault"
+    (folder / "notes").mkdir(parents=True)
+    (folder / "photos").mkdir()
+    (folder / "notes" / "a.md").write_text("Walk\n![[000001_c.webp]]\nand ![[000002_m.webp]]\n", encoding='utf-8')
+    (folder / "notes" / "b.canvas").write_text('{"file" : "000001_z.webp"}', encoding='utf-8')
+    (folder / "photos" / "000003.md").write_text("![[000003_c.webp]]\n", encoding='utf-8')
+    return folder
+
+
+def reference_index(vault, tmp_path, extensions=scan_files.MEDIA_EXTENSIONS):
+    pattern, literal = media_pattern(extensions)
+    return ReferenceIndex(str(vault), pattern, scan_files.VAULT_FOLDERS_TO_IGNORE, str(tmp_path / "state" / "references.json"), literal)
+
+
+def test_first_update_reads_every_file_outside_the_ignored_folders(vault, tmp_path):
+    index = reference_index(vault, tmp_path)
+
+    assert index.update() == (2, 0)
+    assert sorted(index.lookup("000001")) == [(str(vault / "notes" / "a.md"), 2), (str(vault / "notes" / "b.canvas"), 1)]
+    assert index.lookup("000002") == [(str(vault / "notes" / "a.md"), 3)]
+    assert index.lookup("000003") == []
+
+
+def test_unchanged_files_are_not_read_again(vault, tmp_path):
+    reference_index(vault, tmp_path).update()
+
+    index = reference_index(vault, tmp_path)
+
+    assert index.update() == (0, 0)
+    assert index.lookup("000002") == [(str(vault / "notes" / "a.md"), 3)]
+
+
+def test_changed_files_are_read_again(vault, tmp_path):
+    index = reference_index(vault, tmp_path)
+    index.update()
+
+    (vault / "notes" / "a.md").write_text("Rewritten\n\n\n![[000004_n.webp]]\n", encoding='utf-8')
+
+    assert index.update() == (1, 0)
+    assert index.lookup("000002") == []
+    assert index.lookup("000004") == [(str(vault / "notes" / "a.md"), 4)]
+    assert index.lookup("000001") == [(str(vault / "notes" / "b.canvas"), 1)]
+
+
+def test_removed_files_are_dropped(vault, tmp_path):
+    index = reference_index(vault, tmp_path)
+    index.update()
+
+    os.remove(vault / "notes" / "b.canvas")
+
+    assert index.update() == (0, 1)
+    assert index.lookup("000001") == [(str(vault / "notes" / "a.md"), 2)]
+
+
+def test_index_is_rebuilt_when_the_pattern_changes(vault, tmp_path):
+    reference_index(vault, tmp_path).update()
+
+    assert reference_index(vault, tmp_path, ["avif", "webp"]).update() == (2, 0)
+
+
+def test_every_file_but_binary_attachments_is_listed(vault):
+    (vault / "notes" / "page.html").write_text("<img src='000005_c.webp'>", encoding='utf-8')
+    (vault / "notes" / "picture.PNG").write_bytes(b"\x89PNG")
+    (vault / ".obsidian").mkdir()
+    (vault / ".obsidian" / "workspace.json").write_text("{}", encoding='utf-8')
+
+    files = list_files(str(vault), scan_files.VAULT_FOLDERS_TO_IGNORE)
+
+    assert sorted(os.path.relpath(file, vault) for file in files) == sorted([
+        os.path.join("notes", "a.md"), os.path.join("notes", "b.canvas"), os.path.join("notes", "page.html")])
+
+
+def test_media_pattern_matches_only_the_formats_given():
+    pattern, literal = media_pattern(["avif", "webp"])
+
+    assert re.findall(pattern, "![[000001_c.webp]] ![[000002_m.avif]] ![[000003_c.jpg]]") == ["000001_c.webp", "000002_m.avif"]
+    assert literal == (b".avif", b".webp")
+
+
+def test_media_pattern_ignores_flickr_urls():
+    pattern, _ = media_pattern(["jpg", "webp"])
+
+    assert re.findall(pattern, "https://live.staticflickr.com/65535/5551234_8f3e123456_c.jpg") == []
+    assert re.findall(pattern, "![[123456_c.jpg]]") == ["123456_c.jpg"]
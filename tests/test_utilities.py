@@ -0,0 +1,226 @@
+import os
+import stat
+import sys
+import time
+
+import pytest
+
+import config
+from utilities import ExifToolPool, MetadataDigests, set_metadata, write_if_changed
+
+## Stands in for exiftool -stay_open. Each command's last argument names its target, and the
+## target's name says how to behave: "crash" exits once, "die" always exits, "hang" never answers
+## and "bad" is not updated, as exiftool reports for a file it can't write.
+FAKE_EXIFTOOL = f"""#!{sys.executable}
+import os, sys, time
+args = []
+for line in sys.stdin:
+    line = line.rstrip("\\n")
+    if line.startswith("-execute"):
+        target = args[-1] if args else ""
+        if "crash" in target and not os.path.exists(target + ".crashed"):
+            open(target + ".crashed", "w").close()
+            sys.exit(1)
+        if "die" in target:
+            sys.exit(1)
+        if "hang" in target:
+            time.sleep(60)
+        updated = len([arg for arg in args if arg.endswith(".webp") and "bad" not in arg])
+        print("12.70" if args == ["-ver"] else f"    {{updated}} image files updated")
+        print("{{ready" + line[len("-execute"):] + "}}", flush=True)
+        args = []
+    elif line == "False":
+        sys.exit(0)
+    else:
+        args.append(line)
+"""
+
+
+@pytest.fixture
+def exiftool(tmp_path, monkeypatch):
+    path = tmp_path / "exiftool"
+    path.write_text(FAKE_EXIFTOOL)
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setattr(config, "EXIFTOOL_PATH", str(path))
+    return tmp_path
+
+
+def commands(folder, *names):
+    return [(name, ['-TagsFromFile', "original.jpg", str(folder / name)]) for name in names]
+
+
+def results(pool, commands):
+    try:
+        return {key : (output, error) for key, output, error in pool.run(commands)}
+    finally:
+        pool.shutdown()
+
+
+def session_pids(pool):
+    return sorted(session.process.pid for session in pool._idle)
+
+
+def test_every_command_is_answered(exiftool):
+    names = [f"{i}.webp" for i in range(20)]
+
+    answers = results(ExifToolPool(sessions=2, pipeline=3, timeout=5), commands(exiftool, *names))
+
+    assert set(answers) == set(names)
+    assert all(error is None and "1 image files updated" in output for output, error in answers.values())
+
+
+def test_commands_lost_with_a_crashed_session_are_tried_again(exiftool):
+    names = ["a.webp", "crash.webp", "b.webp", "c.webp"]
+
+    answers = results(ExifToolPool(sessions=1, pipeline=4, timeout=5), commands(exiftool, *names))
+
+    assert all(error is None for output, error in answers.values())
+
+
+def test_command_that_keeps_failing_fails_alone(exiftool):
+    names = ["a.webp", "die.webp", "b.webp", "c.webp"]
+
+    answers = results(ExifToolPool(sessions=1, pipeline=4, timeout=5), commands(exiftool, *names))
+
+    assert isinstance(answers["die.webp"][1], OSError)
+    assert all(answers[name][1] is None for name in ["a.webp", "b.webp", "c.webp"])
+
+
+def test_hung_command_times_out_without_blaming_the_others(exiftool):
+    names = ["a.webp", "hang.webp", "b.webp", "c.webp"]
+
+    start = time.perf_counter()
+    answers = results(ExifToolPool(sessions=1, pipeline=4, timeout=1), commands(exiftool, *names))
+
+    assert isinstance(answers["hang.webp"][1], TimeoutError)
+    assert all(answers[name][1] is None for name in ["a.webp", "b.webp", "c.webp"])
+    assert time.perf_counter() - start < 10
+
+
+def test_missing_exiftool_fails_every_command(exiftool, monkeypatch):
+    monkeypatch.setattr(config, "EXIFTOOL_PATH", os.path.join(exiftool, "missing"))
+
+    answers = results(ExifToolPool(sessions=2, timeout=1), commands(exiftool, "a.webp", "b.webp"))
+
+    assert all(error is not None for output, error in answers.values())
+
+
+def test_only_files_exiftool_updated_count_as_written(exiftool):
+    tasks = [("original.jpg", str(exiftool / name), False) for name in ["a_c.webp", "bad_c.webp", "a_m.webp"]]
+    tasks.append(("other.jpg", str(exiftool / "bad_m.webp"), False))
+
+    written = set_metadata(tasks, "Test")
+
+    assert sorted(written) == [str(exiftool / "a_c.webp"), str(exiftool / "a_m.webp")]
+
+
+def test_sessions_are_kept_for_the_next_run_until_shutdown(exiftool):
+    pool = ExifToolPool(sessions=2, pipeline=2, timeout=5)
+    pool.run(commands(exiftool, *[f"{i}.webp" for i in range(8)]))
+    started = session_pids(pool)
+
+    answers = pool.run(commands(exiftool, *[f"{i}.webp" for i in range(8, 16)]))
+
+    assert len(started) == 2
+    assert all(error is None for key, output, error in answers)
+    assert session_pids(pool) == started
+
+    pool.shutdown()
+    assert pool._idle == []
+
+
+def test_kept_sessions_leave_room_for_other_pools(exiftool):
+    kept = ExifToolPool(sessions=config.EXIFTOOL_SESSIONS, pipeline=1, timeout=5)
+    kept.run(commands(exiftool, *[f"{i}.webp" for i in range(config.EXIFTOOL_SESSIONS)]))
+
+    try:
+        answers = results(ExifToolPool(sessions=1, timeout=5), commands(exiftool, "other.webp"))
+    finally:
+        kept.shutdown()
+
+    assert answers["other.webp"][1] is None
+
+
+def test_dead_kept_session_is_restarted(exiftool):
+    pool = ExifToolPool(sessions=1, timeout=5)
+    pool.run(commands(exiftool, "a.webp"))
+    pool._idle[0].process.kill()
+    pool._idle[0].process.wait()
+
+    answers = results(pool, commands(exiftool, "b.webp"))
+
+    assert answers["b.webp"][1] is None
+
+
+## Digests are cached by platform for the run, so each test uses a platform of its own
+
+def test_digest_is_current_until_the_metadata_changes(state, tmp_path):
+    output_file = tmp_path / "000001_c.webp"
+    output_file.write_bytes(b"version")
+
+    MetadataDigests.record("unchanged", {str(output_file) : "abc"})
+
+    assert MetadataDigests.current("unchanged", str(output_file), "abc")
+    assert not MetadataDigests.current("unchanged", str(output_file), "def")
+
+
+def test_digest_is_not_current_once_the_file_is_rewritten(state, tmp_path):
+    output_file = tmp_path / "000001_c.webp"
+    output_file.write_bytes(b"version")
+    MetadataDigests.record("rewritten", {str(output_file) : "abc"})
+
+    output_file.write_bytes(b"rendered again")
+
+    assert not MetadataDigests.current("rewritten", str(output_file), "abc")
+
+
+def test_digest_is_not_current_once_the_file_is_touched(state, tmp_path):
+    output_file = tmp_path / "000001_c.webp"
+    output_file.write_bytes(b"version")
+    MetadataDigests.record("touched", {str(output_file) : "abc"})
+
+    os.utime(output_file, (time.time() + 10, time.time() + 10))
+
+    assert not MetadataDigests.current("touched", str(output_file), "abc")
+
+
+def test_files_never_recorded_or_missing_are_not_current(state, tmp_path):
+    output_file = tmp_path / "000001_c.webp"
+
+    MetadataDigests.record("missing", {str(output_file) : "abc"})
+
+    assert not MetadataDigests.current("missing", str(output_file), "abc")
+    assert not MetadataDigests.current("missing", str(tmp_path / "other.webp"), "abc")
+
+
+def test_write_if_changed_writes_new_files(tmp_path):
+    path = tmp_path / "note.md"
+
+    assert write_if_changed(str(path), "# Photo\n")
+    assert path.read_text(encoding='utf-8') == "# Photo\n"
+
+
+def test_write_if_changed_leaves_identical_files_alone(tmp_path):
+    path = tmp_path / "note.md"
+    path.write_text("# Photo\n", encoding='utf-8')
+    os.utime(path, (1000000000, 1000000000))
+
+    assert not write_if_changed(str(path), "# Photo\n")
+    assert path.stat().st_mtime == 1000000000
+
+
+def test_write_if_changed_replaces_changed_files_without_leaving_a_temp_file(tmp_path):
+    path = tmp_path / "note.md"
+    path.write_text("# Photo\n", encoding='utf-8')
+
+    assert write_if_changed(str(path), "# Photo\nNew caption\n")
+    assert path.read_text(encoding='utf-8') == "# Photo\nNew caption\n"
+    assert os.listdir(tmp_path) == ["note.md"]
+
+
+def test_write_if_changed_replaces_files_that_are_not_text(tmp_path):
+    path = tmp_path / "note.md"
+    path.write_bytes(b"\xff\xfe\x00broken")
+
+    assert write_if_changed(str(path), "# Photo\n")
+    assert path.read_text(encoding='utf-8') == "# Photo\n"
@@ -0,0 +1,110 @@
+import atexit
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+## Opt-in tracing of the calls that dominate a run: IMatch requests, PIL renditions,
+## exiftool, file copies and platform api calls. Spans are saved in the Chrome trace
+## event format, so the file opens in chrome://tracing or https://ui.perfetto.dev.
+## Each span carries the image and platform it was working for, so a slow image can
+## be pinned on IMatch, decoding or upload.
+
+
+def now():
+    """Trace clock in microseconds. Wall clock, so times from worker processes line up."""
+    return time.time_ns() // 1000
+
+
+class Trace():
+    """The spans of the run, held in memory until stop() saves them. Each is tagged with
+    the image and platform that context() set for its thread."""
+
+    enabled = False
+    __path = None
+    __events = []
+    __threads = {}      # (pid, tid) -> thread name
+    __lock = threading.Lock()
+    __context = threading.local()
+
+    @classmethod
+    def start(cls, path):
+        """Begin tracing. The trace is saved to path when the run ends, even if it ends in an error."""
+        cls.__path = path
+        cls.__events = []
+        cls.enabled = True
+        atexit.register(cls.stop)
+
+    @classmethod
+    def stop(cls):
+        """Save the trace collected so far"""
+        if not cls.enabled:
+            return
+        cls.enabled = False
+        with cls.__lock:
+            events = list(cls.__events)
+            for (pid, tid), name in cls.__threads.items():
+                events.append({'name' : 'thread_name', 'ph' : 'M', 'pid' : pid, 'tid' : tid, 'args' : {'name' : name}})
+        with open(cls.__path, 'w', encoding='utf-8') as file:
+            json.dump({'traceEvents' : events, 'displayTimeUnit' : 'ms'}, file)
+        print(f"Trace of {len(events)} events saved to {cls.__path}")
+
+    @classmethod
+    @contextmanager
+    def context(cls, image=None, platform=None):
+        """Tag spans started by this thread, within the block, with the image and platform being worked on"""
+        if not cls.enabled:
+            yield
+            return
+        previous = getattr(cls.__context, 'args', {})
+        cls.__context.args = previous | {key : value for key, value in {'image' : image, 'platform' : platform}.items() if value is not None}
+        try:
+            yield
+        finally:
+            cls.__context.args = previous
+
+    @classmethod
+    @contextmanager
+    def span(cls, name, category, **args):
+        """Record the enclosed block as a span"""
+        if not cls.enabled:
+            yield
+            return
+        start = now()
+        try:
+            yield
+        finally:
+            cls.add(name, category, start, now(), **args)
+
+    @classmethod
+    def add(cls, name, category, start, end, pid=None, tid=None, thread_name=None, **args):
+        """Record a span timed elsewhere, e.g. in a worker process. Defaults to the calling thread."""
+        if not cls.enabled:
+            return
+        if pid is None:
+            pid, tid, thread_name = os.getpid(), threading.get_ident(), threading.current_thread().name
+        event = {
+            'name' : name,
+            'cat' : category,
+            'ph' : 'X',
+            'ts' : start,
+            'dur' : end - start,
+            'pid' : pid,
+            'tid' : tid,
+            'args' : getattr(cls.__context, 'args', {}) | args,
+        }
+        with cls.__lock:
+            cls.__events.append(event)
+            if (pid, tid) not in cls.__threads:
+                cls.__threads[(pid, tid)] = thread_name or f"{pid}:{tid}"
+
+    @classmethod
+    def traced(cls, func, image, platform):
+        """Wrap func(image) so spans inside it are tagged with the image, for use with executors"""
+        if not cls.enabled:
+            return func
+        def call(*args, **kwargs):
+            with cls.context(image=image, platform=platform):
+                return func(*args, **kwargs)
+        return call
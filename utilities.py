@@ -1,14 +1,73 @@
-from datetime import timedelta
+from collections import deque
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+import json
 from pathlib import Path
 import logging
 import os
+import queue
+import re
 import subprocess
 import sys
 import threading
-import time
 from tqdm import tqdm
 
 import config
+from events import Events, EventProgress
+from tracing import Trace, now
+
+## Serialise terminal output. Controllers can run side by side, so status lines
+## and progress bars from different threads must not tear each other apart.
+output_lock = threading.RLock()
+tqdm.set_lock(output_lock)
+
+## Held while rewriting files in the vault. Quantum writes pages into the vault
+## while Flickr may be rewriting image links in those same pages.
+vault_lock = threading.RLock()
+
+class LazyFormat():
+    """Defers an expensive formatting call, e.g. pformat, until a log record is actually emitted.
+    Use as a logging argument: logging.debug("Image\n%s", LazyFormat(pformat, image.__dict__))"""
+
+    def __init__(self, func, *args, **kwargs) -> None:
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return str(self.func(*self.args, **self.kwargs))
+
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per log record, for feeding into other tools. Values passed to logging
+    through extra= are included as fields."""
+
+    _STANDARD = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+    def format(self, record):
+        entry = {
+            "time" : datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level" : record.levelname,
+            "logger" : record.name,
+            "thread" : record.threadName,
+            "message" : record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in self._STANDARD:
+                entry[key] = value if isinstance(value, (str, int, float, bool, type(None))) else str(value)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def add_json_log(path, level=logging.DEBUG):
+    """Also send log records to path as JSON lines. The root logger's level still applies."""
+    handler = logging.FileHandler(path, mode='w', encoding='utf-8')
+    handler.setLevel(level)
+    handler.setFormatter(JsonLogFormatter())
+    logging.getLogger().addHandler(handler)
+    return handler
+
 
 ## Clear the full length of any line so that if the new text is shorter
 ## there are no issues
@@ -19,8 +78,44 @@ def clear_line():
 
 ## Simplify call to clear_line()
 def print_clear(text='', end="\n"):
-    clear_line()
-    print(text, end=end)
+    with output_lock:
+        clear_line()
+        print(text, end=end)
+
+
+## Standard progress bar. Concurrent controllers pass their own position so
+## each keeps to its own line.
+def progress_bar(iterable=None, desc=None, position=None, **kwargs):
+    if Events.enabled:
+        return EventProgress(iterable, desc=desc, **kwargs)
+    return tqdm(iterable, desc=desc, position=position, bar_format=config.bar_format, **kwargs)
+
+
+## Write vault files only when they change. Every file touched in the vault is uploaded
+## again by Obsidian sync, so rewriting identical pages costs sync traffic for nothing.
+def write_if_changed(path, content, encoding='utf-8') -> bool:
+    """Write content to path unless the file already holds exactly that. Returns True if written.
+    The content goes to a hidden temp file beside the target, which then replaces it, so readers
+    never see a half written file. Hidden files are ignored by Obsidian."""
+    try:
+        with open(path, 'r', encoding=encoding) as file:
+            if file.read() == content:
+                return False
+    except (FileNotFoundError, UnicodeDecodeError):
+        pass
+    directory, name = os.path.split(path)
+    tmp_path = os.path.join(directory, f".{name}.tmp")
+    try:
+        with open(tmp_path, 'w', encoding=encoding) as file:
+            file.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return True
 
 
 ## Replace filename extension
@@ -90,54 +185,394 @@ exiftool_private_tag_args = [
     "-overwrite_original"
 ]
 
-def set_metadata(exiftool_tasks, controller_name):
-    with ExifToolSession() as et:
-        for src, tgt, isPrivate in (pbar := tqdm(exiftool_tasks, bar_format=config.bar_format)):
+def metadata_command(src, targets, isPrivate):
+    """exiftool arguments to replace the metadata in each target with the whitelisted tags from src"""
+    args = exiftool_private_tag_args if isPrivate else exiftool_public_tag_args
+    return ['-all=', '--icc_profile:all', '-overwrite_original', '-TagsFromFile', src] + args + list(targets)
+
+
+def files_updated(output):
+    """Number of files exiftool reports updating in the output of a command"""
+    match = re.search(r"(\d+) image files updated", output)
+    return int(match.group(1)) if match else 0
+
+
+def set_metadata(exiftool_tasks, controller_name, position=None, batched=True, pool=None):
+    """Copy metadata from src to tgt for each [src, tgt, isPrivate] task. Returns the targets written.
+
+    When batched, targets sharing a source and privacy are written by a single command, so
+    exiftool reads the source once for all of them, e.g. all of an image's versions. If
+    exiftool reports fewer files updated than given, that group is retried one target at a
+    time to find the failures. A target only counts as written when exiftool reports it updated.
+
+    pool is the controller's ExifToolPool, kept for the run. Without one, sessions are started
+    for this call alone."""
+    groups = {}
+    for src, tgt, isPrivate in exiftool_tasks:
+        key = (src, isPrivate) if batched else (src, isPrivate, tgt)
+        groups.setdefault(key, []).append(tgt)
+    commands = [(tuple(targets), metadata_command(key[0], targets, key[1])) for key, targets in groups.items()]
+
+    written = []
+    retry = []
+    pbar = progress_bar(total=len(exiftool_tasks), desc=f"{controller_name}: Copying metadata", position=position)
+    own_pool = pool is None
+    if own_pool:
+        pool = ExifToolPool()
+    for targets, output, error in pool.run(commands, controller_name, on_done=lambda targets: pbar.update(len(targets))):
+        if error is not None:
+            for tgt in targets:
+                logging.error(f"Failed to copy metadata to {tgt}: {error}")
+        elif files_updated(output) == len(targets):
+            written.extend(targets)
+        elif len(targets) > 1:
+            retry.extend(targets)
+        else:
+            logging.error(f"Failed to copy metadata to {targets[0]}: {output.strip()}")
+    pbar.close()
+
+    if len(retry) > 0:
+        logging.warning(f"{controller_name}: Copying metadata to {len(retry)} files one at a time to find failures")
+        src_for = {tgt : (src, isPrivate) for src, tgt, isPrivate in exiftool_tasks}
+        commands = [((tgt,), metadata_command(src_for[tgt][0], [tgt], src_for[tgt][1])) for tgt in retry]
+        for targets, output, error in pool.run(commands, controller_name):
+            if error is None and files_updated(output) == 1:
+                written.extend(targets)
+            else:
+                logging.error(f"Failed to copy metadata to {targets[0]}: {error if error is not None else output.strip()}")
+    if own_pool:
+        pool.shutdown()
+    return written
+
+
+class MetadataDigests():
+    """The metadata_digest last written into each shared file, by platform. Kept in the state
+    folder so metadata-only runs can leave files alone when the copied tags are unchanged. The
+    file's size and mtime are kept with the digest, so a file rewritten since, e.g. re-rendered
+    or copied afresh, no longer matches. Each platform's file is read when first needed and
+    replaced whole on every record()."""
+
+    FOLDER = "metadata"
+    __digests = {}  # platform -> {file : {digest, size, mtime}}
+    __lock = threading.Lock()
+
+    @classmethod
+    def path(cls, platform):
+        return os.path.join(config.STATE_PATH, cls.FOLDER, f"{platform}.json")
+
+    @classmethod
+    def _load(cls, platform):
+        """Called holding the lock"""
+        if platform not in cls.__digests:
             try:
-                pbar.set_description(f"{controller_name}: Copying metadata")
-                args = exiftool_private_tag_args if isPrivate else exiftool_public_tag_args
-                cmd = ['-all=', '--icc_profile:all', '-overwrite_original', '-TagsFromFile', src] + args + [tgt]
-                response = et.send(cmd)
-            except Exception as e:
-                logging.error(f"Failed to copy metadata to {tgt}: {e}")
+                with open(cls.path(platform), 'r', encoding='utf-8') as file:
+                    cls.__digests[platform] = json.load(file)
+            except (FileNotFoundError, json.JSONDecodeError):
+                cls.__digests[platform] = {}
+        return cls.__digests[platform]
+
+    @staticmethod
+    def _stat(filename):
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        return {'size' : stat.st_size, 'mtime' : stat.st_mtime}
+
+    @classmethod
+    def current(cls, platform, filename, digest) -> bool:
+        """Does the file still hold the metadata with this digest?"""
+        with cls.__lock:
+            entry = cls._load(platform).get(filename)
+        return entry is not None and entry['digest'] == digest and {'size' : entry['size'], 'mtime' : entry['mtime']} == cls._stat(filename)
+
+    @classmethod
+    def record(cls, platform, digests):
+        """Record the digests, a dict of file -> metadata_digest, of files just written and save"""
+        with cls.__lock:
+            entries = cls._load(platform)
+            for filename, digest in digests.items():
+                stat = cls._stat(filename)
+                if stat is not None:
+                    entries[filename] = {'digest' : digest} | stat
+            os.makedirs(os.path.dirname(cls.path(platform)), exist_ok=True)
+            tmp_path = cls.path(platform) + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as file:
+                json.dump(entries, file)
+            os.replace(tmp_path, cls.path(platform))
 
 
 class ExifToolSession:
+    """A stay-open exiftool process. Every session at work counts towards
+    config.EXIFTOOL_SESSIONS, so controllers running side by side share the limit.
+    A session kept for later gives up its place with idle() and takes it back with claim().
+
+    Commands are pipelined: each is numbered with -execute<N> and written straight away,
+    so several can be queued in exiftool's stdin. A reader thread collects the output up
+    to each {ready<N>} and resolves that command's future."""
+
+    _slots = threading.BoundedSemaphore(config.EXIFTOOL_SESSIONS)
+    _READY = re.compile(r"\{ready(\d+)\}")
+
+    def __init__(self) -> None:
+        self.process = None
+        self._lock = threading.Lock()
+        self._pending = {}  # id -> Future, for commands written but not yet answered
+        self._next_id = 0
+        self._holding = False  # One of the _slots
+
     def __enter__(self):
-        self.process = subprocess.Popen(
-            [r"C:\Program Files\photools.com\imatch6\exiftool.exe", '-stay_open', 'True', '-@', '-'],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True,
-            bufsize=1
-        )
-        threading.Thread(target=self._drain_stderr, daemon=True).start()
+        self.start()
         return self
 
-    def _drain_stderr(self):
-        for line in iter(self.process.stderr.readline, ''):
+    def claim(self):
+        if not self._holding:
+            ExifToolSession._slots.acquire()
+            self._holding = True
+
+    def idle(self):
+        if self._holding:
+            self._holding = False
+            ExifToolSession._slots.release()
+
+    def start(self):
+        self.claim()
+        try:
+            process = subprocess.Popen(
+                [config.EXIFTOOL_PATH, '-stay_open', 'True', '-@', '-'],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                universal_newlines=True,
+                bufsize=1
+            )
+        except BaseException:
+            self.idle()
+            raise
+        with self._lock:
+            self.process = process
+            self._pending = {}
+        threading.Thread(target=self._read_stdout, args=(process,), daemon=True).start()
+        threading.Thread(target=self._drain_stderr, args=(process,), daemon=True).start()
+
+    def _drain_stderr(self, process):
+        for line in iter(process.stderr.readline, ''):
             logging.warning(f"[ExifTool stderr] {line.strip()}")
 
+    def _read_stdout(self, process):
+        output = []
+        for line in iter(process.stdout.readline, ''):
+            match = ExifToolSession._READY.fullmatch(line.strip())
+            if match is None:
+                output.append(line)
+                continue
+            with self._lock:
+                future = self._pending.pop(int(match.group(1)), None) if self.process is process else None
+            if future is not None:
+                future.finished = now()
+                future.set_result(''.join(output))
+            output = []
+        # The process has gone, taking any queued commands with it
+        with self._lock:
+            if self.process is process:
+                self._fail_pending(BrokenPipeError("ExifTool exited."))
+
+    def _fail_pending(self, ex):
+        """Fail every unanswered command. Called holding the lock."""
+        for future in self._pending.values():
+            future.set_exception(ex)
+        self._pending = {}
 
-    def send(self, commands, timeout=15):
-        block = '\n'.join(commands) + '\n-execute\n'
-        self.process.stdin.write(block)
-        self.process.stdin.flush()
+    def alive(self):
+        """Is the process running and answering?"""
+        if self.process is None or self.process.poll() is not None:
+            return False
+        try:
+            self.send(['-ver'])
+            return True
+        except (OSError, TimeoutError):
+            return False
 
-        output = ''
-        start = time.time()
-        while True:
-            if time.time() - start > timeout:
-                raise TimeoutError("ExifTool response timed out.")
-            line = self.process.stdout.readline()
-            if line.strip() == '{ready}':
-                break
-            output += line
-        return output
+    def restart(self):
+        logging.warning("Restarting exiftool session")
+        self.close()
+        self.start()
+
+    def submit(self, commands):
+        """Queue a command without waiting for it. Returns a Future for its output that fails
+        with an OSError if the session dies first."""
+        future = Future()
+        future.started = now()
+        with self._lock:
+            if self.process is None or self.process.poll() is not None:
+                future.set_exception(BrokenPipeError("ExifTool is not running."))
+                return future
+            self._next_id += 1
+            self._pending[self._next_id] = future
+            try:
+                self.process.stdin.write('\n'.join(commands) + f'\n-execute{self._next_id}\n')
+                self.process.stdin.flush()
+            except OSError as ex:
+                self._fail_pending(ex)
+        return future
+
+    def send(self, commands, timeout=config.EXIFTOOL_TIMEOUT):
+        """Run a command and wait for its output"""
+        future = self.submit(commands)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            raise TimeoutError(f"ExifTool did not answer within {timeout}s.") from None
+        finally:
+            ExifToolSession.trace(future, commands)
+
+    @staticmethod
+    def trace(future, commands):
+        if future.done() and not future.cancelled():
+            Trace.add("exiftool", "exiftool", future.started, getattr(future, 'finished', now()), target=commands[-1])
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.process.stdin.write('-stay_open\nFalse\n')
-        self.process.stdin.flush()
-        self.process.terminate()
+        self.close()
+
+    def close(self):
+        with self._lock:
+            process, self.process = self.process, None
+            if process is not None:
+                self._fail_pending(BrokenPipeError("ExifTool session closed."))
+        try:
+            if process is not None:
+                process.stdin.write('-stay_open\nFalse\n')
+                process.stdin.flush()
+        except OSError:
+            pass  # Already gone
+        finally:
+            if process is not None:
+                process.terminate()
+            self.idle()
+
+
+class ExifToolPool:
+    """Shares a list of exiftool commands across several sessions, one thread driving each.
+    Each session keeps up to pipeline commands queued. Sessions are checked before use and
+    restarted if they die or a command times out. The commands lost with the session are
+    tried once more on the fresh one.
+
+    Sessions are kept between calls to run(), so a controller starts exiftool once for the
+    whole run rather than for every batch. shutdown() closes them."""
+
+    def __init__(self, sessions=None, pipeline=None, timeout=None) -> None:
+        self.sessions = sessions or config.EXIFTOOL_SESSIONS
+        self.pipeline = pipeline or config.EXIFTOOL_PIPELINE
+        self.timeout = timeout or config.EXIFTOOL_TIMEOUT
+        self._idle = []     # Sessions waiting for the next run()
+        self._lock = threading.Lock()
+
+    def _take(self):
+        """A kept session, or a new one not yet started"""
+        with self._lock:
+            session = self._idle.pop() if len(self._idle) > 0 else ExifToolSession()
+        session.claim()
+        return session
+
+    def _keep(self, session):
+        with self._lock:
+            if session.process is not None and len(self._idle) < self.sessions:
+                session.idle()
+                self._idle.append(session)
+                return
+        session.close()
+
+    def shutdown(self):
+        with self._lock:
+            sessions, self._idle = self._idle, []
+        for session in sessions:
+            session.close()
+
+    def run(self, commands, controller_name=None, on_done=None):
+        """Run each (key, command) and return (key, output, error) for every one. error is None on success.
+        on_done(key) is called, from the session's thread, as each command finishes."""
+        work = queue.Queue()
+        for item in commands:
+            work.put(item)
+        results = []
+        lock = threading.Lock()
+
+        def finish(key, output, error):
+            with lock:
+                results.append((key, output, error))
+            if on_done is not None:
+                on_done(key)
+
+        def drive():
+            with Trace.context(platform=controller_name):
+                session = self._take()
+                try:
+                    if session.process is None:
+                        session.start()
+                    if not session.alive():
+                        session.restart()
+                except Exception as ex:
+                    logging.error(f"Unable to start exiftool ({config.EXIFTOOL_PATH}): {ex}")
+                    session.close()
+                    return  # Leave the work to the other sessions
+                in_flight = deque()  # (key, command, future, retried), oldest first
+                try:
+                    while True:
+                        while len(in_flight) < pipeline:
+                            try:
+                                key, command = work.get_nowait()
+                            except queue.Empty:
+                                break
+                            in_flight.append((key, command, session.submit(command), False))
+                        if len(in_flight) == 0:
+                            return
+
+                        # exiftool answers in order, so the oldest command is the one being worked on
+                        key, command, future, retried = in_flight.popleft()
+                        try:
+                            output = future.result(self.timeout)
+                            ExifToolSession.trace(future, command)
+                            finish(key, output, None)
+                            continue
+                        except TimeoutError:
+                            error = TimeoutError(f"ExifTool did not answer within {self.timeout}s.")
+                        except OSError as ex:
+                            error = ex
+
+                        # The session is broken by the oldest command, as it is the one exiftool was on.
+                        # Keep any answers already in, restart it and queue the rest again. The oldest
+                        # only gets a second attempt.
+                        lost = [(key, command, future, retried)] + list(in_flight)
+                        in_flight.clear()
+                        try:
+                            session.restart()
+                        except Exception as restart_ex:
+                            error = restart_ex
+                        for i, (key, command, future, retried) in enumerate(lost):
+                            if future.done() and future.exception() is None:
+                                finish(key, future.result(), None)
+                            elif (i == 0 and retried) or session.process is None:
+                                finish(key, None, error)
+                            else:
+                                in_flight.append((key, command, session.submit(command), retried or i == 0))
+                        if session.process is None:
+                            return  # Leave the remaining work to the other sessions
+                finally:
+                    for key, command, future, retried in in_flight:
+                        finish(key, None, RuntimeError("exiftool session stopped"))
+                    self._keep(session)
+
+        threads = [threading.Thread(target=drive, name=f"exiftool-{i}", daemon=True) for i in range(min(self.sessions, len(commands)))]
+        # Shallow enough that the first session to start doesn't take all of a short list
+        pipeline = max(1, min(self.pipeline, len(commands) // max(1, len(threads))))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Anything left could not be run as no session would start
+        while not work.empty():
+            key, command = work.get_nowait()
+            finish(key, None, RuntimeError("no exiftool session available"))
+        return results
 